@@ -0,0 +1,260 @@
+"""
+Benchmarks for decoding JWTs through the issuer registry's parsers.
+
+Each token is split and decoded, routed to its issuer's parser, and verified with the parser's
+key before its claims are parsed, timing each stage as well as the whole decode. This is the
+work protected_route does for a token it hasn't seen before; its claims cache, endpoint
+policies, token size and structure checks and auth metrics are not measured.
+
+Each scenario (issuer and signing algorithm) runs with verification on and off, and with small
+and large metadata claims. Keys are generated locally and redis is stubbed out, so the
+benchmarks run offline. Run with:
+
+    tox -e benchmark
+    python -m benchmarks.jwt_validation --iterations 500 --scenario auth0
+"""
+import argparse
+import json
+import sys
+import time
+import uuid
+from typing import Any, Callable, Dict, List, NamedTuple, Optional, Sequence
+from unittest import mock
+
+import dhosredis
+import rsa
+from flask import Flask
+from jose import jwt as jose_jwt
+from jose.backends import RSAKey
+
+from flask_batteries_included.helpers.security.issuers import (
+    IssuerRegistry,
+    build_issuer_registry,
+)
+from flask_batteries_included.helpers.security.parsed_jwt import ParsedJwt
+
+INTERNAL_ISSUER = "http://localhost/"
+AUTH0_ISSUER = "https://auth0.benchmark/"
+CUSTOMDB_ISSUER = "https://customdb.benchmark/"
+EPR_ISSUER = "https://epr.benchmark/"
+AUTH0_AUDIENCE = "https://api.benchmark/"
+AUTH0_METADATA = "https://benchmark/metadata"
+AUTH0_SCOPE_KEY = "https://benchmark/scope"
+
+HS_KEY = "benchmark-internal-secret"
+AUTH0_HS_KEY = "benchmark-customdb-secret"
+EPR_HS_KEY = "benchmark-epr-secret"
+
+STAGES = ("parse", "routing", "key lookup", "verify", "parse_access_token")
+
+
+class Scenario(NamedTuple):
+    name: str
+    issuer: str
+    algorithm: str
+    signing_key: Any
+    kid: Optional[str] = None
+
+
+class Result(NamedTuple):
+    scenario: str
+    verify: bool
+    metadata: str
+    tokens_per_second: float
+    stage_micros: Dict[str, float]
+
+
+def _generate_scenarios() -> List[Scenario]:
+    print("Generating keys...", file=sys.stderr)
+    _, rsa_private_key = rsa.newkeys(2048)
+    return [
+        Scenario("internal HS512", INTERNAL_ISSUER, "HS512", HS_KEY),
+        Scenario("auth0 custom-db HS256", CUSTOMDB_ISSUER, "HS256", AUTH0_HS_KEY),
+        Scenario("epr HS512", EPR_ISSUER, "HS512", EPR_HS_KEY),
+        Scenario(
+            "auth0 RS256",
+            AUTH0_ISSUER,
+            "RS256",
+            RSAKey(rsa_private_key, "RS256"),
+            kid="benchmark-rsa",
+        ),
+    ]
+
+
+def _jwks(scenarios: Sequence[Scenario]) -> Dict:
+    keys = []
+    for scenario in scenarios:
+        if scenario.kid is not None:
+            public_jwk = scenario.signing_key.public_key().to_dict()
+            keys.append({**public_jwk, "kid": scenario.kid, "use": "sig"})
+    return {"keys": keys}
+
+
+def _config() -> Dict[str, Any]:
+    return {
+        "HS_ISSUER": INTERNAL_ISSUER,
+        "HS_KEY": HS_KEY,
+        "VALID_JWT_ALGORITHMS": ["HS256", "HS512", "RS256"],
+        "AUTH0_DOMAIN": AUTH0_ISSUER,
+        "AUTH0_AUDIENCE": AUTH0_AUDIENCE,
+        "AUTH0_METADATA": AUTH0_METADATA,
+        "AUTH0_SCOPE_KEY": AUTH0_SCOPE_KEY,
+        "AUTH0_JWKS_URL": "https://auth0.benchmark/.well-known/jwks.json",
+        "AUTH0_CUSTOM_DOMAIN": CUSTOMDB_ISSUER,
+        "AUTH0_HS_KEY": AUTH0_HS_KEY,
+        "EPR_SERVICE_ADAPTER_ISSUER": EPR_ISSUER,
+        "EPR_SERVICE_ADAPTER_HS_KEY": EPR_HS_KEY,
+    }
+
+
+def _token(scenario: Scenario, large_metadata: bool) -> str:
+    if scenario.issuer == AUTH0_ISSUER:
+        audience, metadata_key, scope_key = (
+            AUTH0_AUDIENCE,
+            AUTH0_METADATA,
+            AUTH0_SCOPE_KEY,
+        )
+    else:
+        audience, metadata_key, scope_key = INTERNAL_ISSUER, "metadata", "scope"
+
+    location_count: int = 2000 if large_metadata else 2
+    scope_count: int = 100 if large_metadata else 5
+    now = int(time.time())
+    claims = {
+        "iss": scenario.issuer,
+        "aud": audience,
+        "sub": str(uuid.uuid4()),
+        "iat": now,
+        "exp": now + 3600,
+        metadata_key: {
+            "clinician_id": str(uuid.uuid4()),
+            "job_title": "Benchmark",
+            "locations": [
+                {"id": str(uuid.uuid4()), "name": f"Location {i}"}
+                for i in range(location_count)
+            ],
+        },
+        scope_key: " ".join(f"read:thing{i}" for i in range(scope_count)),
+    }
+    headers = {"kid": scenario.kid} if scenario.kid else None
+    return jose_jwt.encode(
+        claims, scenario.signing_key, algorithm=scenario.algorithm, headers=headers
+    )
+
+
+def _time_stages(registry: IssuerRegistry, token: str, verify: bool) -> List[float]:
+    timings: List[float] = []
+    clock: Callable[[], float] = time.perf_counter
+
+    start = clock()
+    parsed = ParsedJwt(token)
+    timings.append(clock() - start)
+
+    start = clock()
+    parser = registry.get(parsed.claims["iss"], verify)
+    timings.append(clock() - start)
+    if parser is None:
+        raise RuntimeError(f"No parser for {parsed.claims['iss']}")
+
+    start = clock()
+    key = parser.resolve_key(parsed.header)
+    timings.append(clock() - start)
+
+    # Includes looking up the pre-constructed key object for the token's algorithm
+    start = clock()
+    access_token = parser._verify_token(parsed, key, parsed.header)
+    timings.append(clock() - start)
+
+    start = clock()
+    parser.parse_access_token(access_token)
+    timings.append(clock() - start)
+    return timings
+
+
+def _time_end_to_end(
+    registry: IssuerRegistry, token: str, verify: bool, iterations: int
+) -> float:
+    start = time.perf_counter()
+    for _ in range(iterations):
+        parsed = ParsedJwt(token)
+        parser = registry.get(parsed.claims["iss"], verify)
+        if parser is None:
+            raise RuntimeError(f"No parser for {parsed.claims['iss']}")
+        parser.decode_jwt(parsed, parsed.header)
+    return iterations / (time.perf_counter() - start)
+
+
+def run_benchmarks(
+    iterations: int = 200, scenario_filter: Optional[str] = None
+) -> List[Result]:
+    scenarios = _generate_scenarios()
+    app = Flask(__name__)
+    app.config.update(_config())
+    registry = build_issuer_registry(app.config)
+    jwks_json: str = json.dumps(_jwks(scenarios))
+
+    results: List[Result] = []
+    with app.app_context(), mock.patch.object(
+        dhosredis, "get_value", return_value=jwks_json
+    ):
+        for scenario in scenarios:
+            if scenario_filter and scenario_filter not in scenario.name:
+                continue
+            for large_metadata in (False, True):
+                token = _token(scenario, large_metadata)
+                for verify in (True, False):
+                    # Warm up caches (JWKS, key objects) as a long-running worker would
+                    _time_stages(registry, token, verify)
+
+                    totals = [0.0] * len(STAGES)
+                    for _ in range(iterations):
+                        for i, elapsed in enumerate(
+                            _time_stages(registry, token, verify)
+                        ):
+                            totals[i] += elapsed
+
+                    results.append(
+                        Result(
+                            scenario=scenario.name,
+                            verify=verify,
+                            metadata="large" if large_metadata else "small",
+                            tokens_per_second=_time_end_to_end(
+                                registry, token, verify, iterations
+                            ),
+                            stage_micros={
+                                stage: total / iterations * 1_000_000
+                                for stage, total in zip(STAGES, totals)
+                            },
+                        )
+                    )
+    return results
+
+
+def print_results(results: Sequence[Result]) -> None:
+    header = f"{'scenario':<24}{'verify':<8}{'metadata':<10}{'tokens/s':>10}" + "".join(
+        f"{stage + ' us':>22}" for stage in STAGES
+    )
+    print(header)
+    print("-" * len(header))
+    for result in results:
+        print(
+            f"{result.scenario:<24}{str(result.verify):<8}{result.metadata:<10}"
+            f"{result.tokens_per_second:>10.0f}"
+            + "".join(f"{result.stage_micros[stage]:>22.1f}" for stage in STAGES)
+        )
+
+
+def main(argv: Optional[Sequence[str]] = None) -> None:
+    arg_parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    arg_parser.add_argument(
+        "--iterations", type=int, default=200, help="iterations per benchmark"
+    )
+    arg_parser.add_argument(
+        "--scenario", default=None, help="only run scenarios containing this text"
+    )
+    args = arg_parser.parse_args(argv)
+    print_results(run_benchmarks(args.iterations, args.scenario))
+
+
+if __name__ == "__main__":
+    main()
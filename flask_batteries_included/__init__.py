@@ -9,7 +9,9 @@ from .helpers.error_handler import init_error_handler
 from .helpers.etags import init_etags
 from .helpers.json import CustomJSONEncoder
 from .helpers.metrics import init_metrics
+from .helpers.queued_logging import init_queued_logging
 from .helpers.request_id import init_request_id
+from .helpers.security.issuers import check_issuer_config
 
 
 def create_app(
@@ -40,6 +42,7 @@ def augment_app(
     use_pgsql: bool = False,
     use_sqlite: bool = False,
     use_jwt: bool = True,
+    use_queued_logging: bool = False,
 ) -> Flask:
     # TODO default use_jwt to False in next major version, and enforce kwargs with *
     use_sqlalchemy = use_pgsql or use_sqlite
@@ -53,6 +56,13 @@ def augment_app(
         use_jwt=use_jwt,
     )
 
+    # Fail at startup, rather than on every protected request, if extra JWT issuers are misconfigured
+    check_issuer_config(app.config)
+
+    # Write logs from a background thread so that requests don't wait on slow log I/O
+    if use_queued_logging:
+        init_queued_logging(app)
+
     # Register custom error handlers
     init_error_handler(app=app, use_sqlalchemy=use_sqlalchemy)
 
@@ -51,6 +51,34 @@ class GeneralConfig:
         self.LOG_REQUEST_ID_GENERATE_IF_NOT_FOUND: bool = env.bool(
             "LOG_REQUEST_ID_GENERATE_IF_NOT_FOUND", default=True
         )
+        # Used when augment_app is called with use_queued_logging: at most this many records are
+        # queued for the background logging thread, then records are dropped or logging blocks.
+        self.LOG_QUEUE_SIZE: int = env.int("LOG_QUEUE_SIZE", default=10_000)
+        self.LOG_QUEUE_OVERFLOW: str = env.str("LOG_QUEUE_OVERFLOW", default="drop")
+        # Access log sampling: rates from 0 to 1 by endpoint or status class (e.g. {"2xx": 0.1}) as
+        # JSON, with ACCESS_LOG_SAMPLE_RATE for anything else. Errors (4xx and 5xx) and requests
+        # taking at least ACCESS_LOG_SLOW_THRESHOLD seconds are always logged.
+        self.ACCESS_LOG_SAMPLE_RATE: float = env.float(
+            "ACCESS_LOG_SAMPLE_RATE", default=1.0
+        )
+        self.ACCESS_LOG_SAMPLE_RATES: Dict[str, float] = env.json(
+            "ACCESS_LOG_SAMPLE_RATES", default="{}"
+        )
+        self.ACCESS_LOG_SLOW_THRESHOLD: float = env.float(
+            "ACCESS_LOG_SLOW_THRESHOLD", default=1.0
+        )
+        # Per-request metrics to record (some of count, histogram and summary), with overrides by
+        # endpoint as JSON (e.g. {"healthcheck": []}), and the latency histogram's buckets in
+        # seconds; no buckets means the Prometheus defaults.
+        self.REQUEST_METRICS: List[str] = env.list(
+            "REQUEST_METRICS", default=["count", "histogram", "summary"]
+        )
+        self.REQUEST_METRICS_BY_ENDPOINT: Dict[str, List[str]] = env.json(
+            "REQUEST_METRICS_BY_ENDPOINT", default="{}"
+        )
+        self.REQUEST_LATENCY_BUCKETS: List[float] = env.list(
+            "REQUEST_LATENCY_BUCKETS", default=[], subcast=float
+        )
         self.PORT: int = env.int("PORT", default=5000)
         self.PREFERRED_URL_SCHEME: str = env.str("PREFERRED_URL_SCHEME", default="http")
         self.UNITTESTING: bool = testing
@@ -68,6 +96,9 @@ class GeneralConfig:
 class JwtConfig:
     def __init__(self) -> None:
         self.HS_KEY: str = env.str("HS_KEY")
+        # Secrets by kid, as a JSON object, for rotating HS_KEY: internal tokens with a kid in
+        # their header are verified with that secret, and tokens without one with HS_KEY.
+        self.HS_KEYRING: Dict[str, str] = env.json("HS_KEYRING", default="{}")
         self.IGNORE_JWT_VALIDATION: bool = env.bool(
             "IGNORE_JWT_VALIDATION", default=False
         )
@@ -78,6 +109,8 @@ class JwtConfig:
         self.SYSTEM_AUTH_URL_SCHEME: str = env.str(
             "SYSTEM_AUTH_URL_SCHEME", default="http"
         )
+        # Give up on fetching a system JWT after this many seconds
+        self.SYSTEM_AUTH_TIMEOUT: int = env.int("SYSTEM_AUTH_TIMEOUT", default=5)
         self.VALID_JWT_ALGORITHMS: List[str] = [
             "HS256",
             "HS512",
@@ -89,6 +122,35 @@ class JwtConfig:
             "ES384",
             "ES512",
         ]
+        # Verified claims are cached per token until expiry, or for at most this many seconds.
+        self.JWT_CLAIMS_CACHE_SIZE: int = env.int("JWT_CLAIMS_CACHE_SIZE", default=1024)
+        self.JWT_CLAIMS_CACHE_TTL: int = env.int("JWT_CLAIMS_CACHE_TTL", default=300)
+        # Threads used by async protected routes to verify JWTs off the event loop.
+        self.JWT_VERIFICATION_WORKERS: int = env.int(
+            "JWT_VERIFICATION_WORKERS", default=4
+        )
+        # Bulk token verification spreads batches of at least this many tokens across a
+        # process pool (0 processes means one per CPU).
+        self.JWT_BULK_VERIFICATION_THRESHOLD: int = env.int(
+            "JWT_BULK_VERIFICATION_THRESHOLD", default=256
+        )
+        self.JWT_BULK_VERIFICATION_PROCESSES: int = env.int(
+            "JWT_BULK_VERIFICATION_PROCESSES", default=0
+        )
+        # Only the first JWT_FAILURE_LOG_SAMPLES failures per issuer and reason are logged in
+        # full in each JWT_FAILURE_LOG_WINDOW seconds; the rest are summarised once per window.
+        self.JWT_FAILURE_LOG_WINDOW: int = env.int("JWT_FAILURE_LOG_WINDOW", default=60)
+        self.JWT_FAILURE_LOG_SAMPLES: int = env.int(
+            "JWT_FAILURE_LOG_SAMPLES", default=5
+        )
+        # Bearer tokens longer than this, or with a longer header segment, are rejected before
+        # they are decoded.
+        self.JWT_MAX_TOKEN_LENGTH: int = env.int(
+            "JWT_MAX_TOKEN_LENGTH", default=262_144
+        )
+        self.JWT_MAX_HEADER_LENGTH: int = env.int("JWT_MAX_HEADER_LENGTH", default=4096)
+        # Issuers to trust as well as the built-in ones, as a JSON list (see security.issuers)
+        self.JWT_ISSUERS: List[Dict] = env.json("JWT_ISSUERS", default="[]")
         # Require redis as we'll need it to validate JWTs.
         self.REDIS_INSTALLED = env.bool("REDIS_INSTALLED", True)
         if self.REDIS_INSTALLED:
@@ -129,6 +191,20 @@ class Auth0Config:
         self.AUTH0_METADATA: str = env.str(
             "AUTH0_METADATA", default=self._DEFAULT_AUTH0_METADATA
         )
+        # How long each worker trusts its in-process copy of the JWKS before reloading it
+        self.AUTH0_JWKS_CACHE_TTL: int = env.int("AUTH0_JWKS_CACHE_TTL", default=600)
+        # Reload the JWKS for unknown kids at most this often, and remember kids that are
+        # still unknown afterwards for a while, so forged kids can't cause a fetch per request
+        self.AUTH0_JWKS_MIN_REFETCH_INTERVAL: int = env.int(
+            "AUTH0_JWKS_MIN_REFETCH_INTERVAL", default=10
+        )
+        self.AUTH0_JWKS_NEGATIVE_CACHE_TTL: int = env.int(
+            "AUTH0_JWKS_NEGATIVE_CACHE_TTL", default=60
+        )
+        # Give up on a JWKS fetch after this many seconds
+        self.AUTH0_JWKS_FETCH_TIMEOUT: int = env.int(
+            "AUTH0_JWKS_FETCH_TIMEOUT", default=5
+        )
         # Support our old way of doing things where we infer the scope key from the metadata key.
         auth0_scope_key: Optional[str] = env.str("AUTH0_SCOPE_KEY", None)
         if auth0_scope_key is None:
@@ -0,0 +1,28 @@
+"""
+Per-app objects kept in app.extensions.
+
+Caches, pools and settings derived from app config are built by the first caller that needs
+them rather than in augment_app, so config applied after augment_app is still picked up.
+"""
+import threading
+from typing import Callable, TypeVar
+
+from flask import current_app
+
+T = TypeVar("T")
+
+_lock = threading.RLock()
+
+
+def app_singleton(key: str, factory: Callable[[], T]) -> T:
+    """
+    Returns current_app.extensions[key], calling factory to create it if it isn't there yet.
+    factory is called at most once per app, even if several threads ask at the same time.
+    """
+    value = current_app.extensions.get(key)
+    if value is None:
+        with _lock:
+            value = current_app.extensions.get(key)
+            if value is None:
+                value = current_app.extensions[key] = factory()
+    return value
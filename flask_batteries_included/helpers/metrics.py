@@ -1,18 +1,48 @@
+import glob
+import logging
+import os
+import random
 import time
-from typing import Dict
+from typing import Any, Dict, FrozenSet, Iterable, Mapping, Optional, Sequence, Tuple
 
 from flask import Flask
 from flask import Response as FlaskResponse
-from flask import request
-from prometheus_client import Counter, Histogram, Summary, generate_latest
+from flask import current_app, request
+from prometheus_client import (
+    REGISTRY,
+    CollectorRegistry,
+    Counter,
+    Histogram,
+    Summary,
+    generate_latest,
+    multiprocess,
+    values,
+)
 from she_logging import logger
 from werkzeug import Response as WerkzeugResponse
 
+from flask_batteries_included.helpers.app_singleton import app_singleton
+
 NO_METRICS_HEADER_NAME = "X-No-Metrics"
 NO_METRICS_HEADER = {NO_METRICS_HEADER_NAME: "X"}
 
 CONTENT_TYPE_LATEST = str("text/plain; version=0.0.4; charset=utf-8")
 
+_SAMPLER_EXTENSION_KEY = "fbi_access_log_sampler"
+_PROFILE_EXTENSION_KEY = "fbi_request_metrics_profile"
+
+DEFAULT_ACCESS_LOG_SLOW_THRESHOLD = 1.0
+
+# The per-request metrics: FLASK_REQUEST_COUNT, FLASK_REQUEST_LATENCY and REQUEST_TIME
+REQUEST_METRIC_COUNT = "count"
+REQUEST_METRIC_HISTOGRAM = "histogram"
+REQUEST_METRIC_SUMMARY = "summary"
+REQUEST_METRICS: Tuple[str, ...] = (
+    REQUEST_METRIC_COUNT,
+    REQUEST_METRIC_HISTOGRAM,
+    REQUEST_METRIC_SUMMARY,
+)
+
 
 FLASK_REQUEST_LATENCY = Histogram(
     "flask_request_latency_seconds", "Flask Request Latency", ["method", "endpoint"]
@@ -28,6 +58,46 @@ REQUEST_TIME = Summary(
     ["method", "endpoint"],
 )
 
+# Auth metrics. Issuer is the JwtParser title, outcome is one of security.outcomes.
+JWT_VALIDATION_LATENCY = Histogram(
+    "jwt_validation_latency_seconds",
+    "Time spent validating JWTs in protected routes",
+    ["issuer", "outcome"],
+    buckets=(
+        0.0001,
+        0.00025,
+        0.0005,
+        0.001,
+        0.0025,
+        0.005,
+        0.01,
+        0.025,
+        0.05,
+        0.1,
+        0.25,
+        0.5,
+        1.0,
+    ),
+)
+
+JWKS_FETCH_COUNT = Counter(
+    "jwks_fetch_count",
+    "JWKS loads by source (redis, auth0 or jwks_url) and result",
+    ["source", "result"],
+)
+
+JWT_CACHE_LOOKUP_COUNT = Counter(
+    "jwt_cache_lookup_count",
+    "Lookups in the JWT claims, JWKS and verification key caches",
+    ["cache", "result"],
+)
+
+JWT_MALFORMED_TOKEN_COUNT = Counter(
+    "jwt_malformed_token_count",
+    "Bearer tokens rejected before decoding, by reason",
+    ["reason"],
+)
+
 
 def set_no_metrics(response: FlaskResponse) -> FlaskResponse:
     response.headers.extend(NO_METRICS_HEADER)
@@ -48,46 +118,158 @@ def add_no_cache_headers(response: WerkzeugResponse) -> WerkzeugResponse:
     return response
 
 
-def before_request() -> None:
-    request.start_time = time.time()  # type: ignore
+class AccessLogSampler:
+    """
+    Decides which requests get an access log record. The sample rate is looked up by endpoint,
+    then by status class (e.g. "2xx"), then falls back to default_rate. Errors (4xx and 5xx, so
+    including auth failures) and requests taking at least slow_threshold seconds are always
+    logged. Each record logged carries a sampled_weight of 1 / rate, so counts from the logs can be
+    scaled back up; the Prometheus metrics count every request regardless.
+    """
 
+    def __init__(
+        self,
+        rates: Optional[Mapping[str, float]] = None,
+        default_rate: float = 1.0,
+        slow_threshold: Optional[float] = DEFAULT_ACCESS_LOG_SLOW_THRESHOLD,
+    ) -> None:
+        self.rates: Dict[str, float] = dict(rates or {})
+        self.default_rate: float = default_rate
+        self.slow_threshold: Optional[float] = slow_threshold
+        for rate in (default_rate, *self.rates.values()):
+            if not 0.0 <= rate <= 1.0:
+                raise ValueError(f"Access log sample rate {rate} must be from 0 to 1")
 
-def after_request(response: WerkzeugResponse) -> WerkzeugResponse:
-    response = add_no_cache_headers(response)
+    def weight(self, endpoint: Optional[str], status: int, latency: float) -> float:
+        """Returns the sampled_weight to log this request with, or 0 if it shouldn't be logged."""
+        if status >= 400 or (
+            self.slow_threshold is not None and latency >= self.slow_threshold
+        ):
+            return 1.0
 
-    # Skip logging and metrics for app monitoring probes
-    if NO_METRICS_HEADER_NAME in response.headers:
-        del response.headers[NO_METRICS_HEADER_NAME]
-        return response
+        rate: float = (
+            self.rates[endpoint]
+            if endpoint in self.rates
+            else self.rates.get(f"{status // 100}xx", self.default_rate)
+        )
+        if rate >= 1.0:
+            return 1.0
+        if rate <= 0.0 or random.random() >= rate:
+            return 0.0
+        return 1.0 / rate
 
-    start_time: float = request.start_time  # type:ignore
-    request_latency: float = time.time() - start_time
-    FLASK_REQUEST_LATENCY.labels(request.method, request.endpoint).observe(
-        request_latency
+
+def _build_access_log_sampler(config: Mapping) -> AccessLogSampler:
+    return AccessLogSampler(
+        rates=config.get("ACCESS_LOG_SAMPLE_RATES"),
+        default_rate=config.get("ACCESS_LOG_SAMPLE_RATE", 1.0),
+        slow_threshold=config.get(
+            "ACCESS_LOG_SLOW_THRESHOLD", DEFAULT_ACCESS_LOG_SLOW_THRESHOLD
+        ),
     )
-    FLASK_REQUEST_COUNT.labels(
-        request.method, request.endpoint, response.status_code
-    ).inc()
-    REQUEST_TIME.labels(request.method, request.endpoint).observe(request_latency)
 
-    content_length = response.headers.get("content-length")
 
-    request_details = {
+def _get_access_log_sampler() -> AccessLogSampler:
+    return app_singleton(
+        _SAMPLER_EXTENSION_KEY, lambda: _build_access_log_sampler(current_app.config)
+    )
+
+
+class RequestMetricsProfile:
+    """
+    Which per-request metrics are recorded, and the latency histogram's buckets. metrics applies
+    to every endpoint not listed in endpoint_metrics. A histogram's buckets are shared by all of
+    its label values, so they are set for the whole service; endpoints that don't fit them can be
+    left out of the histogram instead.
+    """
+
+    def __init__(
+        self,
+        metrics: Iterable[str] = REQUEST_METRICS,
+        endpoint_metrics: Optional[Mapping[str, Iterable[str]]] = None,
+        latency_buckets: Optional[Sequence[float]] = None,
+    ) -> None:
+        self.metrics: FrozenSet[str] = self._validate(metrics)
+        self.endpoint_metrics: Dict[str, FrozenSet[str]] = {
+            endpoint: self._validate(names)
+            for endpoint, names in (endpoint_metrics or {}).items()
+        }
+        self.latency_buckets: Tuple[float, ...] = tuple(
+            latency_buckets or Histogram.DEFAULT_BUCKETS
+        )
+        if list(self.latency_buckets) != sorted(self.latency_buckets):
+            raise ValueError("Request latency buckets must be in increasing order")
+
+    @staticmethod
+    def _validate(names: Iterable[str]) -> FrozenSet[str]:
+        metrics: FrozenSet[str] = frozenset(names)
+        unknown: FrozenSet[str] = metrics - frozenset(REQUEST_METRICS)
+        if unknown:
+            raise ValueError(
+                f"Unknown request metrics {', '.join(sorted(unknown))}, expected some of "
+                f"{', '.join(REQUEST_METRICS)}"
+            )
+        return metrics
+
+    def metrics_for(self, endpoint: Optional[str]) -> FrozenSet[str]:
+        if endpoint is None:
+            return self.metrics
+        return self.endpoint_metrics.get(endpoint, self.metrics)
+
+
+def _build_request_metrics_profile(config: Mapping) -> RequestMetricsProfile:
+    return RequestMetricsProfile(
+        metrics=config.get("REQUEST_METRICS", REQUEST_METRICS),
+        endpoint_metrics=config.get("REQUEST_METRICS_BY_ENDPOINT"),
+        latency_buckets=config.get("REQUEST_LATENCY_BUCKETS"),
+    )
+
+
+def _get_request_metrics_profile() -> RequestMetricsProfile:
+    return app_singleton(
+        _PROFILE_EXTENSION_KEY,
+        lambda: _build_request_metrics_profile(current_app.config),
+    )
+
+
+_latency_buckets: Tuple[float, ...] = tuple(Histogram.DEFAULT_BUCKETS)
+
+
+def _use_latency_buckets(buckets: Tuple[float, ...]) -> None:
+    """
+    Replaces FLASK_REQUEST_LATENCY if it doesn't have these buckets. Metrics are process-wide,
+    so the buckets last set apply to every app in the process.
+    """
+    global FLASK_REQUEST_LATENCY, _latency_buckets
+    if buckets == _latency_buckets:
+        return
+    REGISTRY.unregister(FLASK_REQUEST_LATENCY)
+    FLASK_REQUEST_LATENCY = Histogram(
+        "flask_request_latency_seconds",
+        "Flask Request Latency",
+        ["method", "endpoint"],
+        buckets=buckets,
+    )
+    _latency_buckets = buckets
+
+
+def before_request() -> None:
+    request.start_time = time.time()  # type: ignore
+
+
+def _request_details(
+    response: WerkzeugResponse, request_latency: float
+) -> Dict[str, Any]:
+    request_details: Dict[str, Any] = {
         "status": response.status_code,
         "requestUrl": request.url,
         "requestMethod": request.method,
         "remoteIp": request.remote_addr,
-        "responseSize": content_length,
-        "userAgent": str(request.user_agent),
+        "responseSize": response.headers.get("content-length"),
+        # The raw header, rather than parsing it with request.user_agent
+        "userAgent": request.headers.get("User-Agent", ""),
         "latency": f"{request_latency:.4f}s",
-        "etag": response.get_etag(),
-    }
-    additional_details: Dict[str, Dict] = {
-        "requestXHeaders": {
-            k: v for k, v in request.headers.items() if k.lower().startswith("x-")
-        },
-        "requestQueryParams": dict(request.args or {}),
-        "requestPathParams": dict(request.view_args or {}),
+        "etag": response.get_etag() if "ETag" in response.headers else (None, None),
     }
     if response.status_code not in range(200, 300) and not response.direct_passthrough:
         # HTTP error has happened, so include the request/response body which may describe the error.
@@ -99,28 +281,133 @@ def after_request(response: WerkzeugResponse) -> WerkzeugResponse:
             request_body_text = request_body_text[:5000] + " [clipped]"
         request_details["responseContent"] = response_body_text
         request_details["requestContent"] = request_body_text
+    return request_details
+
+
+def _additional_details() -> Dict[str, Dict]:
+    return {
+        "requestXHeaders": {
+            k: v for k, v in request.headers.items() if k.lower().startswith("x-")
+        },
+        "requestQueryParams": dict(request.args or {}),
+        "requestPathParams": dict(request.view_args or {}),
+    }
+
+
+def after_request(response: WerkzeugResponse) -> WerkzeugResponse:
+    response = add_no_cache_headers(response)
+
+    # Skip logging and metrics for app monitoring probes
+    if NO_METRICS_HEADER_NAME in response.headers:
+        del response.headers[NO_METRICS_HEADER_NAME]
+        return response
+
+    start_time: float = request.start_time  # type:ignore
+    request_latency: float = time.time() - start_time
+    request_metrics: FrozenSet[str] = _get_request_metrics_profile().metrics_for(
+        request.endpoint
+    )
+    if REQUEST_METRIC_HISTOGRAM in request_metrics:
+        FLASK_REQUEST_LATENCY.labels(request.method, request.endpoint).observe(
+            request_latency
+        )
+    if REQUEST_METRIC_COUNT in request_metrics:
+        FLASK_REQUEST_COUNT.labels(
+            request.method, request.endpoint, response.status_code
+        ).inc()
+    if REQUEST_METRIC_SUMMARY in request_metrics:
+        REQUEST_TIME.labels(request.method, request.endpoint).observe(request_latency)
+
+    # The access log records are only built if they will be logged, which in production means
+    # the debug record never is
+    if not logger.isEnabledFor(logging.INFO):
+        return response
+    sampled_weight: float = _get_access_log_sampler().weight(
+        request.endpoint, response.status_code, request_latency
+    )
+    if not sampled_weight:
+        return response
+
     logger.info(
         '%s "%s" %s',
         request.method,
         request.endpoint or request.path,
         response.status_code,
-        extra={"httpRequest": request_details},
-    )
-    logger.debug(
-        "Request has additional details",
-        extra={"httpRequest": additional_details},
+        extra={
+            "httpRequest": _request_details(response, request_latency),
+            "sampled_weight": sampled_weight,
+        },
     )
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug(
+            "Request has additional details",
+            extra={"httpRequest": _additional_details()},
+        )
     return response
 
 
+def multiprocess_dir() -> Optional[str]:
+    """
+    The directory for per-process metric files, if the app is served by several worker
+    processes. It must be set in the environment before prometheus_client is first imported.
+    """
+    return os.environ.get("PROMETHEUS_MULTIPROC_DIR") or os.environ.get(
+        "prometheus_multiproc_dir"
+    )
+
+
+def clear_multiprocess_dir() -> None:
+    """
+    Removes metric files left by a previous run of the server. Call from the server's master
+    process before any workers start, e.g. from gunicorn's on_starting hook.
+    """
+    directory: Optional[str] = multiprocess_dir()
+    if directory is None:
+        return
+    for path in glob.glob(os.path.join(directory, "*.db")):
+        os.remove(path)
+
+
+def mark_worker_dead(pid: int) -> None:
+    """
+    Cleans up after a worker process that has exited, e.g. from gunicorn's child_exit hook.
+    Its counters and histograms are kept so that totals don't go backwards.
+    """
+    if multiprocess_dir() is not None:
+        multiprocess.mark_process_dead(pid)
+
+
+def _metrics_registry() -> CollectorRegistry:
+    directory: Optional[str] = multiprocess_dir()
+    if directory is None:
+        return REGISTRY
+
+    if values.ValueClass is values.MutexValue:
+        logger.warning(
+            "Prometheus multiprocess directory was set after metrics were created, so this "
+            "worker's metrics will be missing from /metrics",
+            extra={"multiprocess_dir": directory},
+        )
+    # Aggregate the metric files written by every worker process
+    registry = CollectorRegistry()
+    multiprocess.MultiProcessCollector(registry, path=directory)
+    return registry
+
+
 def init_metrics(app: Flask) -> None:
+    profile: RequestMetricsProfile = _build_request_metrics_profile(app.config)
+    _use_latency_buckets(profile.latency_buckets)
+    app.extensions[_PROFILE_EXTENSION_KEY] = profile
+    app.extensions[_SAMPLER_EXTENSION_KEY] = _build_access_log_sampler(app.config)
     app.before_request(before_request)
     app.after_request(after_request)
 
+    registry: CollectorRegistry = _metrics_registry()
+
     @app.route("/metrics")
     def get_metrics() -> FlaskResponse:
         return set_no_metrics(
-            FlaskResponse(generate_latest(), mimetype=CONTENT_TYPE_LATEST)
+            FlaskResponse(generate_latest(registry), mimetype=CONTENT_TYPE_LATEST)
         )
 
     logger.info("Registered metrics route on /metrics")
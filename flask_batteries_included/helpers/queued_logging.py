@@ -0,0 +1,155 @@
+"""
+Non-blocking log shipping.
+
+she_logging formats every record as JSON and writes it to stdout on the thread that logged it,
+so a slow stdout or log collector stalls requests. init_queued_logging moves the root logger's
+handlers behind a QueuedLogHandler, which only puts records on a bounded queue; a background
+thread formats and writes them. When the queue is full, records are either dropped (and counted,
+with a warning once there is room again) or the logging thread blocks until there is room.
+Queued records are flushed when logging shuts down at exit.
+"""
+import logging
+import os
+import queue
+import threading
+from typing import Iterable, List, Optional
+
+from flask import Flask, has_request_context, request
+from she_logging import logger
+
+OVERFLOW_DROP = "drop"
+OVERFLOW_BLOCK = "block"
+
+DEFAULT_LOG_QUEUE_SIZE = 10_000
+
+# How long to wait for queued records to be written at shutdown
+_FLUSH_TIMEOUT = 5.0
+
+# she_logging's JSON formatter adds these from the request, which has gone by the time a queued
+# record is formatted, so they are copied onto the record when it is queued
+_REQUEST_HEADERS = ("X-Client", "X-Version")
+
+
+class QueuedLogHandler(logging.Handler):
+    def __init__(
+        self,
+        handlers: Iterable[logging.Handler],
+        queue_size: int = DEFAULT_LOG_QUEUE_SIZE,
+        overflow: str = OVERFLOW_DROP,
+    ) -> None:
+        if overflow not in (OVERFLOW_DROP, OVERFLOW_BLOCK):
+            raise ValueError(
+                f"Log queue overflow must be {OVERFLOW_DROP} or {OVERFLOW_BLOCK}"
+            )
+        super().__init__()
+        self.handlers: List[logging.Handler] = list(handlers)
+        self.overflow: str = overflow
+        self.dropped: int = 0
+        self._queue: "queue.Queue[Optional[logging.LogRecord]]" = queue.Queue(
+            maxsize=queue_size
+        )
+        self._lock = threading.Lock()
+        self._thread: Optional[threading.Thread] = None
+        self._pid: Optional[int] = None
+
+    def emit(self, record: logging.LogRecord) -> None:
+        try:
+            self._ensure_started()
+            self._queue.put(
+                self._prepare(record), block=self.overflow == OVERFLOW_BLOCK
+            )
+        except queue.Full:
+            with self._lock:
+                self.dropped += 1
+        except Exception:
+            self.handleError(record)
+
+    def _prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # Merge the args now, in case they are changed before the record is formatted
+        record.msg = record.getMessage()
+        record.args = None
+        if has_request_context():
+            for header in _REQUEST_HEADERS:
+                value: Optional[str] = request.headers.get(header)
+                if value is not None:
+                    setattr(record, header, value)
+        return record
+
+    def _ensure_started(self) -> None:
+        # Threads don't survive a fork, so pre-forked workers each start their own
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid != os.getpid():
+                self._thread = threading.Thread(
+                    target=self._run, name="queued-logging", daemon=True
+                )
+                self._thread.start()
+                self._pid = os.getpid()
+
+    def _run(self) -> None:
+        while True:
+            record: Optional[logging.LogRecord] = self._queue.get()
+            if record is None:
+                return
+            self._handle(record)
+            self._report_dropped()
+
+    def _handle(self, record: logging.LogRecord) -> None:
+        for handler in self.handlers:
+            if record.levelno >= handler.level:
+                handler.handle(record)
+
+    def _report_dropped(self) -> None:
+        if not self.dropped:
+            return
+        with self._lock:
+            dropped, self.dropped = self.dropped, 0
+        self._handle(
+            logging.makeLogRecord(
+                {
+                    "name": __name__,
+                    "levelno": logging.WARNING,
+                    "levelname": "WARNING",
+                    "msg": f"Dropped {dropped} log records because the log queue was full",
+                }
+            )
+        )
+
+    def close(self) -> None:
+        """Writes any queued records, then stops the background thread."""
+        thread: Optional[threading.Thread] = self._thread
+        if thread is not None and thread.is_alive() and self._pid == os.getpid():
+            try:
+                self._queue.put(None, timeout=_FLUSH_TIMEOUT)
+                thread.join(_FLUSH_TIMEOUT)
+            except queue.Full:
+                pass
+            self._report_dropped()
+        self._pid = None
+        super().close()
+
+
+def init_queued_logging(app: Flask) -> QueuedLogHandler:
+    """
+    Moves the root logger's handlers to a background thread, behind a queue of LOG_QUEUE_SIZE
+    records with LOG_QUEUE_OVERFLOW ("drop" or "block") as the overflow policy. Logging is
+    process-wide, so this only happens once per process.
+    """
+    # Make sure she_logging has set up the root logger's handlers
+    logger.isEnabledFor(logging.INFO)
+    root_logger: logging.Logger = logging.getLogger()
+    for handler in root_logger.handlers:
+        if isinstance(handler, QueuedLogHandler):
+            return handler
+
+    queued_handler = QueuedLogHandler(
+        root_logger.handlers,
+        queue_size=app.config.get("LOG_QUEUE_SIZE", DEFAULT_LOG_QUEUE_SIZE),
+        overflow=app.config.get("LOG_QUEUE_OVERFLOW", OVERFLOW_DROP),
+    )
+    root_logger.handlers = [queued_handler]
+    logger.info(
+        "Logging via a background queue", extra={"overflow": queued_handler.overflow}
+    )
+    return queued_handler
@@ -1,16 +1,59 @@
+import inspect
+import logging
 import os
+import time
 from functools import wraps
-from typing import Any, Callable, Dict, List, Optional, Tuple, Union
+from typing import (
+    Any,
+    Callable,
+    Dict,
+    List,
+    Mapping,
+    NamedTuple,
+    Optional,
+    Tuple,
+    Union,
+)
 
-from flask import current_app, g, request
+from flask import Flask, current_app, g, request
 from jose import jwt as jose_jwt
 from she_logging import logger
 
 from flask_batteries_included.config import is_production_environment
-from flask_batteries_included.helpers.security.endpoint_security import compare_keys
+from flask_batteries_included.helpers.app_singleton import app_singleton
+from flask_batteries_included.helpers.metrics import JWT_VALIDATION_LATENCY
+from flask_batteries_included.helpers.security.claims_cache import get_claims_cache
+from flask_batteries_included.helpers.security.endpoint_security import (
+    Policy,
+    compile_policy,
+)
+from flask_batteries_included.helpers.security.issuers import get_issuer_registry
 from flask_batteries_included.helpers.security.jwt_parsers import JwtParser
+from flask_batteries_included.helpers.security.outcomes import (
+    OUTCOME_DENIED_BY_POLICY,
+    OUTCOME_ERROR,
+    OUTCOME_INVALID_TOKEN,
+    OUTCOME_ISSUER_NOT_ALLOWED,
+    OUTCOME_MALFORMED_TOKEN,
+    OUTCOME_NO_ISSUER,
+    OUTCOME_NO_TOKEN,
+    OUTCOME_OK,
+    OUTCOME_UNKNOWN_ISSUER,
+    classify_jwt_error,
+)
+from flask_batteries_included.helpers.security.parsed_jwt import (
+    MalformedTokenError,
+    ParsedJwt,
+    check_token_size,
+    get_token_limits,
+    parse_request_jwt,
+)
+from flask_batteries_included.helpers.security.security_log import get_security_log
+from flask_batteries_included.helpers.security.verification_executor import (
+    run_in_verification_executor,
+)
 
-from . import connexion_bearerinfo, jwt_parsers
+from . import connexion_bearerinfo
 
 # TODO: this should be removed with our refactoring of the identifiers module.
 SYSTEM_UUIDS: List[str] = [
@@ -33,6 +76,57 @@ SYSTEM_UUIDS: List[str] = [
 ]
 
 
+_VALIDATION_PLAN_EXTENSION_KEY = "fbi_jwt_validation_plan"
+
+
+class _ValidationPlan(NamedTuple):
+    ignore_jwt_validation: bool
+
+
+def _build_validation_plan(config: Mapping) -> _ValidationPlan:
+    return _ValidationPlan(
+        ignore_jwt_validation=bool(config.get("IGNORE_JWT_VALIDATION", False))
+        and not is_production_environment(config.get("ENVIRONMENT"))
+    )
+
+
+def init_jwt_validation(app: Flask) -> None:
+    """
+    Resolves the app's JWT validation settings now. They are otherwise resolved by the first
+    protected request and kept, so that protected routes don't read config on every request.
+    Call again after changing IGNORE_JWT_VALIDATION once the app has served a protected request.
+    """
+    app.extensions[_VALIDATION_PLAN_EXTENSION_KEY] = _build_validation_plan(app.config)
+
+
+def _get_validation_plan() -> _ValidationPlan:
+    return app_singleton(
+        _VALIDATION_PLAN_EXTENSION_KEY,
+        lambda: _build_validation_plan(current_app.config),
+    )
+
+
+class _ValidationRecord:
+    """Collects the issuer and outcome of validating one request's JWT, for the auth metrics."""
+
+    __slots__ = ("issuer", "outcome", "started_at")
+
+    def __init__(self) -> None:
+        self.issuer: str = "none"
+        self.outcome: Optional[str] = None
+        self.started_at: float = time.perf_counter()
+
+    def observe(self) -> None:
+        JWT_VALIDATION_LATENCY.labels(
+            self.issuer, self.outcome or OUTCOME_ERROR
+        ).observe(time.perf_counter() - self.started_at)
+
+
+class _PendingDecode(NamedTuple):
+    parsed_jwt: ParsedJwt
+    jwt_parser: JwtParser
+
+
 class _ProtectedRoute:
     def __init__(
         self,
@@ -50,19 +144,31 @@ class _ProtectedRoute:
             allowed_issuers = [allowed_issuers]
         self.allowed_issuers: Optional[List[Optional[str]]] = allowed_issuers
 
-        self.validation_function: Callable = validation_function or compare_keys
-        self.ignore_jwt_validation: Optional[bool] = None
+        self.validation_function: Policy = compile_policy(validation_function)
 
     def __call__(self, f: Callable) -> Callable:
-        if is_production_environment():
-            validator = self._call_validation
+        # Routes decorated in production always validate, whatever the app's config says
+        production: bool = is_production_environment()
+
+        def should_verify() -> bool:
+            return self.verify and (
+                production or not _get_validation_plan().ignore_jwt_validation
+            )
+
+        decorated: Callable
+        if inspect.iscoroutinefunction(f):
+            # Async views decode and verify the JWT off the event loop
+            @wraps(f)
+            async def decorated(*args: List[Any], **kwargs: Dict[str, Any]) -> Any:
+                await self._call_validation_async(should_verify(), **kwargs)
+                return await f(*args, **kwargs)
+
         else:
-            validator = self._call_validation_development
 
-        @wraps(f)
-        def decorated(*args: List[Any], **kwargs: Dict[str, Any]) -> Callable:
-            validator(self.verify, **kwargs)
-            return f(*args, **kwargs)
+            @wraps(f)
+            def decorated(*args: List[Any], **kwargs: Dict[str, Any]) -> Callable:
+                self._call_validation(should_verify(), **kwargs)
+                return f(*args, **kwargs)
 
         def _fbi_apispec(operation: Dict) -> None:
             if hasattr(f, "_fbi_apispec"):
@@ -72,26 +178,54 @@ class _ProtectedRoute:
         setattr(decorated, "_fbi_apispec", _fbi_apispec)
         return decorated
 
-    def _call_validation_development(
+    def _call_validation(self, verify: bool, /, **kwargs: Dict[str, Any]) -> Any:
+        record = _ValidationRecord()
+        try:
+            jwt_claims, jwt_scopes = self._retrieve_jwt_claims(verify, record)
+            self._apply_validation(verify, jwt_claims, jwt_scopes, record, **kwargs)
+        finally:
+            record.observe()
+            get_security_log().flush_if_due()
+
+    async def _call_validation_async(
         self, verify: bool, /, **kwargs: Dict[str, Any]
     ) -> Any:
-        with current_app.app_context():
-            ignore_jwt_validation = current_app.config.get(
-                "IGNORE_JWT_VALIDATION", False
+        record = _ValidationRecord()
+        try:
+            jwt_claims, jwt_scopes = await self._retrieve_jwt_claims_async(
+                verify, record
             )
+            self._apply_validation(verify, jwt_claims, jwt_scopes, record, **kwargs)
+        finally:
+            record.observe()
+            get_security_log().flush_if_due()
 
-        self._call_validation((verify and not ignore_jwt_validation), **kwargs)
-
-    def _call_validation(self, verify: bool, /, **kwargs: Dict[str, Any]) -> Any:
-        jwt_claims, jwt_scopes = self._retrieve_jwt_claims(verify)
-
+    def _apply_validation(
+        self,
+        verify: bool,
+        jwt_claims: Dict[str, str],
+        jwt_scopes: List[str],
+        record: _ValidationRecord,
+        /,
+        **kwargs: Dict[str, Any],
+    ) -> None:
         valid = jwt_claims and self.validation_function(
             jwt_claims, self.claims_map, jwt_scopes=jwt_scopes, **kwargs
         )
 
         if verify and not valid:
+            if jwt_claims:
+                record.outcome = OUTCOME_DENIED_BY_POLICY
+            if jwt_claims and logger.isEnabledFor(logging.DEBUG):
+                logger.debug(
+                    "JWT denied by endpoint policy: %s",
+                    self.validation_function.explain(
+                        jwt_claims, self.claims_map, jwt_scopes=jwt_scopes, **kwargs
+                    ),
+                )
+            # The message is logged on every denied request, so keep it small for large claim sets
             raise PermissionError(
-                f"Claims {str(jwt_claims)} not valid for call to {request.url}"
+                f"Claims ({', '.join(jwt_claims or {})}) not valid for call to {request.url}"
             )
 
         g.jwt_claims = jwt_claims
@@ -100,125 +234,141 @@ class _ProtectedRoute:
     def _log_token(self, jwt_token: str) -> None:
         logger.debug("JWT value: %s", jwt_token)
 
+    def _issuer_allowed(self, issuer: Optional[str], jwt_token: str) -> bool:
+        if self.allowed_issuers is None or issuer in self.allowed_issuers:
+            return True
+        if get_security_log().should_log(issuer, OUTCOME_ISSUER_NOT_ALLOWED):
+            self._log_token(jwt_token)
+            logger.info(
+                "JWT issuer is not allowed for this endpoint",
+                extra={"issuer": issuer, "allowed_issuers": self.allowed_issuers},
+            )
+        return False
+
+    def _reject_malformed(
+        self, error: MalformedTokenError, jwt_token: str, record: _ValidationRecord
+    ) -> Tuple[Dict, List]:
+        # Don't log the token itself, it may be megabytes of junk
+        if get_security_log().should_log(None, OUTCOME_MALFORMED_TOKEN):
+            logger.info(
+                "Rejected malformed JWT",
+                extra={"reason": error.reason, "token_length": len(jwt_token)},
+            )
+        record.outcome = OUTCOME_MALFORMED_TOKEN
+        return {}, []
+
     def _retrieve_jwt_claims(
-        self, verify: bool = True
+        self, verify: bool = True, record: Optional[_ValidationRecord] = None
+    ) -> Tuple[Dict[str, str], List[str]]:
+        record = record or _ValidationRecord()
+        pending = self._prepare_decode(verify, record)
+        if not isinstance(pending, _PendingDecode):
+            return pending
+        return self._decode(pending, verify, record)
+
+    async def _retrieve_jwt_claims_async(
+        self, verify: bool = True, record: Optional[_ValidationRecord] = None
     ) -> Tuple[Dict[str, str], List[str]]:
+        record = record or _ValidationRecord()
+        pending = self._prepare_decode(verify, record)
+        if not isinstance(pending, _PendingDecode):
+            return pending
+        # Verification is CPU-bound and a JWKS miss blocks on I/O, so keep it off the loop
+        return await run_in_verification_executor(self._decode, pending, verify, record)
+
+    def _prepare_decode(
+        self, verify: bool, record: _ValidationRecord
+    ) -> Union[_PendingDecode, Tuple[Dict, List]]:
+        """
+        Does the cheap work of finding a token's claims: returns the claims and scopes if they
+        are already known (or the token is rejected), otherwise the token still to be decoded.
+        """
         auth_header: Optional[str] = request.headers.get("Authorization", None)
         if auth_header is None or not auth_header.startswith("Bearer "):
+            record.outcome = OUTCOME_NO_TOKEN
             return {}, []
         jwt_token: str = auth_header[7:]
 
-        full_internal_domain: str = current_app.config["HS_ISSUER"]
-        full_auth0_domain: Optional[str] = current_app.config.get("AUTH0_DOMAIN", None)
-        full_customdb_auth0_domain: Optional[str] = current_app.config.get(
-            "AUTH0_CUSTOM_DOMAIN", None
-        )
-        full_epr_service_adapter_domain: Optional[str] = current_app.config.get(
-            "EPR_SERVICE_ADAPTER_ISSUER", None
-        )
-        algorithms: List[str] = current_app.config["VALID_JWT_ALGORITHMS"]
-        internal_audience: str = current_app.config["HS_ISSUER"]
+        # Reject oversized tokens before hashing them for the cache or decoding them
+        try:
+            check_token_size(jwt_token, get_token_limits())
+        except MalformedTokenError as e:
+            return self._reject_malformed(e, jwt_token, record)
 
-        # Now decode it either as Auth0 or an internal JWT
+        # Tokens are reused across many requests, so skip decoding if we've seen this one before
+        cached = get_claims_cache().get(jwt_token, verify)
+        if cached is not None:
+            cached_parser: Optional[JwtParser] = get_issuer_registry().get(
+                cached.issuer, verify
+            )
+            record.issuer = cached_parser.title if cached_parser else "unknown"
+            if not self._issuer_allowed(cached.issuer, jwt_token) and verify:
+                record.outcome = OUTCOME_ISSUER_NOT_ALLOWED
+                return {}, []
+            record.outcome = OUTCOME_OK
+            return cached.claims, cached.scopes
+
+        # Split and decode the token once; connexion's bearerinfo function, routing, key lookup
+        # and verification all share it
         try:
-            unverified_claims: dict = jose_jwt.get_unverified_claims(jwt_token)
+            parsed_jwt: ParsedJwt = parse_request_jwt(jwt_token)
+        except MalformedTokenError as e:
+            return self._reject_malformed(e, jwt_token, record)
         except jose_jwt.JWTError:
-            self._log_token(jwt_token)
-            logger.exception("Failed to decode JWT claim")
+            if get_security_log().should_log(None, OUTCOME_INVALID_TOKEN):
+                self._log_token(jwt_token)
+                logger.exception("Failed to decode JWT claim")
+            record.outcome = OUTCOME_INVALID_TOKEN
             return {}, []
+        unverified_claims: dict = parsed_jwt.claims
 
         # Throw out JWT if it has no issuer
         if "iss" not in unverified_claims or unverified_claims["iss"] is None:
-            self._log_token(jwt_token)
-            logger.info("JWT claim has no issuer")
+            if get_security_log().should_log(None, OUTCOME_NO_ISSUER):
+                self._log_token(jwt_token)
+                logger.info("JWT claim has no issuer")
             if verify:
+                record.outcome = OUTCOME_NO_ISSUER
                 return {}, []
 
         # Throw out JWT if this route is locked down to certain issuer(s) and the JWT's issuer doesn't match
-        if (
-            self.allowed_issuers is not None
-            and unverified_claims["iss"] not in self.allowed_issuers
-        ):
-            self._log_token(jwt_token)
-            logger.info(
-                "JWT issuer is not allowed for this endpoint",
-                extra={
-                    "issuer": unverified_claims["iss"],
-                    "allowed_issuers": self.allowed_issuers,
-                },
-            )
-            if verify:
-                return {}, []
+        if not self._issuer_allowed(unverified_claims.get("iss"), jwt_token) and verify:
+            record.outcome = OUTCOME_ISSUER_NOT_ALLOWED
+            return {}, []
 
-        # Generate the correct parser object
-
-        # Find the appropriate issuer domain or error
-        if (
-            full_auth0_domain is not None
-            and unverified_claims["iss"] == full_auth0_domain
-        ):
-            issuer_to_verify: str = full_auth0_domain
-            audience: str = current_app.config["AUTH0_AUDIENCE"]
-            metadata_key: str = current_app.config["AUTH0_METADATA"]
-            scope_key: str = current_app.config["AUTH0_SCOPE_KEY"]
-            jwt_parser: JwtParser = jwt_parsers.Auth0JwtParser(
-                required_audience=audience,
-                required_issuer=issuer_to_verify,
-                allowed_algorithms=algorithms,
-                metadata_key=metadata_key,
-                scope_key=scope_key,
-                verify=verify,
-            )
-        elif unverified_claims["iss"] == full_internal_domain:
-            jwt_parser = jwt_parsers.InternalJwtParser(
-                required_audience=internal_audience,
-                required_issuer=full_internal_domain,
-                allowed_algorithms=algorithms,
-                metadata_key="metadata",
-                scope_key="scope",
-                verify=verify,
-                hs_key=current_app.config["HS_KEY"],
-            )
-        elif (
-            full_customdb_auth0_domain is not None
-            and unverified_claims["iss"] == full_customdb_auth0_domain
-        ):
-            jwt_parser = jwt_parsers.Auth0LoginJwtParser(
-                required_audience=internal_audience,
-                required_issuer=full_customdb_auth0_domain,
-                allowed_algorithms=algorithms,
-                metadata_key="metadata",
-                scope_key="scope",
-                verify=verify,
-                hs_key=current_app.config["AUTH0_HS_KEY"],
-            )
-        elif (
-            full_epr_service_adapter_domain is not None
-            and unverified_claims["iss"] == full_epr_service_adapter_domain
-        ):
-            jwt_parser = jwt_parsers.InternalJwtParser(
-                required_audience=internal_audience,
-                required_issuer=full_epr_service_adapter_domain,
-                allowed_algorithms=algorithms,
-                metadata_key="metadata",
-                scope_key="scope",
-                verify=verify,
-                hs_key=current_app.config["EPR_SERVICE_ADAPTER_HS_KEY"],
-                title="EPR Service Adapter",
-            )
-        else:
-            logger.error(
-                "Detected JWT with unknown issuer",
-                extra={"issuer": unverified_claims["iss"]},
-            )
+        # Find the parser for this issuer or error
+        jwt_parser: Optional[JwtParser] = get_issuer_registry().get(
+            unverified_claims.get("iss"), verify
+        )
+        if jwt_parser is None:
+            if get_security_log().should_log(
+                unverified_claims.get("iss"), OUTCOME_UNKNOWN_ISSUER
+            ):
+                logger.error(
+                    "Detected JWT with unknown issuer",
+                    extra={"issuer": unverified_claims.get("iss")},
+                )
+            record.issuer = "unknown"
+            record.outcome = OUTCOME_UNKNOWN_ISSUER
             return {}, []
 
+        record.issuer = jwt_parser.title
+        return _PendingDecode(parsed_jwt=parsed_jwt, jwt_parser=jwt_parser)
+
+    def _decode(
+        self, pending: _PendingDecode, verify: bool, record: _ValidationRecord
+    ) -> Tuple[Dict[str, str], List[str]]:
+        parsed_jwt: ParsedJwt = pending.parsed_jwt
+        jwt_parser: JwtParser = pending.jwt_parser
+        jwt_token: str = parsed_jwt.token
+        unverified_claims: dict = parsed_jwt.claims
+
         # Verify jwt or error
-        unverified_header: Any = None
+        unverified_header: Dict[str, Any] = parsed_jwt.header
         try:
-            # Auth0 token
-            unverified_header = jose_jwt.get_unverified_header(jwt_token)
-            return jwt_parser.decode_jwt(jwt_token, unverified_header)
+            jwt_claims, jwt_scopes = jwt_parser.decode_jwt(
+                parsed_jwt, unverified_header
+            )
         except (
             ValueError,
             jose_jwt.ExpiredSignatureError,
@@ -226,17 +376,30 @@ class _ProtectedRoute:
             jose_jwt.JWSError,
             jose_jwt.JWTError,
         ) as e:
-            self._log_token(jwt_token)
-            logger.info(
-                "Access attempted with invalid JWT",
-                extra={"error_message": e},
-            )
-            logger.debug("Detected %s", jwt_parser)
-            logger.debug("Unverified token header: %s", unverified_header)
-            logger.debug("Unverified token claims: %s", unverified_claims)
+            record.outcome = classify_jwt_error(e)
+            if get_security_log().should_log(jwt_parser.title, record.outcome):
+                self._log_token(jwt_token)
+                logger.info(
+                    "Access attempted with invalid JWT",
+                    extra={"error_message": e},
+                )
+                logger.debug("Detected %s", jwt_parser)
+                logger.debug("Unverified token header: %s", unverified_header)
+                logger.debug("Unverified token claims: %s", unverified_claims)
             # Deliberately mask the error so the caller has no clues about security internals
             return {}, []
 
+        jwt_claims, jwt_scopes = get_claims_cache().put(
+            jwt_token,
+            verify,
+            issuer=unverified_claims["iss"],
+            claims=jwt_claims,
+            scopes=jwt_scopes,
+            exp=unverified_claims.get("exp"),
+        )
+        record.outcome = OUTCOME_OK
+        return jwt_claims, jwt_scopes
+
 
 protected_route = _ProtectedRoute
 
@@ -0,0 +1,261 @@
+"""
+Bulk JWT verification for message-consuming workers.
+
+verify_tokens takes a batch of bearer tokens (e.g. from queued messages) and returns claims or
+an error outcome for each, in the order given. Identical tokens are verified once, and tokens are
+grouped by issuer and signing key so that key material is looked up once per group. Batches of
+at least JWT_BULK_VERIFICATION_THRESHOLD tokens are spread across a process pool, which is shut
+down at exit. Must be called within an app context.
+"""
+import atexit
+import math
+import multiprocessing
+import os
+import weakref
+from concurrent.futures import Future, ProcessPoolExecutor
+from typing import Any, Dict, List, NamedTuple, Optional, Sequence, Tuple, Type
+
+from flask import current_app
+from jose import jwt as jose_jwt
+from she_logging import logger
+
+from flask_batteries_included.helpers.app_singleton import app_singleton
+from flask_batteries_included.helpers.security.claims_cache import get_claims_cache
+from flask_batteries_included.helpers.security.issuers import get_issuer_registry
+from flask_batteries_included.helpers.security.jwt_parsers import JwtParser
+from flask_batteries_included.helpers.security.outcomes import (
+    OUTCOME_INVALID_TOKEN,
+    OUTCOME_KEY_NOT_FOUND,
+    OUTCOME_KEY_UNAVAILABLE,
+    OUTCOME_MALFORMED_TOKEN,
+    OUTCOME_UNKNOWN_ISSUER,
+    classify_jwt_error,
+)
+from flask_batteries_included.helpers.security.parsed_jwt import (
+    MalformedTokenError,
+    ParsedJwt,
+    TokenLimits,
+    check_token_size,
+    check_token_structure,
+    get_token_limits,
+)
+from flask_batteries_included.helpers.security.security_log import get_security_log
+
+_POOL_EXTENSION_KEY = "fbi_jwt_bulk_verification_pool"
+
+DEFAULT_BULK_VERIFICATION_THRESHOLD = 256
+
+_pools: "weakref.WeakSet[ProcessPoolExecutor]" = weakref.WeakSet()
+
+
+class TokenVerificationResult(NamedTuple):
+    claims: Optional[Dict[str, Any]] = None
+    scopes: Optional[List[str]] = None
+    error: Optional[str] = None
+
+    @property
+    def ok(self) -> bool:
+        return self.error is None
+
+
+class _TokenGroup(NamedTuple):
+    jwt_parser: JwtParser
+    header: Dict[str, Any]
+    parsed_jwts: List[ParsedJwt]
+
+
+def _verify_chunk(
+    jwt_parser: JwtParser, key: Any, jwt_tokens: List[str]
+) -> List[TokenVerificationResult]:
+    # Runs in pool workers, so must not depend on the app context
+    results: List[TokenVerificationResult] = []
+    for jwt_token in jwt_tokens:
+        try:
+            parsed_jwt = ParsedJwt(jwt_token)
+            access_token = jwt_parser._verify_token(parsed_jwt, key, parsed_jwt.header)
+            claims, scopes = jwt_parser.parse_access_token(access_token)
+        except (
+            ValueError,
+            PermissionError,
+            jose_jwt.ExpiredSignatureError,
+            jose_jwt.JWTClaimsError,
+            jose_jwt.JWSError,
+            jose_jwt.JWTError,
+        ) as e:
+            results.append(TokenVerificationResult(error=classify_jwt_error(e)))
+        else:
+            results.append(TokenVerificationResult(claims=claims, scopes=scopes))
+    return results
+
+
+def _pool_processes() -> int:
+    processes: int = current_app.config.get("JWT_BULK_VERIFICATION_PROCESSES", 0)
+    return processes if processes > 0 else (os.cpu_count() or 1)
+
+
+def _build_bulk_verification_pool() -> ProcessPoolExecutor:
+    # Forked workers would inherit any lock another thread of the server (e.g. the queued
+    # logging thread, or prometheus_client) held at the time, and could deadlock on it, so
+    # workers are started from a clean forkserver process instead
+    start_method: str = (
+        "forkserver"
+        if "forkserver" in multiprocessing.get_all_start_methods()
+        else "spawn"
+    )
+    pool = ProcessPoolExecutor(
+        max_workers=_pool_processes(),
+        mp_context=multiprocessing.get_context(start_method),
+    )
+    _pools.add(pool)
+    return pool
+
+
+@atexit.register
+def _shutdown_pools() -> None:
+    # Don't leave worker processes running after the app has gone
+    for pool in list(_pools):
+        pool.shutdown()
+
+
+def get_bulk_verification_pool() -> ProcessPoolExecutor:
+    """Returns the bulk verification process pool for the current app."""
+    return app_singleton(_POOL_EXTENSION_KEY, _build_bulk_verification_pool)
+
+
+def _key_lookup_errors() -> Tuple[Type[Exception], ...]:
+    # Only imported when keys are looked up, as for dhosredis in jwk
+    from redis import RedisError
+
+    # EnvironmentError covers failed JWKS fetches (requests' exceptions are IOErrors) and the
+    # JWKS cache's backoff after a failure
+    return EnvironmentError, RedisError
+
+
+def _verify_groups(
+    work: List[Tuple[JwtParser, Any, List[ParsedJwt]]]
+) -> List[Tuple[ParsedJwt, TokenVerificationResult]]:
+    token_count: int = sum(len(parsed_jwts) for _, _, parsed_jwts in work)
+    threshold: int = current_app.config.get(
+        "JWT_BULK_VERIFICATION_THRESHOLD", DEFAULT_BULK_VERIFICATION_THRESHOLD
+    )
+    processes: int = _pool_processes()
+
+    if token_count < threshold or processes <= 1:
+        return [
+            (parsed_jwt, result)
+            for jwt_parser, key, parsed_jwts in work
+            for parsed_jwt, result in zip(
+                parsed_jwts,
+                _verify_chunk(jwt_parser, key, [p.token for p in parsed_jwts]),
+            )
+        ]
+
+    # Split every group into roughly one chunk per process so all cores are used
+    pool: ProcessPoolExecutor = get_bulk_verification_pool()
+    chunk_size: int = max(1, math.ceil(token_count / processes))
+    futures: List[Tuple[List[ParsedJwt], Future]] = []
+    for jwt_parser, key, parsed_jwts in work:
+        for start in range(0, len(parsed_jwts), chunk_size):
+            chunk: List[ParsedJwt] = parsed_jwts[start : start + chunk_size]
+            futures.append(
+                (
+                    chunk,
+                    pool.submit(
+                        _verify_chunk, jwt_parser, key, [p.token for p in chunk]
+                    ),
+                )
+            )
+    return [
+        (parsed_jwt, result)
+        for chunk, future in futures
+        for parsed_jwt, result in zip(chunk, future.result())
+    ]
+
+
+def verify_tokens(
+    jwt_tokens: Sequence[str], verify: bool = True
+) -> List[TokenVerificationResult]:
+    """
+    Verifies a batch of JWTs, returning a result (claims and scopes, or an error) for each token
+    in the order given. Duplicate tokens share a result. Verified claims are cached in the same
+    way as for protected routes.
+    """
+    claims_cache = get_claims_cache()
+    registry = get_issuer_registry()
+    limits: TokenLimits = get_token_limits()
+    results: Dict[str, TokenVerificationResult] = {}
+    groups: Dict[Tuple[Any, Any, Any], _TokenGroup] = {}
+
+    for jwt_token in dict.fromkeys(jwt_tokens):
+        try:
+            check_token_size(jwt_token, limits)
+        except MalformedTokenError:
+            results[jwt_token] = TokenVerificationResult(error=OUTCOME_MALFORMED_TOKEN)
+            continue
+
+        cached = claims_cache.get(jwt_token, verify)
+        if cached is not None:
+            results[jwt_token] = TokenVerificationResult(
+                claims=cached.claims, scopes=cached.scopes
+            )
+            continue
+
+        try:
+            check_token_structure(jwt_token, limits)
+            parsed_jwt = ParsedJwt(jwt_token)
+        except MalformedTokenError:
+            results[jwt_token] = TokenVerificationResult(error=OUTCOME_MALFORMED_TOKEN)
+            continue
+        except jose_jwt.JWTError:
+            results[jwt_token] = TokenVerificationResult(error=OUTCOME_INVALID_TOKEN)
+            continue
+
+        issuer: Optional[str] = parsed_jwt.claims.get("iss")
+        jwt_parser: Optional[JwtParser] = registry.get(issuer, verify)
+        if jwt_parser is None:
+            results[jwt_token] = TokenVerificationResult(error=OUTCOME_UNKNOWN_ISSUER)
+            continue
+
+        group_key = (issuer, parsed_jwt.header.get("kid"), parsed_jwt.header.get("alg"))
+        group: Optional[_TokenGroup] = groups.get(group_key)
+        if group is None:
+            group = groups[group_key] = _TokenGroup(jwt_parser, parsed_jwt.header, [])
+        group.parsed_jwts.append(parsed_jwt)
+
+    # Look up the key material once per issuer and key. A failed lookup only fails its group.
+    key_lookup_errors: Tuple[Type[Exception], ...] = _key_lookup_errors()
+    work: List[Tuple[JwtParser, Any, List[ParsedJwt]]] = []
+    for group in groups.values():
+        error: Optional[str] = None
+        try:
+            key: Any = group.jwt_parser.resolve_key(group.header)
+        except ValueError:
+            error = OUTCOME_KEY_NOT_FOUND
+        except key_lookup_errors:
+            error = OUTCOME_KEY_UNAVAILABLE
+            if get_security_log().should_log(group.jwt_parser.title, error):
+                logger.warning(
+                    "Could not load JWT verification key",
+                    exc_info=True,
+                    extra={"issuer": group.jwt_parser.title},
+                )
+        if error is not None:
+            for parsed_jwt in group.parsed_jwts:
+                results[parsed_jwt.token] = TokenVerificationResult(error=error)
+            continue
+        work.append((group.jwt_parser, key, group.parsed_jwts))
+
+    for parsed_jwt, result in _verify_groups(work):
+        if result.ok:
+            claims, scopes = claims_cache.put(
+                parsed_jwt.token,
+                verify,
+                issuer=parsed_jwt.claims.get("iss"),
+                claims=result.claims or {},
+                scopes=result.scopes or [],
+                exp=parsed_jwt.claims.get("exp"),
+            )
+            result = TokenVerificationResult(claims=claims, scopes=scopes)
+        results[parsed_jwt.token] = result
+
+    return [results[jwt_token] for jwt_token in jwt_tokens]
@@ -0,0 +1,106 @@
+"""
+Set-indexed lists for JWT scopes and list-valued claims.
+
+Clinician tokens can carry thousands of location ids, and endpoint policies test membership
+of these lists on every request. IndexedList is still a list (so g.jwt_claims and g.jwt_scopes
+serialise and behave as before) but carries a frozenset index, built once per token, that
+makes `in` checks O(1). Any mutation drops the index and membership falls back to a scan.
+A frozen IndexedList (see freeze) can't be mutated at all, so it can be shared between requests;
+copies of it are ordinary, mutable IndexedLists.
+"""
+from typing import Any, FrozenSet, Iterable, Optional, Tuple
+
+
+class IndexedList(list):
+    _frozen: bool = False
+
+    def __init__(self, iterable: Iterable = ()) -> None:
+        super().__init__(iterable)
+        self._index: Optional[FrozenSet] = self._build_index()
+
+    def _build_index(self) -> Optional[FrozenSet]:
+        try:
+            return frozenset(self)
+        except TypeError:
+            # Unhashable items, e.g. a list of dicts
+            return None
+
+    def __contains__(self, item: Any) -> bool:
+        if self._index is not None:
+            try:
+                return item in self._index
+            except TypeError:
+                return False
+        return super().__contains__(item)
+
+    def freeze(self) -> "IndexedList":
+        """Makes the list immutable, and returns it."""
+        self._frozen = True
+        return self
+
+    def _check_mutable(self) -> None:
+        if self._frozen:
+            raise TypeError("Cannot modify a frozen IndexedList")
+
+    def _mutating(self) -> None:
+        self._check_mutable()
+        self._index = None
+
+    def __reduce__(self) -> Tuple[Any, ...]:
+        # Pickled and copied lists are rebuilt as new, mutable lists
+        return IndexedList, (list(self),)
+
+    def copy(self) -> "IndexedList":
+        copied: IndexedList = IndexedList.__new__(IndexedList)
+        list.extend(copied, self)
+        copied._index = self._index
+        return copied
+
+    # Mutators invalidate the index, and fail if the list is frozen
+    def append(self, item: Any) -> None:
+        self._mutating()
+        super().append(item)
+
+    def extend(self, iterable: Iterable) -> None:
+        self._mutating()
+        super().extend(iterable)
+
+    def insert(self, index: Any, item: Any) -> None:
+        self._mutating()
+        super().insert(index, item)
+
+    def remove(self, item: Any) -> None:
+        self._mutating()
+        super().remove(item)
+
+    def pop(self, *args: Any) -> Any:
+        self._mutating()
+        return super().pop(*args)
+
+    def clear(self) -> None:
+        self._mutating()
+        super().clear()
+
+    def __setitem__(self, key: Any, value: Any) -> None:
+        self._mutating()
+        super().__setitem__(key, value)
+
+    def __delitem__(self, key: Any) -> None:
+        self._mutating()
+        super().__delitem__(key)
+
+    def __iadd__(self, other: Iterable) -> "IndexedList":  # type:ignore
+        self._mutating()
+        return super().__iadd__(other)
+
+    def __imul__(self, n: Any) -> "IndexedList":  # type:ignore
+        self._mutating()
+        return super().__imul__(n)
+
+    def sort(self, *args: Any, **kwargs: Any) -> None:
+        self._check_mutable()
+        super().sort(*args, **kwargs)
+
+    def reverse(self) -> None:
+        self._check_mutable()
+        super().reverse()
@@ -0,0 +1,242 @@
+"""
+In-process cache of verified JWT claims.
+
+Clients tend to reuse the same bearer token for many requests, so once a token has been
+decoded and verified we keep the parsed claims and scopes until the token expires (or the
+configured TTL elapses, whichever comes first). Tokens are never stored in the clear - the
+cache is keyed by a SHA-256 digest of the token and the verify mode. The set indexes built
+for scopes and list claims (see claim_index) are kept with the cached entry. The cache's own
+copy of the claims is frozen, so hits can share it; each hit gets a dict that copies a nested
+claim (e.g. g.jwt_claims["raw"] or location_ids) out of the cache the first time it is read,
+so claims a view never reads are never copied and callers can still modify the ones they do.
+"""
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+from collections.abc import ItemsView, ValuesView
+from typing import Any, Dict, Iterator, List, NamedTuple, Optional, Tuple
+
+from flask import current_app
+
+from flask_batteries_included.helpers.app_singleton import app_singleton
+from flask_batteries_included.helpers.metrics import JWT_CACHE_LOOKUP_COUNT
+from flask_batteries_included.helpers.security.claim_index import IndexedList
+
+_EXTENSION_KEY = "fbi_jwt_claims_cache"
+
+DEFAULT_CLAIMS_CACHE_SIZE = 1024
+DEFAULT_CLAIMS_CACHE_TTL = 300
+
+_CACHE_HITS = JWT_CACHE_LOOKUP_COUNT.labels("claims", "hit")
+_CACHE_MISSES = JWT_CACHE_LOOKUP_COUNT.labels("claims", "miss")
+
+
+class CachedClaims(NamedTuple):
+    issuer: Optional[str]
+    claims: Dict[str, Any]
+    scopes: List[str]
+    expires_at: float
+
+
+class _FrozenDict(dict):
+    """A dict that can't be modified. Copies of it are ordinary dicts."""
+
+    def _immutable(self, *args: Any, **kwargs: Any) -> None:
+        raise TypeError("Cannot modify cached JWT claims")
+
+    __setitem__ = __delitem__ = _immutable
+    clear = pop = popitem = setdefault = update = _immutable  # type:ignore
+    __ior__ = _immutable  # type:ignore
+
+    def __reduce__(self) -> Tuple[Any, ...]:
+        return dict, (dict(self),)
+
+
+def _freeze(value: Any) -> Any:
+    if isinstance(value, (str, int, float)) or value is None:
+        return value
+    if isinstance(value, IndexedList) and value._index is not None:
+        # Hashable items are immutable, so only the list itself needs freezing
+        return value.copy().freeze()
+    if isinstance(value, list):
+        return IndexedList([_freeze(item) for item in value]).freeze()
+    if isinstance(value, tuple):
+        return tuple(_freeze(item) for item in value)
+    if isinstance(value, dict):
+        return _FrozenDict({key: _freeze(item) for key, item in value.items()})
+    if isinstance(value, set):
+        return frozenset(value)
+    return value
+
+
+def _thaw(value: Any) -> Any:
+    """Returns a mutable copy of a frozen claim value, or the value itself if it isn't frozen."""
+    if isinstance(value, _FrozenDict):
+        return _CopyOnReadDict(dict.items(value))
+    if isinstance(value, IndexedList) and value._frozen:
+        if value._index is not None:
+            return value.copy()
+        return IndexedList([_thaw(item) for item in value])
+    if isinstance(value, tuple):
+        return tuple(_thaw(item) for item in value)
+    if isinstance(value, frozenset):
+        return set(value)
+    return value
+
+
+class _CopyOnReadDict(dict):
+    """
+    A dict holding frozen claim values, each replaced by a mutable copy the first time it is read.
+    Overriding __iter__ makes dict(), ** and update() read values through __getitem__ as well.
+    """
+
+    def __getitem__(self, key: Any) -> Any:
+        value = dict.__getitem__(self, key)
+        thawed = _thaw(value)
+        if thawed is not value:
+            dict.__setitem__(self, key, thawed)
+        return thawed
+
+    def __iter__(self) -> Iterator:
+        return dict.__iter__(self)
+
+    def get(self, key: Any, default: Any = None) -> Any:
+        return self[key] if key in self else default
+
+    def setdefault(self, key: Any, default: Any = None) -> Any:
+        if key in self:
+            return self[key]
+        self[key] = default
+        return default
+
+    def pop(self, key: Any, *default: Any) -> Any:
+        if key in self:
+            value = self[key]
+            del self[key]
+            return value
+        return dict.pop(self, key, *default)
+
+    def popitem(self) -> Tuple[Any, Any]:
+        key, value = dict.popitem(self)
+        return key, _thaw(value)
+
+    def items(self) -> ItemsView:  # type:ignore
+        return ItemsView(self)
+
+    def values(self) -> ValuesView:  # type:ignore
+        return ValuesView(self)
+
+    def __or__(self, other: Any) -> Any:
+        return dict(self) | other
+
+    def copy(self) -> "_CopyOnReadDict":
+        return _CopyOnReadDict(dict.items(self))
+
+    def __reduce__(self) -> Tuple[Any, ...]:
+        return dict, (dict(self),)
+
+
+class VerifiedClaimsCache:
+    """
+    Thread-safe LRU cache of (claims, scopes) tuples for tokens that have already been decoded.
+    A max_size of 0 disables the cache.
+    """
+
+    def __init__(
+        self,
+        max_size: int = DEFAULT_CLAIMS_CACHE_SIZE,
+        ttl: int = DEFAULT_CLAIMS_CACHE_TTL,
+    ) -> None:
+        self.max_size: int = max_size
+        self.ttl: int = ttl
+        self.hits: int = 0
+        self.misses: int = 0
+        self._entries: "OrderedDict[Tuple[bytes, bool], CachedClaims]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _key(jwt_token: str, verify: bool) -> Tuple[bytes, bool]:
+        return hashlib.sha256(jwt_token.encode("utf-8")).digest(), verify
+
+    def get(self, jwt_token: str, verify: bool) -> Optional[CachedClaims]:
+        if self.max_size <= 0:
+            return None
+
+        key = self._key(jwt_token, verify)
+        with self._lock:
+            entry: Optional[CachedClaims] = self._entries.get(key)
+            if entry is not None and entry.expires_at <= time.time():
+                del self._entries[key]
+                entry = None
+            if entry is None:
+                self.misses += 1
+                _CACHE_MISSES.inc()
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+        _CACHE_HITS.inc()
+
+        # Nested claims are copied as they are read, so callers changing g.jwt_claims can't
+        # poison the cache
+        return entry._replace(
+            claims=_CopyOnReadDict(entry.claims), scopes=entry.scopes.copy()
+        )
+
+    def put(
+        self,
+        jwt_token: str,
+        verify: bool,
+        issuer: Optional[str],
+        claims: Dict[str, Any],
+        scopes: List[str],
+        exp: Any = None,
+    ) -> Tuple[Dict[str, Any], List[str]]:
+        """
+        Caches the claims and scopes for a token, and returns them as later cache hits will.
+        Callers should use the returned claims, so that the request that decoded the token sees
+        the same claims as later ones.
+        """
+        if self.max_size <= 0:
+            return claims, scopes
+
+        expires_at: float = time.time() + self.ttl
+        if isinstance(exp, (int, float)) and not isinstance(exp, bool):
+            expires_at = min(expires_at, float(exp))
+
+        entry = CachedClaims(
+            issuer=issuer,
+            claims={name: _freeze(value) for name, value in claims.items()},
+            scopes=_freeze(scopes),
+            expires_at=expires_at,
+        )
+        key = self._key(jwt_token, verify)
+        with self._lock:
+            self._entries[key] = entry
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+        return _CopyOnReadDict(entry.claims), entry.scopes.copy()
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+
+def _build_claims_cache() -> VerifiedClaimsCache:
+    return VerifiedClaimsCache(
+        max_size=current_app.config.get(
+            "JWT_CLAIMS_CACHE_SIZE", DEFAULT_CLAIMS_CACHE_SIZE
+        ),
+        ttl=current_app.config.get("JWT_CLAIMS_CACHE_TTL", DEFAULT_CLAIMS_CACHE_TTL),
+    )
+
+
+def get_claims_cache() -> VerifiedClaimsCache:
+    """Returns the verified claims cache for the current app."""
+    return app_singleton(_EXTENSION_KEY, _build_claims_cache)
@@ -4,16 +4,19 @@ This allows us to use bearerAuth in our OpenApi specifications.
 """
 from typing import Any, Dict
 
-from jose import JWTError, jwt
+from jose import JWTError
+
+from flask_batteries_included.helpers.security.parsed_jwt import parse_request_jwt
 
 
 def decode_bearer_token(token: str) -> Dict[str, Any]:
     """
     decodes but does not verify the JWT.
     We assume the endpoint will provide the required verification
-    (probably through the `protected_route` decorator)
+    (probably through the `protected_route` decorator), which reuses the token
+    parsed here rather than decoding it again.
     """
     try:
-        return jwt.get_unverified_claims(token)
+        return dict(parse_request_jwt(token).claims)
     except JWTError as e:
         raise PermissionError(f"Bearer token not valid") from e
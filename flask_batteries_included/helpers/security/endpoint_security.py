@@ -1,4 +1,14 @@
-from typing import Any, Callable, Dict, List, Optional, Union
+"""
+Endpoint policies for protected_route.
+
+The combinators below (or_, and_, key_present, scopes_present, ...) build Policy objects when
+the route is decorated. Nested or_/and_ calls are flattened into a single level, evaluation
+short-circuits with plain loops, and debug log payloads are only built when debug logging is
+enabled. Every policy is still callable as fn(jwt_claims, claims_map, **kwargs) -> bool, and
+explain() describes why a request was denied.
+"""
+import logging
+from typing import Any, Callable, Dict, FrozenSet, List, Optional, Tuple, Union
 
 from flask import request
 from she_logging import logger
@@ -9,87 +19,293 @@ from flask_batteries_included.config import (
 )
 
 
-def or_(*args: Callable) -> Callable[..., bool]:
-    def composed_validation(jwt_claims: Dict, claims_map: Dict, **kwargs: Any) -> bool:
-        return any(arg(jwt_claims, claims_map, **kwargs) for arg in args)
+def _debug_enabled() -> bool:
+    return logger.isEnabledFor(logging.DEBUG)
 
-    return composed_validation
+
+class Policy:
+    """
+    A compiled endpoint policy. Subclasses implement check() and describe(); explain() returns
+    None if the policy allows the request, otherwise a reason it was denied.
+    """
+
+    def __call__(
+        self, jwt_claims: Dict, claims_map: Optional[Dict], **kwargs: Any
+    ) -> bool:
+        return self.check(jwt_claims, claims_map, kwargs)
+
+    def check(self, jwt_claims: Dict, claims_map: Optional[Dict], kwargs: Dict) -> bool:
+        raise NotImplementedError()
+
+    def describe(self) -> str:
+        raise NotImplementedError()
+
+    def explain(
+        self, jwt_claims: Dict, claims_map: Optional[Dict], **kwargs: Any
+    ) -> Optional[str]:
+        return self._explain(jwt_claims, claims_map, kwargs)
+
+    def _explain(
+        self, jwt_claims: Dict, claims_map: Optional[Dict], kwargs: Dict
+    ) -> Optional[str]:
+        if self.check(jwt_claims, claims_map, kwargs):
+            return None
+        return f"{self.describe()} failed"
+
+    def __repr__(self) -> str:
+        return self.describe()
+
+
+class _CallablePolicy(Policy):
+    """Wraps a plain validation function so it can take part in a compiled policy."""
+
+    def __init__(self, function: Callable[..., bool]) -> None:
+        self.function: Callable[..., bool] = function
+
+    def check(self, jwt_claims: Dict, claims_map: Optional[Dict], kwargs: Dict) -> bool:
+        return bool(self.function(jwt_claims, claims_map, **kwargs))
+
+    def describe(self) -> str:
+        return f"{getattr(self.function, '__name__', repr(self.function))}()"
+
+
+class _AnyOf(Policy):
+    def __init__(self, policies: Tuple[Policy, ...]) -> None:
+        self.policies: Tuple[Policy, ...] = policies
+
+    def check(self, jwt_claims: Dict, claims_map: Optional[Dict], kwargs: Dict) -> bool:
+        for policy in self.policies:
+            if policy.check(jwt_claims, claims_map, kwargs):
+                return True
+        return False
+
+    def describe(self) -> str:
+        return f"or_({', '.join(p.describe() for p in self.policies)})"
+
+    def _explain(
+        self, jwt_claims: Dict, claims_map: Optional[Dict], kwargs: Dict
+    ) -> Optional[str]:
+        reasons: List[str] = []
+        for policy in self.policies:
+            reason: Optional[str] = policy._explain(jwt_claims, claims_map, kwargs)
+            if reason is None:
+                return None
+            reasons.append(reason)
+        return f"none of the alternatives passed: [{'; '.join(reasons)}]"
+
+
+class _AllOf(Policy):
+    def __init__(self, policies: Tuple[Policy, ...]) -> None:
+        self.policies: Tuple[Policy, ...] = policies
+
+    def check(self, jwt_claims: Dict, claims_map: Optional[Dict], kwargs: Dict) -> bool:
+        for policy in self.policies:
+            if not policy.check(jwt_claims, claims_map, kwargs):
+                return False
+        return True
+
+    def describe(self) -> str:
+        return f"and_({', '.join(p.describe() for p in self.policies)})"
+
+    def _explain(
+        self, jwt_claims: Dict, claims_map: Optional[Dict], kwargs: Dict
+    ) -> Optional[str]:
+        for policy in self.policies:
+            reason: Optional[str] = policy._explain(jwt_claims, claims_map, kwargs)
+            if reason is not None:
+                return reason
+        return None
 
 
-def and_(*args: Callable) -> Callable[..., bool]:
-    def composed_validation(jwt_claims: Dict, claims_map: Dict, **kwargs: Any) -> bool:
-        return all(arg(jwt_claims, claims_map, **kwargs) for arg in args)
+def compile_policy(validation_function: Optional[Callable]) -> Policy:
+    """
+    Returns validation_function as a Policy, wrapping plain functions. With no validation
+    function, the policy is compare_keys against the protected_route claims map.
+    """
+    if isinstance(validation_function, Policy):
+        return validation_function
+    return _CallablePolicy(validation_function or compare_keys)
+
+
+def _flatten(combinator: type, args: Tuple[Callable, ...]) -> Tuple[Policy, ...]:
+    policies: List[Policy] = []
+    for arg in args:
+        policy: Policy = compile_policy(arg)
+        if isinstance(policy, combinator):
+            policies.extend(policy.policies)  # type:ignore
+        else:
+            policies.append(policy)
+    return tuple(policies)
+
+
+def or_(*args: Callable) -> Policy:
+    policies: Tuple[Policy, ...] = _flatten(_AnyOf, args)
+    return policies[0] if len(policies) == 1 else _AnyOf(policies)
+
 
-    return composed_validation
+def and_(*args: Callable) -> Policy:
+    policies: Tuple[Policy, ...] = _flatten(_AllOf, args)
+    return policies[0] if len(policies) == 1 else _AllOf(policies)
 
 
-def key_present(key_to_contain: str) -> Callable[..., bool]:
-    def any_with_key(jwt_claims: Dict, claims_map: Dict, **kwargs: Any) -> bool:
-        if isinstance(key_to_contain, str) and key_to_contain in jwt_claims:
+class _KeyPresent(Policy):
+    def __init__(self, key_to_contain: str) -> None:
+        self.key_to_contain: str = key_to_contain
+
+    def check(self, jwt_claims: Dict, claims_map: Optional[Dict], kwargs: Dict) -> bool:
+        if isinstance(self.key_to_contain, str) and self.key_to_contain in jwt_claims:
             return True
-        logger.debug(
-            "Failed to find key '%s' in JWT",
-            key_to_contain,
-            extra={"jwt_claims": jwt_claims},
-        )
+        if _debug_enabled():
+            logger.debug(
+                "Failed to find key '%s' in JWT",
+                self.key_to_contain,
+                extra={"jwt_claims": jwt_claims},
+            )
         return False
 
-    return any_with_key
+    def describe(self) -> str:
+        return f"key_present({self.key_to_contain!r})"
 
+    def _explain(
+        self, jwt_claims: Dict, claims_map: Optional[Dict], kwargs: Dict
+    ) -> Optional[str]:
+        if self.check(jwt_claims, claims_map, kwargs):
+            return None
+        return f"key '{self.key_to_contain}' not in JWT"
 
-def key_contains_value(
-    key_to_contain: str, value_to_contain: str
-) -> Callable[..., bool]:
-    if not isinstance(value_to_contain, str):
-        raise ValueError("Endpoint protection expected values can only be of type str")
 
-    def any_with_key_and_value(
-        jwt_claims: Dict, claims_map: Dict, **kwargs: Any
-    ) -> bool:
+def key_present(key_to_contain: str) -> Policy:
+    return _KeyPresent(key_to_contain)
+
+
+class _KeyContainsValue(Policy):
+    def __init__(self, key_to_contain: str, value_to_contain: str) -> None:
+        self.key_to_contain: str = key_to_contain
+        self.value_to_contain: str = value_to_contain
+
+    def check(self, jwt_claims: Dict, claims_map: Optional[Dict], kwargs: Dict) -> bool:
         if (
-            key_to_contain in jwt_claims
-            and jwt_claims[key_to_contain] == value_to_contain
+            self.key_to_contain in jwt_claims
+            and jwt_claims[self.key_to_contain] == self.value_to_contain
         ):
             return True
-        logger.debug(
-            "Failed to find key '%s' in JWT with the expected value '%s'",
-            key_to_contain,
-            value_to_contain,
-            extra={"jwt_claims": jwt_claims},
+        if _debug_enabled():
+            logger.debug(
+                "Failed to find key '%s' in JWT with the expected value '%s'",
+                self.key_to_contain,
+                self.value_to_contain,
+                extra={"jwt_claims": jwt_claims},
+            )
+        return False
+
+    def describe(self) -> str:
+        return f"key_contains_value({self.key_to_contain!r}, {self.value_to_contain!r})"
+
+    def _explain(
+        self, jwt_claims: Dict, claims_map: Optional[Dict], kwargs: Dict
+    ) -> Optional[str]:
+        if self.check(jwt_claims, claims_map, kwargs):
+            return None
+        return (
+            f"key '{self.key_to_contain}' does not have value '{self.value_to_contain}'"
         )
+
+
+def key_contains_value(key_to_contain: str, value_to_contain: str) -> Policy:
+    if not isinstance(value_to_contain, str):
+        raise ValueError("Endpoint protection expected values can only be of type str")
+    return _KeyContainsValue(key_to_contain, value_to_contain)
+
+
+class _KeyContainsValueInList(Policy):
+    def __init__(self, key_to_contain: str, possible_values: List[str]) -> None:
+        self.key_to_contain: str = key_to_contain
+        self.possible_values: List[str] = possible_values
+        self._possible_values_set: Optional[FrozenSet] = None
+        try:
+            self._possible_values_set = frozenset(possible_values)
+        except TypeError:
+            pass
+
+    def _contains(self, value: Any) -> bool:
+        if self._possible_values_set is not None:
+            try:
+                return value in self._possible_values_set
+            except TypeError:
+                # Unhashable claim value, e.g. a list
+                pass
+        return value in self.possible_values
+
+    def check(self, jwt_claims: Dict, claims_map: Optional[Dict], kwargs: Dict) -> bool:
+        if self.key_to_contain in jwt_claims and self._contains(
+            jwt_claims[self.key_to_contain]
+        ):
+            return True
+        if _debug_enabled():
+            logger.debug(
+                "Failed to find key '%s' in JWT with allowed value",
+                self.key_to_contain,
+                extra={
+                    "allowed_values": self.possible_values,
+                    "jwt_claims": jwt_claims,
+                },
+            )
         return False
 
-    return any_with_key_and_value
+    def describe(self) -> str:
+        return f"key_contains_value_in_list({self.key_to_contain!r}, {self.possible_values!r})"
+
+    def _explain(
+        self, jwt_claims: Dict, claims_map: Optional[Dict], kwargs: Dict
+    ) -> Optional[str]:
+        if self.check(jwt_claims, claims_map, kwargs):
+            return None
+        return f"key '{self.key_to_contain}' does not have an allowed value"
 
 
 def key_contains_value_in_list(
     key_to_contain: str, list_of_possible_values_to_contain: List[str]
-) -> Callable[..., bool]:
+) -> Policy:
     if not isinstance(list_of_possible_values_to_contain, list):
         raise ValueError("Endpoint protection expected list can only be of type list")
+    return _KeyContainsValueInList(key_to_contain, list_of_possible_values_to_contain)
 
-    def any_with_key_in_value_list(
-        jwt_claims: Dict, claims_map: Dict, **kwargs: Any
-    ) -> bool:
-        if (
-            key_to_contain in jwt_claims
-            and jwt_claims[key_to_contain] in list_of_possible_values_to_contain
-        ):
-            return True
-        logger.debug(
-            "Failed to find key '%s' in JWT with allowed value",
-            key_to_contain,
-            extra={
-                "allowed_values": list_of_possible_values_to_contain,
-                "jwt_claims": jwt_claims,
-            },
-        )
-        return False
 
-    return any_with_key_in_value_list
+class _ScopesPresent(Policy):
+    def __init__(self, required_scopes: List[str]) -> None:
+        self.required_scopes: Tuple[str, ...] = tuple(required_scopes)
+
+    def _missing_scopes(self, jwt_scopes: Any) -> List[str]:
+        return [scope for scope in self.required_scopes if scope not in jwt_scopes]
+
+    def check(self, jwt_claims: Dict, claims_map: Optional[Dict], kwargs: Dict) -> bool:
+        jwt_scopes: Any = kwargs.get("jwt_scopes")
+        if not jwt_scopes:
+            logger.debug("No scopes found in JWT claims")
+            return False
+
+        for required_scope in self.required_scopes:
+            if required_scope not in jwt_scopes:
+                if _debug_enabled():
+                    logger.debug(
+                        "JWT is missing required scopes: %s",
+                        self._missing_scopes(jwt_scopes),
+                    )
+                return False
+        return True
+
+    def describe(self) -> str:
+        return f"scopes_present({list(self.required_scopes)!r})"
 
+    def _explain(
+        self, jwt_claims: Dict, claims_map: Optional[Dict], kwargs: Dict
+    ) -> Optional[str]:
+        if self.check(jwt_claims, claims_map, kwargs):
+            return None
+        return f"JWT is missing scopes {self._missing_scopes(kwargs.get('jwt_scopes') or [])}"
 
-def scopes_present(required_scopes: Union[str, List[str]]) -> Callable[..., bool]:
+
+def scopes_present(required_scopes: Union[str, List[str]]) -> Policy:
     if isinstance(required_scopes, str):
         required_scopes = [required_scopes]  # wrap string in a list
     elif not isinstance(required_scopes, list):
@@ -99,30 +315,30 @@ def scopes_present(required_scopes: Union[str, List[str]]) -> Callable[..., bool
         raise ValueError(
             "Endpoints protected with scopes_present must require at least one scope"
         )
+    return _ScopesPresent(required_scopes)
 
-    def all_scopes_present(
-        jwt_claims: Dict, claims_map: Dict, jwt_scopes: List[str], **kwargs: Any
-    ) -> bool:
-        if jwt_scopes == {}:
-            logger.debug("No scopes found in JWT claims")
-            return False
 
-        scopes_in_claims: bool = all(
-            required_scope in jwt_scopes for required_scope in required_scopes
-        )
-        if not scopes_in_claims:
-            missing_scopes: List[str] = list(set(required_scopes) - set(jwt_scopes))
-            logger.debug("JWT is missing required scopes: %s", missing_scopes)
-        return scopes_in_claims
+class _MatchKeys(Policy):
+    def __init__(self, route_params: Dict[str, str]) -> None:
+        self.route_params: Dict[str, str] = route_params
 
-    return all_scopes_present
+    def check(self, jwt_claims: Dict, claims_map: Optional[Dict], kwargs: Dict) -> bool:
+        return compare_keys(jwt_claims, self.route_params, **kwargs)
 
+    def describe(self) -> str:
+        params: str = ", ".join(f"{k}={v!r}" for k, v in self.route_params.items())
+        return f"match_keys({params})"
 
-def match_keys(**route_params: str) -> Callable[..., bool]:
-    def match_all_keys(jwt_claims: Dict, claims_map: Dict, **kwargs: Any) -> bool:
-        return compare_keys(jwt_claims, route_params, **kwargs)
+    def _explain(
+        self, jwt_claims: Dict, claims_map: Optional[Dict], kwargs: Dict
+    ) -> Optional[str]:
+        if self.check(jwt_claims, claims_map, kwargs):
+            return None
+        return f"route parameters do not match JWT claims {self.route_params}"
 
-    return match_all_keys
+
+def match_keys(**route_params: str) -> Policy:
+    return _MatchKeys(route_params)
 
 
 def compare_keys(jwt_claims: Dict, claims_map: Dict, **route_params: str) -> bool:
@@ -142,7 +358,7 @@ def compare_keys(jwt_claims: Dict, claims_map: Dict, **route_params: str) -> boo
         permission: str = jwt_claims[claim_field]
 
         # If the permission is a list, look in it. Otherwise just compare values
-        if type(permission) == list:
+        if isinstance(permission, list):
             if route_value not in permission:
                 return False
 
@@ -157,85 +373,115 @@ def compare_keys(jwt_claims: Dict, claims_map: Dict, **route_params: str) -> boo
     return True
 
 
-def non_production_only_route() -> Callable[..., bool]:
-    def non_production_only_route_internal(
-        jwt_claims: Dict, claims_map: Dict, **kwargs: Any
-    ) -> bool:
+class _EnvironmentPolicy(Policy):
+    def __init__(self, production: bool) -> None:
+        self.production: bool = production
+
+    def check(self, jwt_claims: Dict, claims_map: Optional[Dict], kwargs: Dict) -> bool:
+        if self.production:
+            return is_production_environment()
         return is_not_production_environment()
 
-    return non_production_only_route_internal
+    def describe(self) -> str:
+        if self.production:
+            return "production_only_route()"
+        return "non_production_only_route()"
 
 
-def production_only_route() -> Callable[..., bool]:
-    def production_only_route_internal(
-        jwt_claims: Dict, claims_map: Dict, **kwargs: Any
-    ) -> bool:
-        return is_production_environment()
+def non_production_only_route() -> Policy:
+    return _EnvironmentPolicy(production=False)
 
-    return production_only_route_internal
 
+def production_only_route() -> Policy:
+    return _EnvironmentPolicy(production=True)
 
-def argument_present(argument: str, expected_value: str) -> Callable:
-    def argument_present_internal(
-        jwt_claims: Dict, claims_map: Dict, **kwargs: Any
-    ) -> bool:
-        value = request.args.get(argument, default="").upper()
-        return value == expected_value.upper()
 
-    return argument_present_internal
+class _ArgumentPresent(Policy):
+    def __init__(self, argument: str, expected_value: str) -> None:
+        self.argument: str = argument
+        self.expected_value: str = expected_value.upper()
 
+    def check(self, jwt_claims: Dict, claims_map: Optional[Dict], kwargs: Dict) -> bool:
+        value = request.args.get(self.argument, default="").upper()
+        return value == self.expected_value
 
-def argument_not_present(argument: str) -> Callable:
-    def argument_not_present_internal(
-        jwt_claims: Dict, claims_map: Dict, **kwargs: Any
-    ) -> bool:
-        return request.args.get(argument, default=None) is None
+    def describe(self) -> str:
+        return f"argument_present({self.argument!r}, {self.expected_value!r})"
 
-    return argument_not_present_internal
 
+def argument_present(argument: str, expected_value: str) -> Policy:
+    return _ArgumentPresent(argument, expected_value)
 
-def field_in_path_matches_jwt_claim(
-    path_field_name: str, jwt_claim_name: str
-) -> Callable:
-    """
-    Returns a function that checks that the named field in the request path matches the named JWT claim.
-    :param path_field_name: Name of the field in the request path
-    :param jwt_claim_name: Name of the JWT claim
-    :return: a Callable
-    """
 
-    def field_in_path_matches_jwt_claim_internal(
-        jwt_claims: Dict, claims_map: Dict, **kwargs: Any
-    ) -> bool:
+class _ArgumentNotPresent(Policy):
+    def __init__(self, argument: str) -> None:
+        self.argument: str = argument
+
+    def check(self, jwt_claims: Dict, claims_map: Optional[Dict], kwargs: Dict) -> bool:
+        return request.args.get(self.argument, default=None) is None
+
+    def describe(self) -> str:
+        return f"argument_not_present({self.argument!r})"
+
+
+def argument_not_present(argument: str) -> Policy:
+    return _ArgumentNotPresent(argument)
+
+
+class _FieldInPathMatchesJwtClaim(Policy):
+    def __init__(self, path_field_name: str, jwt_claim_name: str) -> None:
+        self.path_field_name: str = path_field_name
+        self.jwt_claim_name: str = jwt_claim_name
+
+    def check(self, jwt_claims: Dict, claims_map: Optional[Dict], kwargs: Dict) -> bool:
         uuid_in_path: Optional[str] = (
-            request.view_args.get(path_field_name)
+            request.view_args.get(self.path_field_name)
             if request.view_args is not None
             else None
         )
-        jwt_user_id: Optional[str] = jwt_claims.get(jwt_claim_name)
+        jwt_user_id: Optional[str] = jwt_claims.get(self.jwt_claim_name)
         return jwt_user_id is not None and uuid_in_path == jwt_user_id
 
-    return field_in_path_matches_jwt_claim_internal
+    def describe(self) -> str:
+        return f"field_in_path_matches_jwt_claim({self.path_field_name!r}, {self.jwt_claim_name!r})"
 
 
-def field_in_body_matches_jwt_claim(
-    body_field_name: str, jwt_claim_name: str
-) -> Callable:
+def field_in_path_matches_jwt_claim(
+    path_field_name: str, jwt_claim_name: str
+) -> Policy:
     """
-    Returns a function that checks that the named field in the request JSON body matches the named JWT claim.
-    :param body_field_name: Name of the field in the request body
+    Returns a policy that checks that the named field in the request path matches the named JWT claim.
+    :param path_field_name: Name of the field in the request path
     :param jwt_claim_name: Name of the JWT claim
-    :return: a Callable
+    :return: a Policy
     """
+    return _FieldInPathMatchesJwtClaim(path_field_name, jwt_claim_name)
 
-    def field_in_body_matches_jwt_claim_internal(
-        jwt_claims: Dict, claims_map: Dict, **kwargs: Any
-    ) -> bool:
+
+class _FieldInBodyMatchesJwtClaim(Policy):
+    def __init__(self, body_field_name: str, jwt_claim_name: str) -> None:
+        self.body_field_name: str = body_field_name
+        self.jwt_claim_name: str = jwt_claim_name
+
+    def check(self, jwt_claims: Dict, claims_map: Optional[Dict], kwargs: Dict) -> bool:
         body = request.get_json(silent=True)
         field_in_body: Optional[str] = (
-            body.get(body_field_name) if body is not None else None
+            body.get(self.body_field_name) if body is not None else None
         )
-        jwt_claim: Optional[str] = jwt_claims.get(jwt_claim_name)
+        jwt_claim: Optional[str] = jwt_claims.get(self.jwt_claim_name)
         return jwt_claim is not None and field_in_body == jwt_claim
 
-    return field_in_body_matches_jwt_claim_internal
+    def describe(self) -> str:
+        return f"field_in_body_matches_jwt_claim({self.body_field_name!r}, {self.jwt_claim_name!r})"
+
+
+def field_in_body_matches_jwt_claim(
+    body_field_name: str, jwt_claim_name: str
+) -> Policy:
+    """
+    Returns a policy that checks that the named field in the request JSON body matches the named JWT claim.
+    :param body_field_name: Name of the field in the request body
+    :param jwt_claim_name: Name of the JWT claim
+    :return: a Policy
+    """
+    return _FieldInBodyMatchesJwtClaim(body_field_name, jwt_claim_name)
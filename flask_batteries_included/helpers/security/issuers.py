@@ -0,0 +1,228 @@
+"""
+Registry of the JWT issuers an app trusts, mapping each issuer string to ready-made parsers.
+
+Parsers only depend on app config, so they are built once per app rather than on every request.
+
+As well as the built-in issuers (internal, Auth0, Auth0 custom-db and the EPR service adapter),
+further issuers can be declared in JWT_ISSUERS, a list of entries like:
+
+    {
+        "issuer": "https://tenant.b2clogin.com/tenant-id/v2.0/",
+        "parser": "auth0",
+        "audience": "https://api.example/",
+        "jwks_url": "https://tenant.b2clogin.com/tenant-id/discovery/v2.0/keys",
+        "metadata_key": "extension_metadata",
+        "scope_key": "scp",
+        "title": "Azure AD B2C"
+    }
+
+The parser is one of the PARSER_TYPES. "auth0" issuers verify against the JWKS at jwks_url, and
+the others against the HS secret in hs_key ("internal" issuers may also give an hs_keyring of
+secrets by kid). audience defaults to HS_ISSUER, algorithms to VALID_JWT_ALGORITHMS and title to
+the parser's own. Each issuer may only be declared once, whether in JWT_ISSUERS or as a built-in.
+Whatever the number of issuers, a token is routed to its parser with one dict lookup. augment_app
+checks JWT_ISSUERS with check_issuer_config, so that a bad or duplicate entry stops the app
+starting rather than failing (or being ignored by) every protected request.
+"""
+from typing import Any, Callable, Dict, List, Mapping, Optional, Set, Tuple, Type
+
+from flask import current_app
+
+from flask_batteries_included.helpers.app_singleton import app_singleton
+from flask_batteries_included.helpers.security import jwt_parsers
+from flask_batteries_included.helpers.security.jwt_parsers import JwtParser
+
+_EXTENSION_KEY = "fbi_jwt_issuers"
+
+_BUILT_IN_ISSUER_KEYS: Tuple[str, ...] = (
+    "HS_ISSUER",
+    "AUTH0_DOMAIN",
+    "AUTH0_CUSTOM_DOMAIN",
+    "EPR_SERVICE_ADAPTER_ISSUER",
+)
+
+PARSER_TYPES: Dict[str, Type[JwtParser]] = {
+    "internal": jwt_parsers.InternalJwtParser,
+    "auth0": jwt_parsers.Auth0JwtParser,
+    "auth0_login": jwt_parsers.Auth0LoginJwtParser,
+}
+
+
+class IssuerRegistry:
+    def __init__(self) -> None:
+        self._parsers: Dict[Tuple[str, bool], JwtParser] = {}
+
+    def register(
+        self, issuer: str, parser_factory: Callable[[str, bool], JwtParser]
+    ) -> None:
+        """Registers parsers for both verify modes. The first registration wins."""
+        for verify in (True, False):
+            if (issuer, verify) not in self._parsers:
+                self._parsers[(issuer, verify)] = parser_factory(issuer, verify)
+
+    def get(self, issuer: Optional[str], verify: bool) -> Optional[JwtParser]:
+        if issuer is None:
+            return None
+        return self._parsers.get((issuer, verify))
+
+    def issuers(self) -> Tuple[str, ...]:
+        return tuple(issuer for issuer, verify in self._parsers if verify)
+
+
+def build_issuer_registry(config: Mapping) -> IssuerRegistry:
+    check_issuer_config(config)
+    registry = IssuerRegistry()
+    algorithms = config["VALID_JWT_ALGORITHMS"]
+    internal_domain: str = config["HS_ISSUER"]
+
+    auth0_domain: Optional[str] = config.get("AUTH0_DOMAIN", None)
+    if auth0_domain is not None:
+        registry.register(
+            auth0_domain,
+            lambda issuer, verify: jwt_parsers.Auth0JwtParser(
+                required_audience=config["AUTH0_AUDIENCE"],
+                required_issuer=issuer,
+                allowed_algorithms=algorithms,
+                metadata_key=config["AUTH0_METADATA"],
+                scope_key=config["AUTH0_SCOPE_KEY"],
+                verify=verify,
+            ),
+        )
+
+    registry.register(
+        internal_domain,
+        lambda issuer, verify: jwt_parsers.InternalJwtParser(
+            required_audience=internal_domain,
+            required_issuer=issuer,
+            allowed_algorithms=algorithms,
+            metadata_key="metadata",
+            scope_key="scope",
+            verify=verify,
+            hs_key=config["HS_KEY"],
+            hs_keyring=config.get("HS_KEYRING"),
+        ),
+    )
+
+    customdb_auth0_domain: Optional[str] = config.get("AUTH0_CUSTOM_DOMAIN", None)
+    if customdb_auth0_domain is not None:
+        registry.register(
+            customdb_auth0_domain,
+            lambda issuer, verify: jwt_parsers.Auth0LoginJwtParser(
+                required_audience=internal_domain,
+                required_issuer=issuer,
+                allowed_algorithms=algorithms,
+                metadata_key="metadata",
+                scope_key="scope",
+                verify=verify,
+                hs_key=config["AUTH0_HS_KEY"],
+            ),
+        )
+
+    epr_service_adapter_domain: Optional[str] = config.get(
+        "EPR_SERVICE_ADAPTER_ISSUER", None
+    )
+    if epr_service_adapter_domain is not None:
+        registry.register(
+            epr_service_adapter_domain,
+            lambda issuer, verify: jwt_parsers.InternalJwtParser(
+                required_audience=internal_domain,
+                required_issuer=issuer,
+                allowed_algorithms=algorithms,
+                metadata_key="metadata",
+                scope_key="scope",
+                verify=verify,
+                hs_key=config.get("EPR_SERVICE_ADAPTER_HS_KEY"),
+                title="EPR Service Adapter",
+            ),
+        )
+
+    for issuer_config in config.get("JWT_ISSUERS") or []:
+        _register_configured_issuer(
+            registry, issuer_config, algorithms, internal_domain
+        )
+
+    return registry
+
+
+def check_issuer_config(config: Mapping) -> None:
+    """
+    Checks the JWT_ISSUERS entries in config.
+    :raises EnvironmentError: if an entry is invalid, or declares an issuer already declared
+    """
+    declared: Set[str] = {
+        config[key] for key in _BUILT_IN_ISSUER_KEYS if config.get(key) is not None
+    }
+    for issuer_config in config.get("JWT_ISSUERS") or []:
+        _check_configured_issuer(issuer_config)
+        issuer: str = issuer_config["issuer"]
+        if issuer in declared:
+            raise EnvironmentError(f"JWT issuer {issuer} is declared more than once")
+        declared.add(issuer)
+
+
+def _key_source(parser_type: str) -> str:
+    # Auth0-style issuers publish a JWKS, the others share an HS secret
+    return "jwks_url" if parser_type == "auth0" else "hs_key"
+
+
+def _check_configured_issuer(issuer_config: Any) -> None:
+    # This is a server misconfiguration, so mustn't be a ValueError, which becomes a 400
+    if not isinstance(issuer_config, Mapping):
+        raise EnvironmentError("JWT_ISSUERS entries must be JSON objects")
+    issuer: Optional[str] = issuer_config.get("issuer")
+    parser_type: Optional[str] = issuer_config.get("parser")
+    if not issuer:
+        raise EnvironmentError("JWT_ISSUERS entries must have an issuer")
+    if parser_type not in PARSER_TYPES:
+        raise EnvironmentError(
+            f"JWT issuer {issuer} has unknown parser {parser_type}, "
+            f"expected one of {', '.join(PARSER_TYPES)}"
+        )
+    key_source: str = _key_source(parser_type)
+    if not issuer_config.get(key_source):
+        raise EnvironmentError(f"JWT issuer {issuer} must have a {key_source}")
+
+
+def _register_configured_issuer(
+    registry: IssuerRegistry,
+    issuer_config: Mapping[str, Any],
+    algorithms: List[str],
+    internal_domain: str,
+) -> None:
+    issuer: str = issuer_config["issuer"]
+    parser_type: str = issuer_config["parser"]
+    key_source: str = _key_source(parser_type)
+
+    parser_class: Type[JwtParser] = PARSER_TYPES[parser_type]
+    options: Dict[str, Any] = {
+        key_source: issuer_config[key_source],
+        "metadata_key": issuer_config.get("metadata_key", "metadata"),
+        "scope_key": issuer_config.get("scope_key", "scope"),
+    }
+    if "title" in issuer_config:
+        options["title"] = issuer_config["title"]
+    if parser_type == "internal" and "hs_keyring" in issuer_config:
+        options["hs_keyring"] = issuer_config["hs_keyring"]
+
+    registry.register(
+        issuer,
+        lambda issuer, verify: parser_class(
+            required_audience=issuer_config.get("audience", internal_domain),
+            required_issuer=issuer,
+            allowed_algorithms=issuer_config.get("algorithms", algorithms),
+            verify=verify,
+            **options,
+        ),
+    )
+
+
+def get_issuer_registry() -> IssuerRegistry:
+    """Returns the issuer registry for the current app."""
+    return app_singleton(
+        _EXTENSION_KEY, lambda: build_issuer_registry(current_app.config)
+    )
+
+
+def reset_issuer_registry() -> None:
+    """Forces the issuer registry to be rebuilt, e.g. after changing issuer config."""
+    current_app.extensions.pop(_EXTENSION_KEY, None)
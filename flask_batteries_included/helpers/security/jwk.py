@@ -1,55 +1,322 @@
+import hashlib
 import json
-from typing import Dict, Optional
+import threading
+import time
+from typing import Any, Dict, Hashable, Optional, Tuple
 
 import requests
-from flask import current_app
+from flask import Flask, current_app
+from jose import jwk as jose_jwk
+from jose.exceptions import JWKError
 from she_logging import logger
 
+from flask_batteries_included.helpers.app_singleton import app_singleton
+from flask_batteries_included.helpers.metrics import (
+    JWKS_FETCH_COUNT,
+    JWT_CACHE_LOOKUP_COUNT,
+)
+
+_JWKS_EXTENSION_KEY = "fbi_auth0_jwks"
+_JWKS_BY_URL_EXTENSION_KEY = "fbi_jwks_by_url"
+_JWKS_TESTING_EXTENSION_KEY = "fbi_auth0_jwks_testing"
+
+# Public key members of the JWKs we verify with. Others (e.g. x5c) are left out so that keys
+# stay hashable for the verification key cache; which key types are supported is up to jose.
+_JWK_MEMBERS = ("kty", "kid", "use", "alg", "n", "e", "crv", "x", "y")
+
+DEFAULT_JWKS_CACHE_TTL = 600
+DEFAULT_JWKS_MIN_REFETCH_INTERVAL = 10
+DEFAULT_JWKS_NEGATIVE_CACHE_TTL = 60
+DEFAULT_JWKS_FETCH_TIMEOUT = 5
+
+# Key objects are cheap to keep but expensive to build (particularly RSA), so keep a few
+_VERIFICATION_KEYS_MAX_SIZE = 256
+_verification_keys: Dict[Tuple[str, Hashable], Any] = {}
+_verification_keys_lock = threading.Lock()
+
+_JWKS_CACHE_HITS = JWT_CACHE_LOOKUP_COUNT.labels("jwks", "hit")
+_JWKS_CACHE_MISSES = JWT_CACHE_LOOKUP_COUNT.labels("jwks", "miss")
+_KEY_CACHE_HITS = JWT_CACHE_LOOKUP_COUNT.labels("verification_key", "hit")
+_KEY_CACHE_MISSES = JWT_CACHE_LOOKUP_COUNT.labels("verification_key", "miss")
+
+
+class IndexedJwks(dict):
+    """
+    A JWKS document with its keys indexed by kid. Behaves like the parsed JSON document so
+    existing callers can keep treating it as one.
+    """
+
+    def __init__(self, jwks: Dict) -> None:
+        super().__init__(jwks)
+        self.keys_by_kid: Dict[str, Dict] = {
+            key["kid"]: key for key in jwks.get("keys", []) if "kid" in key
+        }
+
+    @classmethod
+    def from_json(cls, jwks_str: str) -> "IndexedJwks":
+        return cls(json.loads(jwks_str))
+
+
+class JwksCache:
+    """
+    Process-local copy of the Auth0 JWKS, or of the JWKS at jwks_url for other issuers. Redis is
+    the shared second tier, and Auth0 itself is only called when neither tier knows the
+    requested kid. Once the TTL has passed the stale
+    JWKS is still served while a background thread reloads it; if that reload fails, the next
+    one waits negative_ttl seconds.
+
+    Reloads are single-flight: concurrent requests for an unknown kid wait for one reload
+    rather than each starting their own. Reloads happen at most once per min_refetch_interval,
+    and a kid that is still unknown after a reload isn't retried for negative_ttl seconds, so a
+    burst of tokens with forged kids costs one fetch.
+    """
+
+    _MAX_UNKNOWN_KIDS = 1024
+
+    def __init__(
+        self,
+        ttl: int = DEFAULT_JWKS_CACHE_TTL,
+        min_refetch_interval: int = DEFAULT_JWKS_MIN_REFETCH_INTERVAL,
+        negative_ttl: int = DEFAULT_JWKS_NEGATIVE_CACHE_TTL,
+        jwks_url: Optional[str] = None,
+    ) -> None:
+        self.jwks_url: Optional[str] = jwks_url
+        self.ttl: int = ttl
+        self.min_refetch_interval: int = min_refetch_interval
+        self.negative_ttl: int = negative_ttl
+        self._jwks: Optional[IndexedJwks] = None
+        self._expires_at: float = 0.0
+        self._last_load_attempt: Optional[float] = None
+        self._unknown_kids: Dict[str, float] = {}
+        self._lock = threading.Lock()
+        self._refresh_lock = threading.Lock()
+
+    def get(self, jwt_header: Dict) -> IndexedJwks:
+        kid: Optional[str] = jwt_header.get("kid")
+        jwks: Optional[IndexedJwks] = self._jwks
+        if jwks is not None and kid in jwks.keys_by_kid:
+            _JWKS_CACHE_HITS.inc()
+            if time.monotonic() >= self._expires_at:
+                self._refresh_in_background()
+            return jwks
+        _JWKS_CACHE_MISSES.inc()
+
+        if jwks is None or self._may_reload(kid):
+            # Unknown kid, so the keys may have been rotated - reload before giving up.
+            with self._lock:
+                jwks = self._jwks
+                if jwks is None or (
+                    kid not in jwks.keys_by_kid and self._may_reload(kid)
+                ):
+                    jwks = self._reload(jwt_header)
+
+        if kid not in jwks.keys_by_kid:
+            logger.debug("JWT kid not found in Auth0 JWKS", extra={"kid": kid})
+        return jwks
+
+    def _may_reload(self, kid: Optional[str]) -> bool:
+        now: float = time.monotonic()
+        if kid is None or self._unknown_kids.get(kid, 0.0) > now:
+            return False
+        return (
+            self._last_load_attempt is None
+            or now - self._last_load_attempt >= self.min_refetch_interval
+        )
+
+    def _reload(self, jwt_header: Optional[Dict]) -> IndexedJwks:
+        """Reloads the JWKS. Must be called holding self._lock."""
+        if (
+            self._jwks is None
+            and self._last_load_attempt is not None
+            and time.monotonic() - self._last_load_attempt < self.min_refetch_interval
+        ):
+            # Don't hammer redis/Auth0 while they are failing
+            raise EnvironmentError("Could not retrieve JWKs from Auth0")
+
+        self._last_load_attempt = time.monotonic()
+        jwks = _load_jwks(jwt_header, self.jwks_url)
+        self._jwks = jwks
+        self._expires_at = time.monotonic() + self.ttl
+
+        kid: Optional[str] = jwt_header.get("kid") if jwt_header else None
+        if kid is not None and kid not in jwks.keys_by_kid:
+            now: float = time.monotonic()
+            if len(self._unknown_kids) >= self._MAX_UNKNOWN_KIDS:
+                self._unknown_kids = {
+                    k: t for k, t in self._unknown_kids.items() if t > now
+                }
+            self._unknown_kids[kid] = now + self.negative_ttl
+        return jwks
+
+    def _refresh_in_background(self) -> None:
+        if not self._refresh_lock.acquire(blocking=False):
+            # Already refreshing
+            return
+
+        app: Flask = current_app._get_current_object()  # type:ignore
+        threading.Thread(
+            target=self._refresh, args=(app,), name="jwks-refresh", daemon=True
+        ).start()
+
+    def _refresh(self, app: Flask) -> None:
+        try:
+            with app.app_context(), self._lock:
+                self._reload(jwt_header=None)
+        except Exception:
+            # Keep serving the stale JWKS, but don't start another refresh on every request
+            # while the JWKS endpoint is failing
+            self._expires_at = time.monotonic() + self.negative_ttl
+            logger.exception("Failed to refresh Auth0 JWKS")
+        finally:
+            self._refresh_lock.release()
+
+
+def _new_jwks_cache(jwks_url: Optional[str]) -> JwksCache:
+    return JwksCache(
+        ttl=current_app.config.get("AUTH0_JWKS_CACHE_TTL", DEFAULT_JWKS_CACHE_TTL),
+        min_refetch_interval=current_app.config.get(
+            "AUTH0_JWKS_MIN_REFETCH_INTERVAL", DEFAULT_JWKS_MIN_REFETCH_INTERVAL
+        ),
+        negative_ttl=current_app.config.get(
+            "AUTH0_JWKS_NEGATIVE_CACHE_TTL", DEFAULT_JWKS_NEGATIVE_CACHE_TTL
+        ),
+        jwks_url=jwks_url,
+    )
+
+
+def get_jwks_cache(jwks_url: Optional[str] = None) -> JwksCache:
+    """
+    Returns the JWKS cache for the current app. Without a jwks_url this is the Auth0 JWKS
+    (AUTH0_JWKS_URL); issuers with their own JWKS get a cache per URL.
+    """
+    if jwks_url is None:
+        return app_singleton(_JWKS_EXTENSION_KEY, lambda: _new_jwks_cache(None))
+
+    caches: Dict[str, JwksCache] = app_singleton(_JWKS_BY_URL_EXTENSION_KEY, dict)
+    cache: Optional[JwksCache] = caches.get(jwks_url)
+    if cache is None:
+        cache = caches.setdefault(jwks_url, _new_jwks_cache(jwks_url))
+    return cache
+
 
 def retrieve_relevant_jwk(jwks: Dict, jwt_header: Dict) -> Optional[Dict]:
-    rsa_key = None
-    for key in jwks["keys"]:
-        if key["kid"] == jwt_header["kid"]:
-            rsa_key = {
-                "kty": key["kty"],
-                "kid": key["kid"],
-                "use": key["use"],
-                "n": key["n"],
-                "e": key["e"],
-            }
-            break
-    return rsa_key
+    key: Optional[Dict[str, Any]]
+    if isinstance(jwks, IndexedJwks):
+        key = jwks.keys_by_kid.get(jwt_header["kid"])
+    else:
+        key = next((k for k in jwks["keys"] if k.get("kid") == jwt_header["kid"]), None)
+
+    if key is None:
+        return None
+    return {member: key[member] for member in _JWK_MEMBERS if member in key}
 
 
 def fetch_auth0_jwks() -> str:
-    logger.debug("Fetching JWKS from Auth0")
     with current_app.app_context():
         auth0_jwks_url = current_app.config["AUTH0_JWKS_URL"]
-    fresh_jwks_resp = requests.get(auth0_jwks_url)
+    return fetch_jwks(auth0_jwks_url)
+
+
+def fetch_jwks(jwks_url: str) -> str:
+    """
+    Fetches the JWKS document at jwks_url, giving up after AUTH0_JWKS_FETCH_TIMEOUT seconds.
+    Raises EnvironmentError if it can't be fetched.
+    """
+    logger.debug("Fetching JWKS from %s", jwks_url)
+    timeout = current_app.config.get(
+        "AUTH0_JWKS_FETCH_TIMEOUT", DEFAULT_JWKS_FETCH_TIMEOUT
+    )
+    # Reloads are single-flight, so a hung fetch would hold up every request waiting on it
+    try:
+        fresh_jwks_resp = requests.get(jwks_url, timeout=timeout)
+    except requests.RequestException as e:
+        logger.critical("Not able to retrieve JWKS from %s: %s", jwks_url, e)
+        raise EnvironmentError(f"Could not retrieve JWKs from {jwks_url}") from e
     if fresh_jwks_resp.status_code != 200:
-        logger.critical("Not able to retrieve Auth0 JWKS from Auth0")
-        raise EnvironmentError("Could not retrieve JWKs from Auth0")
+        logger.critical("Not able to retrieve JWKS from %s", jwks_url)
+        raise EnvironmentError(f"Could not retrieve JWKs from {jwks_url}")
     return fresh_jwks_resp.text
 
 
+def _load_jwks(jwt_header: Optional[Dict], jwks_url: Optional[str]) -> IndexedJwks:
+    """
+    Loads the JWKS from redis, falling back to Auth0 (or jwks_url, if given) if redis is empty or
+    doesn't know the kid in jwt_header.
+    """
+    # Import dhosredis locally so we can avoid needing redis for services that don't use JWT validation.
+    import dhosredis
+
+    redis_key: str = "AUTH0_JWKS" if jwks_url is None else f"JWKS:{jwks_url}"
+    source: str = "auth0" if jwks_url is None else "jwks_url"
+
+    jwks_from_cache = dhosredis.get_value(redis_key)
+    if jwks_from_cache:
+        jwks = IndexedJwks.from_json(jwks_from_cache)
+        if jwt_header is None or jwt_header.get("kid") in jwks.keys_by_kid:
+            JWKS_FETCH_COUNT.labels("redis", "hit").inc()
+            return jwks
+    JWKS_FETCH_COUNT.labels("redis", "miss").inc()
+
+    logger.debug("Did not find JWKS in cache - fetching from %s", source)
+    try:
+        jwks_str = fetch_auth0_jwks() if jwks_url is None else fetch_jwks(jwks_url)
+    except Exception:
+        JWKS_FETCH_COUNT.labels(source, "error").inc()
+        raise
+    JWKS_FETCH_COUNT.labels(source, "ok").inc()
+    dhosredis.set_value(redis_key, jwks_str)
+    return IndexedJwks.from_json(jwks_str)
+
+
 def retrieve_auth0_jwks(jwt_header: Dict, testing: bool = False) -> Dict:
     if testing:
-        with current_app.app_context():
-            jwks_str = current_app.config["AUTH0_JWKS_TESTING"]
-            jwks = json.loads(jwks_str)
-            return jwks
+        return app_singleton(
+            _JWKS_TESTING_EXTENSION_KEY,
+            lambda: IndexedJwks.from_json(current_app.config["AUTH0_JWKS_TESTING"]),
+        )
 
-    # Import dhosredis locally so we can avoid needing redis for services that don't use JWT validation.
-    import dhosredis
+    return get_jwks_cache().get(jwt_header)
+
+
+def retrieve_jwks(jwt_header: Dict, jwks_url: str) -> Dict:
+    """Returns the JWKS published at jwks_url, for issuers other than Auth0."""
+    return get_jwks_cache(jwks_url).get(jwt_header)
+
+
+def get_verification_key(key_data: Any, algorithm: Optional[str]) -> Any:
+    """
+    Returns a pre-constructed python-jose key object for the given JWK or HS secret, so that
+    it doesn't have to be rebuilt on every verification. JWKs are cached by their contents
+    (kid and key material) and HS secrets by a SHA-256 fingerprint, in each case per algorithm.
+    If no key object can be built, key_data is returned unchanged for python-jose to deal with.
+    """
+    if not algorithm:
+        return key_data
+
+    fingerprint: Hashable
+    if isinstance(key_data, dict):
+        try:
+            fingerprint = tuple(sorted(key_data.items()))
+            hash(fingerprint)
+        except TypeError:
+            return key_data
+    elif isinstance(key_data, str):
+        fingerprint = hashlib.sha256(key_data.encode("utf-8")).hexdigest()
+    else:
+        return key_data
 
-    jwks_from_cache = dhosredis.get_value("AUTH0_JWKS")
-    if (
-        jwks_from_cache
-        and retrieve_relevant_jwk(json.loads(jwks_from_cache), jwt_header) is not None
-    ):
-        jwks_str = jwks_from_cache
+    cache_key: Tuple[str, Hashable] = (algorithm, fingerprint)
+    key = _verification_keys.get(cache_key)
+    if key is not None:
+        _KEY_CACHE_HITS.inc()
     else:
-        logger.debug("Did not find Auth0 JWKS in cache - fetching from Auth0 API")
-        jwks_str = fetch_auth0_jwks()
-        dhosredis.set_value("AUTH0_JWKS", jwks_str)
-    return json.loads(jwks_str)
+        _KEY_CACHE_MISSES.inc()
+        try:
+            key = jose_jwk.construct(key_data, algorithm)
+        except JWKError:
+            return key_data
+        with _verification_keys_lock:
+            if len(_verification_keys) >= _VERIFICATION_KEYS_MAX_SIZE:
+                _verification_keys.clear()
+            _verification_keys[cache_key] = key
+    return key
@@ -1,26 +1,48 @@
-from typing import Dict, List, Optional, Tuple
+import threading
+import time
+from typing import Dict, List, Optional, Set, Tuple
 
 import requests
 from flask import current_app, g
 from jose import jwt as jose_jwt
 from she_logging import logger
 
+from flask_batteries_included.helpers.security.outcomes import classify_jwt_error
+from flask_batteries_included.helpers.security.parsed_jwt import ParsedJwt
+from flask_batteries_included.helpers.security.security_log import get_security_log
+
 VALID_USER_ID_KEYS: Tuple = ("patient_id", "device_id", "clinician_id", "system_id")
 
+# System JWTs are refreshed in the background once they are this close to expiry
+SYSTEM_JWT_REFRESH_MARGIN = 60
+DEFAULT_SYSTEM_AUTH_TIMEOUT = 5
+
 
 def current_jwt_user() -> str:
-    try:
-        claims = g.jwt_claims or {}
-    except AttributeError:
-        claims = {}
+    """
+    Returns the user UUID from the current JWT claims, or "unknown". This is the default for the
+    created_by_ and modified_by_ columns, so it is called for every row written; the result is
+    kept on g for as long as g.jwt_claims is unchanged.
+    """
+    raw_claims: Optional[Dict] = g.get("jwt_claims")
+    cached: Optional[Tuple[Optional[Dict], str]] = g.get("_fbi_jwt_user")
+    if cached is not None and cached[0] is raw_claims:
+        return cached[1]
+
+    user_id: str = _jwt_user_from_claims(raw_claims or {})
+    g._fbi_jwt_user = (raw_claims, user_id)
+    return user_id
+
 
+def _jwt_user_from_claims(claims: Dict) -> str:
     for claim_type in VALID_USER_ID_KEYS:
         if claim_type in claims:
             return claims[claim_type]
 
-    if claims:
+    if claims and not g.get("_fbi_jwt_user_warned"):
         # There are claims, so we should expect to be able to get the user UUID.
         logger.warning("Could not get user UUID from JWT - claims are: %s", claims)
+        g._fbi_jwt_user_warned = True
     return "unknown"
 
 
@@ -31,8 +53,13 @@ def decode_hs_jwt(
         return jose_jwt.decode(
             jwt_token, hs_key, algorithms=algorithms, options=decode_options
         )
-    except (jose_jwt.ExpiredSignatureError, jose_jwt.JWTError, jose_jwt.JWSError):
-        logger.exception("Access attempted with incorrect JWT token: %s")
+    except (
+        jose_jwt.ExpiredSignatureError,
+        jose_jwt.JWTError,
+        jose_jwt.JWSError,
+    ) as e:
+        if get_security_log().should_log("HS", classify_jwt_error(e)):
+            logger.exception("Access attempted with incorrect JWT token")
         # Deliberately mask the error so the caller has no clues about security internals
         return None
 
@@ -44,19 +71,109 @@ def add_system_jwt_to_headers(http_headers: Dict, system_id: str) -> Dict:
             _scheme = current_app.config["SYSTEM_AUTH_URL_SCHEME"]
             _host = current_app.config["SYSTEM_AUTH_HOST"]
             _port = str(current_app.config["SYSTEM_AUTH_PORT"])
+            _timeout = current_app.config.get(
+                "SYSTEM_AUTH_TIMEOUT", DEFAULT_SYSTEM_AUTH_TIMEOUT
+            )
 
             return _add_system_jwt_to_headers(
-                http_headers, system_id, f"{_scheme}://{_host}:{_port}"
+                http_headers, system_id, f"{_scheme}://{_host}:{_port}", _timeout
             )
 
     return http_headers
 
 
 def _add_system_jwt_to_headers(
-    http_headers: Dict, system_id: str, _url_base: str
+    http_headers: Dict,
+    system_id: str,
+    _url_base: str,
+    timeout: float = DEFAULT_SYSTEM_AUTH_TIMEOUT,
 ) -> Dict:
     url = f"{_url_base}/dhos/v1/system/{system_id}/jwt"
-    jwt: str = requests.get(url).json()["jwt"]
+    jwt: str = _system_jwt_cache.get(url, timeout)
     http_headers["Authorization"] = f"Bearer {jwt}"
 
     return http_headers
+
+
+class SystemJwtCache:
+    """
+    Caches system JWTs by URL (and so by system ID) until shortly before they expire, then
+    serves the current token while fetching a replacement in the background. Tokens are
+    fetched over a keep-alive session per thread, as requests.Session isn't thread-safe.
+    Tokens without a readable exp claim are not cached.
+    """
+
+    def __init__(self, refresh_margin: int = SYSTEM_JWT_REFRESH_MARGIN) -> None:
+        self.refresh_margin: int = refresh_margin
+        self._local = threading.local()
+        self._tokens: Dict[str, Tuple[str, float]] = {}
+        self._refreshing: Set[str] = set()
+        self._lock = threading.Lock()
+
+    def get(self, url: str, timeout: float = DEFAULT_SYSTEM_AUTH_TIMEOUT) -> str:
+        entry: Optional[Tuple[str, float]] = self._tokens.get(url)
+        if entry is not None:
+            jwt, expires_at = entry
+            now: float = time.time()
+            if now < expires_at - self.refresh_margin:
+                return jwt
+            if now < expires_at:
+                self._refresh_in_background(url, timeout)
+                return jwt
+        return self._fetch(url, timeout)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._tokens.clear()
+
+    def _session(self) -> requests.Session:
+        session: Optional[requests.Session] = getattr(self._local, "session", None)
+        if session is None:
+            session = self._local.session = requests.Session()
+        return session
+
+    def _fetch(self, url: str, timeout: float) -> str:
+        response = self._session().get(url, timeout=timeout)
+        response.raise_for_status()
+        jwt: str = response.json()["jwt"]
+        expires_at: Optional[float] = self._expiry(jwt)
+        with self._lock:
+            if expires_at is not None:
+                self._tokens[url] = (jwt, expires_at)
+            else:
+                self._tokens.pop(url, None)
+        return jwt
+
+    def _refresh_in_background(self, url: str, timeout: float) -> None:
+        with self._lock:
+            if url in self._refreshing:
+                return
+            self._refreshing.add(url)
+        threading.Thread(
+            target=self._refresh,
+            args=(url, timeout),
+            name="system-jwt-refresh",
+            daemon=True,
+        ).start()
+
+    def _refresh(self, url: str, timeout: float) -> None:
+        try:
+            self._fetch(url, timeout)
+        except Exception:
+            logger.exception("Failed to refresh system JWT")
+        finally:
+            with self._lock:
+                self._refreshing.discard(url)
+
+    @staticmethod
+    def _expiry(jwt: str) -> Optional[float]:
+        try:
+            exp = ParsedJwt(jwt).claims.get("exp")
+        except jose_jwt.JWTError:
+            return None
+        if isinstance(exp, (int, float)) and not isinstance(exp, bool):
+            return float(exp)
+        return None
+
+
+_system_jwt_cache = SystemJwtCache()
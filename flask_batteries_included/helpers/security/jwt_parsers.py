@@ -1,9 +1,12 @@
-from typing import Any, Dict, List, Tuple, Union
+from typing import Any, Dict, List, Mapping, Optional, Tuple, Union
 
 from jose import jwt as jose_jwt
+from jose.exceptions import JWKError
 from she_logging import logger
 
 from flask_batteries_included.helpers.security import jwk
+from flask_batteries_included.helpers.security.claim_index import IndexedList
+from flask_batteries_included.helpers.security.parsed_jwt import ParsedJwt
 
 
 class JwtParser:
@@ -29,10 +32,45 @@ class JwtParser:
         ] = self._construct_verification_options(verify)
 
     def decode_jwt(
-        self, jwt_token: str, unverified_header: Dict
+        self, jwt_token: Union[str, ParsedJwt], unverified_header: Dict
     ) -> Tuple[Dict[str, str], List[str]]:
         raise NotImplementedError()
 
+    def resolve_key(self, unverified_header: Dict) -> Any:
+        """Returns the key material (HS secret or JWK) to verify a token with this header."""
+        raise NotImplementedError()
+
+    def _verify_token(
+        self, jwt_token: Union[str, ParsedJwt], key: Any, unverified_header: Dict
+    ) -> Dict:
+        # Reuse a pre-constructed key object for the token's algorithm where we can
+        algorithm: Optional[str] = unverified_header.get("alg")
+        if algorithm in self.allowed_algorithms:
+            key = jwk.get_verification_key(key, algorithm)
+
+        try:
+            # A pre-parsed token can be verified without decoding its segments again
+            if isinstance(jwt_token, ParsedJwt):
+                return jwt_token.verify(
+                    key,
+                    algorithms=self.allowed_algorithms,
+                    options=self.decode_options,
+                    audience=self.required_audience,
+                    issuer=self.required_issuer,
+                )
+            return jose_jwt.decode(
+                jwt_token,
+                key,
+                audience=self.required_audience,
+                algorithms=self.allowed_algorithms,
+                options=self.decode_options,
+                issuer=self.required_issuer,
+            )
+        except JWKError as e:
+            # jose can't build a key of this type or shape for the token's algorithm
+            logger.info("Could not build JWT key: %s", e)
+            raise ValueError("Could not build JWT key") from e
+
     def parse_access_token(
         self, access_token: Dict
     ) -> Tuple[Dict[str, Any], List[str]]:
@@ -55,9 +93,9 @@ class JwtParser:
             raw_scopes = access_token[self.scope_key]
             if not isinstance(raw_scopes, str):
                 raise PermissionError("Invalid scopes (must be string)")
-            scopes: List[str] = access_token[self.scope_key].split(" ")
+            scopes: List[str] = IndexedList(access_token[self.scope_key].split(" "))
         else:
-            scopes = []
+            scopes = IndexedList()
 
         return claims, scopes
 
@@ -67,12 +105,14 @@ class JwtParser:
         for claim in access_token[self.metadata_key]:
             if claim == "locations":
                 # Special case
-                claims["location_ids"] = [
+                claims["location_ids"] = IndexedList(
                     location["id"]
                     for location in access_token[self.metadata_key][claim]
-                ]
+                )
                 continue
-            claims[claim] = access_token[self.metadata_key][claim]
+            value: Any = access_token[self.metadata_key][claim]
+            # Index list claims so that policies can check membership cheaply
+            claims[claim] = IndexedList(value) if type(value) is list else value
 
         return claims
 
@@ -107,9 +147,12 @@ class InternalJwtParser(JwtParser):
         verify: bool = True,
         hs_key: str = None,
         title: str = "Internal",
+        hs_keyring: Optional[Mapping[str, str]] = None,
     ):
         self.title = title
         self.hs_key = hs_key
+        # Secrets by kid, so the HS secret can be rotated without trying several keys per token
+        self.hs_keyring: Dict[str, str] = dict(hs_keyring or {})
         super(InternalJwtParser, self).__init__(
             required_audience,
             required_issuer,
@@ -120,18 +163,23 @@ class InternalJwtParser(JwtParser):
         )
 
     def decode_jwt(
-        self, jwt_token: str, unverified_header: Dict
+        self, jwt_token: Union[str, ParsedJwt], unverified_header: Dict
     ) -> Tuple[Dict[str, str], List[str]]:
-        access_token = jose_jwt.decode(
-            jwt_token,
-            self.hs_key,
-            audience=self.required_audience,
-            algorithms=self.allowed_algorithms,
-            options=self.decode_options,
-            issuer=self.required_issuer,
+        access_token = self._verify_token(
+            jwt_token, self.resolve_key(unverified_header), unverified_header
         )
         return self.parse_access_token(access_token)
 
+    def resolve_key(self, unverified_header: Dict) -> Any:
+        kid: Optional[str] = unverified_header.get("kid")
+        if kid is None or not self.hs_keyring:
+            # Tokens without a kid are signed with the primary key
+            return self.hs_key
+        hs_key: Optional[str] = self.hs_keyring.get(kid)
+        if hs_key is None:
+            raise ValueError("Could not retrieve JWT key from header")
+        return hs_key
+
 
 class Auth0LoginJwtParser(JwtParser):
     title = "Auth0 login"
@@ -145,8 +193,11 @@ class Auth0LoginJwtParser(JwtParser):
         scope_key: str = "scope",
         verify: bool = True,
         hs_key: str = None,
+        title: Optional[str] = None,
     ):
         self.hs_key = hs_key
+        if title is not None:
+            self.title = title
         super(Auth0LoginJwtParser, self).__init__(
             required_audience,
             required_issuer,
@@ -157,18 +208,16 @@ class Auth0LoginJwtParser(JwtParser):
         )
 
     def decode_jwt(
-        self, jwt_token: str, unverified_header: Dict
+        self, jwt_token: Union[str, ParsedJwt], unverified_header: Dict
     ) -> Tuple[dict, List[str]]:
-        access_token = jose_jwt.decode(
-            jwt_token,
-            self.hs_key,
-            audience=self.required_audience,
-            algorithms=self.allowed_algorithms,
-            options=self.decode_options,
-            issuer=self.required_issuer,
+        access_token = self._verify_token(
+            jwt_token, self.resolve_key(unverified_header), unverified_header
         )
         return self.parse_access_token(access_token)
 
+    def resolve_key(self, unverified_header: Dict) -> Any:
+        return self.hs_key
+
 
 class Auth0JwtParser(JwtParser):
     title = "Auth0 standard"
@@ -181,7 +230,13 @@ class Auth0JwtParser(JwtParser):
         metadata_key: str = "",
         scope_key: str = "scope",
         verify: bool = True,
+        jwks_url: Optional[str] = None,
+        title: Optional[str] = None,
     ):
+        # Without a jwks_url, keys come from the Auth0 JWKS (AUTH0_JWKS_URL)
+        self.jwks_url: Optional[str] = jwks_url
+        if title is not None:
+            self.title = title
         super(Auth0JwtParser, self).__init__(
             required_audience,
             required_issuer,
@@ -192,26 +247,25 @@ class Auth0JwtParser(JwtParser):
         )
 
     def decode_jwt(
-        self, jwt_token: str, unverified_header: Dict
+        self, jwt_token: Union[str, ParsedJwt], unverified_header: Dict
     ) -> Tuple[Dict[str, Any], List[str]]:
+        rsa_key = self.resolve_key(unverified_header)
+        access_token = self._verify_token(jwt_token, rsa_key, unverified_header)
+        return self.parse_access_token(access_token)
+
+    def resolve_key(self, unverified_header: Dict) -> Any:
         kid = unverified_header.get("kid", None)
         if kid is None:
             logger.warning("JWT provided with no kid field in header")
             raise ValueError("Could not retrieve JWT kid from header")
 
-        jwks = jwk.retrieve_auth0_jwks(unverified_header)
+        if self.jwks_url is None:
+            jwks = jwk.retrieve_auth0_jwks(unverified_header)
+        else:
+            jwks = jwk.retrieve_jwks(unverified_header, self.jwks_url)
         rsa_key = jwk.retrieve_relevant_jwk(jwks, unverified_header)
 
         if not rsa_key:
             logger.info("Could not retrieve JWT key from header: %s", unverified_header)
             raise ValueError("Could not retrieve JWT key from header")
-
-        access_token = jose_jwt.decode(
-            jwt_token,
-            rsa_key,
-            audience=self.required_audience,
-            algorithms=self.allowed_algorithms,
-            options=self.decode_options,
-            issuer=self.required_issuer,
-        )
-        return self.parse_access_token(access_token)
+        return rsa_key
@@ -0,0 +1,31 @@
+"""
+Outcomes of validating a JWT, shared by protected routes, bulk verification and the auth metrics.
+"""
+from jose import jwt as jose_jwt
+
+OUTCOME_OK = "ok"
+OUTCOME_NO_TOKEN = "no_token"
+OUTCOME_MALFORMED_TOKEN = "malformed_token"
+OUTCOME_INVALID_TOKEN = "invalid_token"
+OUTCOME_NO_ISSUER = "no_issuer"
+OUTCOME_ISSUER_NOT_ALLOWED = "issuer_not_allowed"
+OUTCOME_UNKNOWN_ISSUER = "unknown_issuer"
+OUTCOME_KEY_NOT_FOUND = "key_not_found"
+# The key material couldn't be loaded, e.g. the JWKS endpoint or redis is down
+OUTCOME_KEY_UNAVAILABLE = "key_unavailable"
+OUTCOME_EXPIRED = "expired"
+OUTCOME_INVALID_CLAIMS = "invalid_claims"
+OUTCOME_BAD_SIGNATURE = "bad_signature"
+OUTCOME_DENIED_BY_POLICY = "denied_by_policy"
+OUTCOME_ERROR = "error"
+
+
+def classify_jwt_error(error: Exception) -> str:
+    """Maps an exception raised while decoding a JWT to an outcome."""
+    if isinstance(error, jose_jwt.ExpiredSignatureError):
+        return OUTCOME_EXPIRED
+    if isinstance(error, (jose_jwt.JWTClaimsError, PermissionError)):
+        return OUTCOME_INVALID_CLAIMS
+    if isinstance(error, ValueError):
+        return OUTCOME_KEY_NOT_FOUND
+    return OUTCOME_BAD_SIGNATURE
@@ -0,0 +1,226 @@
+"""
+A JWT that has been split and decoded exactly once.
+
+python-jose's get_unverified_claims, get_unverified_header and decode each re-split and
+re-decode the token, so a protected request would otherwise parse every token three times.
+ParsedJwt decodes the segments up front and verifies the signature and registered claims
+against the already-decoded values. parse_request_jwt shares one ParsedJwt per request between
+connexion's bearerinfo function and protected_route.
+
+Bearer tokens are attacker-controlled, so check_token_size and check_token_structure reject
+oversized or malformed tokens before any base64 or JSON decoding. The size checks don't depend
+on the token's length and run before the claims cache is consulted; the full structure check
+scans the token once and runs only before it is decoded.
+"""
+import binascii
+import json
+import re
+from typing import Any, Dict, List, Mapping, NamedTuple, Optional
+
+from flask import current_app, g, has_app_context, has_request_context
+from jose import JWSError, JWTError
+from jose import jws as jose_jws
+from jose import jwt as jose_jwt
+from jose.utils import base64url_decode
+
+from flask_batteries_included.helpers.app_singleton import app_singleton
+from flask_batteries_included.helpers.metrics import JWT_MALFORMED_TOKEN_COUNT
+
+_LIMITS_EXTENSION_KEY = "fbi_jwt_token_limits"
+
+DEFAULT_MAX_TOKEN_LENGTH = 262_144
+DEFAULT_MAX_HEADER_LENGTH = 4096
+
+MALFORMED_TOO_LONG = "too_long"
+MALFORMED_HEADER_TOO_LONG = "header_too_long"
+MALFORMED_SEGMENTS = "segments"
+MALFORMED_ALPHABET = "alphabet"
+
+# Three base64url segments; the signature is empty for unsigned tokens
+_TOKEN_STRUCTURE = re.compile(r"[A-Za-z0-9_-]+\.[A-Za-z0-9_-]+\.[A-Za-z0-9_-]*")
+
+# Mirrors the defaults applied by jose.jwt.decode
+_DEFAULT_DECODE_OPTIONS: Dict[str, Any] = {
+    "verify_signature": True,
+    "verify_aud": True,
+    "verify_iat": True,
+    "verify_exp": True,
+    "verify_nbf": True,
+    "verify_iss": True,
+    "verify_sub": True,
+    "verify_jti": True,
+    "verify_at_hash": True,
+    "require_aud": False,
+    "require_iat": False,
+    "require_exp": False,
+    "require_nbf": False,
+    "require_iss": False,
+    "require_sub": False,
+    "require_jti": False,
+    "require_at_hash": False,
+    "leeway": 0,
+}
+
+
+class TokenLimits(NamedTuple):
+    max_length: int = DEFAULT_MAX_TOKEN_LENGTH
+    max_header_length: int = DEFAULT_MAX_HEADER_LENGTH
+
+
+class MalformedTokenError(JWTError):
+    def __init__(self, reason: str) -> None:
+        super().__init__(f"Malformed token: {reason}")
+        self.reason: str = reason
+
+
+def get_token_limits() -> TokenLimits:
+    """
+    Returns the bearer token limits for the current app (JWT_MAX_TOKEN_LENGTH and
+    JWT_MAX_HEADER_LENGTH), resolved on first use. Outside an app context the defaults are used.
+    """
+    if not has_app_context():
+        return TokenLimits()
+    return app_singleton(
+        _LIMITS_EXTENSION_KEY,
+        lambda: TokenLimits(
+            max_length=current_app.config.get(
+                "JWT_MAX_TOKEN_LENGTH", DEFAULT_MAX_TOKEN_LENGTH
+            ),
+            max_header_length=current_app.config.get(
+                "JWT_MAX_HEADER_LENGTH", DEFAULT_MAX_HEADER_LENGTH
+            ),
+        ),
+    )
+
+
+def _reject(reason: str) -> None:
+    JWT_MALFORMED_TOKEN_COUNT.labels(reason).inc()
+    raise MalformedTokenError(reason)
+
+
+def check_token_size(jwt_token: str, limits: TokenLimits) -> None:
+    """
+    Rejects tokens, or token headers, that are too long. Only looks at the first
+    max_header_length characters of the token.
+    :raises MalformedTokenError: if the token is too long
+    """
+    if len(jwt_token) > limits.max_length:
+        _reject(MALFORMED_TOO_LONG)
+    # The header is the first segment, so it's too long if there's no "." just after the limit
+    if (
+        len(jwt_token) > limits.max_header_length
+        and jwt_token.find(".", 0, limits.max_header_length + 1) < 0
+    ):
+        _reject(MALFORMED_HEADER_TOO_LONG)
+
+
+def check_token_structure(jwt_token: str, limits: TokenLimits) -> None:
+    """
+    Rejects tokens that are too long or aren't three base64url segments, without decoding them.
+    :raises MalformedTokenError: if the token is malformed
+    """
+    check_token_size(jwt_token, limits)
+    if _TOKEN_STRUCTURE.fullmatch(jwt_token) is None:
+        segments: List[str] = jwt_token.split(".")
+        _reject(
+            MALFORMED_SEGMENTS
+            if len(segments) != 3 or not all(segments[:2])
+            else MALFORMED_ALPHABET
+        )
+
+
+def _has_private_api() -> bool:
+    # verify() uses python-jose internals to avoid re-parsing the token, so falls back to the
+    # public decode if a release renames them
+    return hasattr(jose_jws, "_verify_signature") and hasattr(
+        jose_jwt, "_validate_claims"
+    )
+
+
+class ParsedJwt:
+    def __init__(self, jwt_token: str) -> None:
+        self.token: str = jwt_token
+        try:
+            self.signing_input, crypto_segment = jwt_token.encode("utf-8").rsplit(
+                b".", 1
+            )
+            header_segment, claims_segment = self.signing_input.split(b".", 1)
+            header: Any = json.loads(base64url_decode(header_segment))
+            claims: Any = json.loads(base64url_decode(claims_segment))
+            self.signature: bytes = base64url_decode(crypto_segment)
+        except (ValueError, TypeError, binascii.Error) as e:
+            raise JWTError(f"Invalid token: {e}")
+
+        if not isinstance(header, Mapping):
+            raise JWTError("Invalid header string: must be a json object")
+        if not isinstance(claims, Mapping):
+            raise JWTError("Invalid claims string: must be a json object")
+        self.header: Dict[str, Any] = dict(header)
+        self.claims: Dict[str, Any] = dict(claims)
+
+    def verify(
+        self,
+        key: Any,
+        algorithms: List[str],
+        options: Optional[Mapping[str, Any]] = None,
+        audience: Optional[str] = None,
+        issuer: Optional[str] = None,
+    ) -> Dict[str, Any]:
+        """
+        Equivalent to jose.jwt.decode, but without re-parsing the token.
+        :return: the verified claims
+        :raises JWTError: if the signature is invalid
+        :raises ExpiredSignatureError: if the token has expired
+        :raises JWTClaimsError: if any registered claim is invalid
+        """
+        if not _has_private_api():
+            return jose_jwt.decode(
+                self.token,
+                key,
+                algorithms=algorithms,
+                options=dict(options or {}),
+                audience=audience,
+                issuer=issuer,
+            )
+
+        decode_options: Dict[str, Any] = {**_DEFAULT_DECODE_OPTIONS, **(options or {})}
+
+        if decode_options["verify_signature"]:
+            try:
+                jose_jws._verify_signature(
+                    self.signing_input, self.header, self.signature, key, algorithms
+                )
+            except JWSError as e:
+                raise JWTError(e)
+
+        jose_jwt._validate_claims(
+            self.claims,
+            audience=audience,
+            issuer=issuer,
+            algorithm=self.header.get("alg"),
+            options=decode_options,
+        )
+        return self.claims
+
+    def __str__(self) -> str:
+        return self.token
+
+
+def parse_request_jwt(jwt_token: str) -> ParsedJwt:
+    """
+    Returns the ParsedJwt for a bearer token on the current request, parsing it at most once per
+    request. Outside a request the token is simply parsed. Malformed tokens are rejected before
+    they are decoded.
+    :raises MalformedTokenError: if the token fails check_token_structure
+    :raises JWTError: if the token can't be decoded
+    """
+    if not has_request_context():
+        check_token_structure(jwt_token, get_token_limits())
+        return ParsedJwt(jwt_token)
+
+    parsed_jwt: Optional[ParsedJwt] = g.get("_fbi_parsed_jwt")
+    if parsed_jwt is None or parsed_jwt.token != jwt_token:
+        check_token_structure(jwt_token, get_token_limits())
+        parsed_jwt = ParsedJwt(jwt_token)
+        g._fbi_parsed_jwt = parsed_jwt
+    return parsed_jwt
@@ -0,0 +1,130 @@
+"""
+Rate-limited logging of JWT validation failures.
+
+A bad deploy handing out expired tokens can make every request fail validation, and logging each
+failure in full (token, header, claims, traceback) then costs more than serving the request.
+Failures are counted per issuer and reason over a window; only the first few in each window are
+logged in full, and the rest are reported as one summary line when the window closes. Protected
+routes check for a closed window after every request, and any remaining counts are reported at
+exit, so the summary is written even when the failures stop.
+"""
+import atexit
+import threading
+import time
+import weakref
+from typing import Dict, Optional, Tuple
+
+from flask import current_app, has_app_context
+from she_logging import logger
+
+from flask_batteries_included.helpers.app_singleton import app_singleton
+
+_EXTENSION_KEY = "fbi_jwt_security_log"
+
+DEFAULT_FAILURE_LOG_WINDOW = 60
+DEFAULT_FAILURE_LOG_SAMPLES = 5
+# Issuers come from unverified tokens, so cap the number of distinct keys counted per window
+_MAX_KEYS = 1000
+
+# Every security log, so that suppressed counts can be reported at exit
+_security_logs: "weakref.WeakSet[SecurityLog]" = weakref.WeakSet()
+
+
+class SecurityLog:
+    """
+    Counts JWT validation failures per (issuer, reason). should_log() says whether the caller
+    should log a failure in full; the suppressed remainder is summarised once per window.
+    """
+
+    def __init__(
+        self,
+        window: int = DEFAULT_FAILURE_LOG_WINDOW,
+        max_samples: int = DEFAULT_FAILURE_LOG_SAMPLES,
+    ) -> None:
+        self.window: int = window
+        self.max_samples: int = max_samples
+        self._window_ends_at: float = time.monotonic() + window
+        self._counts: Dict[Tuple[str, str], int] = {}
+        self._lock = threading.Lock()
+        _security_logs.add(self)
+
+    def should_log(self, issuer: Optional[str], reason: str) -> bool:
+        key: Tuple[str, str] = (issuer or "none", reason)
+        with self._lock:
+            summary: Optional[Dict[Tuple[str, str], int]] = self._roll_window()
+            if key not in self._counts and len(self._counts) >= _MAX_KEYS:
+                key = ("other", reason)
+            count: int = self._counts.get(key, 0) + 1
+            self._counts[key] = count
+        if summary:
+            self._log_summary(summary)
+        return count <= self.max_samples
+
+    def flush(self) -> None:
+        """Logs the summary for the current window now, and starts a new window."""
+        with self._lock:
+            self._window_ends_at = 0.0
+            summary = self._roll_window()
+        if summary:
+            self._log_summary(summary)
+
+    def flush_if_due(self) -> None:
+        """Logs the summary for the current window if it has ended. Cheap enough to call per request."""
+        if not self._counts or time.monotonic() < self._window_ends_at:
+            return
+        with self._lock:
+            summary = self._roll_window()
+        if summary:
+            self._log_summary(summary)
+
+    def _roll_window(self) -> Optional[Dict[Tuple[str, str], int]]:
+        """Starts a new window if the current one has ended. Must be called holding self._lock."""
+        now: float = time.monotonic()
+        if now < self._window_ends_at:
+            return None
+        counts, self._counts = self._counts, {}
+        self._window_ends_at = now + self.window
+        # Only failures that weren't logged in full need summarising
+        return {key: count for key, count in counts.items() if count > self.max_samples}
+
+    def _log_summary(self, summary: Dict[Tuple[str, str], int]) -> None:
+        logger.warning(
+            "Suppressed logging of %d JWT validation failures",
+            sum(count - self.max_samples for count in summary.values()),
+            extra={
+                "jwt_failures": {
+                    f"{issuer}:{reason}": count
+                    for (issuer, reason), count in summary.items()
+                },
+                "window_seconds": self.window,
+            },
+        )
+
+
+@atexit.register
+def _flush_security_logs() -> None:
+    for security_log in list(_security_logs):
+        security_log.flush()
+
+
+_default_security_log = SecurityLog()
+
+
+def get_security_log() -> SecurityLog:
+    """
+    Returns the security log for the current app. Outside an app context a process-wide
+    default is used.
+    """
+    if not has_app_context():
+        return _default_security_log
+    return app_singleton(
+        _EXTENSION_KEY,
+        lambda: SecurityLog(
+            window=current_app.config.get(
+                "JWT_FAILURE_LOG_WINDOW", DEFAULT_FAILURE_LOG_WINDOW
+            ),
+            max_samples=current_app.config.get(
+                "JWT_FAILURE_LOG_SAMPLES", DEFAULT_FAILURE_LOG_SAMPLES
+            ),
+        ),
+    )
@@ -0,0 +1,45 @@
+"""
+Bounded thread pool for verifying JWTs from async views.
+
+Signature verification is CPU-bound, and an Auth0 JWKS miss does blocking redis and HTTP I/O,
+so async protected routes hand decoding to this pool rather than stalling the event loop. The
+pool is created per app on first use, sized by JWT_VERIFICATION_WORKERS.
+"""
+import asyncio
+import contextvars
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable
+
+from flask import current_app
+
+from flask_batteries_included.helpers.app_singleton import app_singleton
+
+_EXTENSION_KEY = "fbi_jwt_verification_executor"
+
+DEFAULT_VERIFICATION_WORKERS = 4
+
+
+def _build_verification_executor() -> ThreadPoolExecutor:
+    workers: int = current_app.config.get(
+        "JWT_VERIFICATION_WORKERS", DEFAULT_VERIFICATION_WORKERS
+    )
+    return ThreadPoolExecutor(
+        max_workers=workers, thread_name_prefix="jwt-verification"
+    )
+
+
+def get_verification_executor() -> ThreadPoolExecutor:
+    """Returns the JWT verification pool for the current app."""
+    return app_singleton(_EXTENSION_KEY, _build_verification_executor)
+
+
+async def run_in_verification_executor(function: Callable, *args: Any) -> Any:
+    """
+    Runs function in the verification pool and awaits the result. The caller's context
+    variables, and so the Flask app and request contexts, are carried over to the worker thread.
+    """
+    context: contextvars.Context = contextvars.copy_context()
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(
+        get_verification_executor(), context.run, function, *args
+    )
@@ -1,9 +1,24 @@
 import json
-from typing import Dict, Optional
+import threading
+import time
+from typing import Any, Dict, Optional
 
+import pytest
+import requests
+from flask import Flask
 from jose import jwt
+from prometheus_client import REGISTRY
+from requests_mock.mocker import Mocker
 
-from flask_batteries_included.helpers.security.jwk import retrieve_relevant_jwk
+from flask_batteries_included.helpers.security.jwk import (
+    IndexedJwks,
+    get_jwks_cache,
+    get_verification_key,
+    retrieve_auth0_jwks,
+    retrieve_jwks,
+    retrieve_relevant_jwk,
+)
+from flask_batteries_included.helpers.security.parsed_jwt import ParsedJwt
 
 JWT = (
     "eyJ0eXAiOiJKV1QiLCJhbGciOiJSUzI1NiIsImtpZCI6Ik5EYzFNamd5T0VFd1F6STJRME0yUWpaQl"
@@ -114,3 +129,296 @@ def test_auth0_retrieve_jwk_wrong_kid() -> None:
     jwks["keys"][0]["kid"] = "12345"
 
     assert retrieve_relevant_jwk(jwks, jwt.get_unverified_header(JWT)) is None
+
+
+def test_auth0_retrieve_jwk_indexed() -> None:
+    jwks = IndexedJwks.from_json(JWKS_RAW)
+    header = jwt.get_unverified_header(JWT)
+
+    assert jwks == json.loads(JWKS_RAW)
+    assert retrieve_relevant_jwk(jwks, header) == retrieve_relevant_jwk(
+        json.loads(JWKS_RAW), header
+    )
+    assert retrieve_relevant_jwk(jwks, {"kid": "12345"}) is None
+
+
+@pytest.mark.usefixtures("app_context")
+def test_auth0_jwks_testing_parsed_once(app: Flask) -> None:
+    header = jwt.get_unverified_header(JWT)
+    jwks = retrieve_auth0_jwks(header, testing=True)
+    assert retrieve_relevant_jwk(jwks, header) is not None
+    assert retrieve_auth0_jwks(header, testing=True) is jwks
+
+
+@pytest.mark.usefixtures("app_context", "mock_dhosredis")
+class TestJwksCache:
+    @pytest.fixture
+    def auth0_mock(self, requests_mock: Mocker) -> Any:
+        return requests_mock.get(
+            "https://draysonhealth.eu.auth0.com/.well-known/jwks.json", text=JWKS_RAW
+        )
+
+    @pytest.fixture
+    def header(self) -> Dict:
+        return jwt.get_unverified_header(JWT)
+
+    def test_loaded_once(
+        self, auth0_mock: Any, header: Dict, redis_values: Dict[str, Any]
+    ) -> None:
+        first = retrieve_auth0_jwks(header)
+        redis_values.clear()
+        second = retrieve_auth0_jwks(header)
+
+        assert second is first
+        assert retrieve_relevant_jwk(second, header) is not None
+        assert auth0_mock.call_count == 1
+
+    @pytest.mark.parametrize("redis_values", [{"AUTH0_JWKS": JWKS_RAW}])
+    def test_loaded_from_redis(self, auth0_mock: Any, header: Dict) -> None:
+        jwks = retrieve_auth0_jwks(header)
+        assert retrieve_relevant_jwk(jwks, header) is not None
+        assert auth0_mock.call_count == 0
+
+    @pytest.mark.parametrize("redis_values", [{"AUTH0_JWKS": JWKS_RAW}])
+    def test_metrics(self, auth0_mock: Any, header: Dict) -> None:
+        def sample(name: str, labels: Dict[str, str]) -> float:
+            return REGISTRY.get_sample_value(name, labels) or 0.0
+
+        redis_hits = sample(
+            "jwks_fetch_count_total", {"source": "redis", "result": "hit"}
+        )
+        cache_hits = sample(
+            "jwt_cache_lookup_count_total", {"cache": "jwks", "result": "hit"}
+        )
+        cache_misses = sample(
+            "jwt_cache_lookup_count_total", {"cache": "jwks", "result": "miss"}
+        )
+
+        retrieve_auth0_jwks(header)
+        retrieve_auth0_jwks(header)
+
+        assert (
+            sample("jwks_fetch_count_total", {"source": "redis", "result": "hit"})
+            == redis_hits + 1
+        )
+        assert (
+            sample("jwt_cache_lookup_count_total", {"cache": "jwks", "result": "miss"})
+            == cache_misses + 1
+        )
+        assert (
+            sample("jwt_cache_lookup_count_total", {"cache": "jwks", "result": "hit"})
+            == cache_hits + 1
+        )
+
+    def test_jwks_url_metrics(
+        self, header: Dict, redis_values: Dict[str, Any], requests_mock: Mocker
+    ) -> None:
+        requests_mock.get("https://other/keys", text=JWKS_RAW)
+        labels = {"source": "jwks_url", "result": "ok"}
+        fetches = REGISTRY.get_sample_value("jwks_fetch_count_total", labels) or 0.0
+
+        retrieve_jwks(header, "https://other/keys")
+
+        assert (
+            REGISTRY.get_sample_value("jwks_fetch_count_total", labels) == fetches + 1
+        )
+
+    def test_jwks_url_cached_separately(
+        self,
+        auth0_mock: Any,
+        header: Dict,
+        redis_values: Dict[str, Any],
+        requests_mock: Mocker,
+    ) -> None:
+        other_mock = requests_mock.get("https://other/keys", text=JWKS_RAW)
+
+        auth0_jwks = retrieve_auth0_jwks(header)
+        other_jwks = retrieve_jwks(header, "https://other/keys")
+
+        assert other_jwks is not auth0_jwks
+        assert retrieve_jwks(header, "https://other/keys") is other_jwks
+        assert get_jwks_cache("https://other/keys") is not get_jwks_cache()
+        assert auth0_mock.call_count == 1
+        assert other_mock.call_count == 1
+        assert set(redis_values) == {"AUTH0_JWKS", "JWKS:https://other/keys"}
+
+    def test_unknown_kid_reloads(
+        self, auth0_mock: Any, header: Dict, redis_values: Dict[str, Any]
+    ) -> None:
+        get_jwks_cache().min_refetch_interval = 0
+        retrieve_auth0_jwks(header)
+        rotated = json.loads(JWKS_RAW)
+        rotated["keys"][0]["kid"] = "rotated"
+        redis_values["AUTH0_JWKS"] = json.dumps(rotated)
+
+        jwks = retrieve_auth0_jwks({"kid": "rotated"})
+        assert retrieve_relevant_jwk(jwks, {"kid": "rotated"}) is not None
+        assert auth0_mock.call_count == 1
+
+    def test_unknown_kids_fetched_once(
+        self, auth0_mock: Any, header: Dict, redis_values: Dict[str, Any]
+    ) -> None:
+        retrieve_auth0_jwks(header)
+        redis_values.clear()
+
+        for i in range(10):
+            jwks = retrieve_auth0_jwks({"kid": f"forged-{i}"})
+            assert retrieve_relevant_jwk(jwks, {"kid": f"forged-{i}"}) is None
+        assert auth0_mock.call_count == 1
+
+    def test_unknown_kid_negatively_cached(
+        self, auth0_mock: Any, header: Dict, redis_values: Dict[str, Any]
+    ) -> None:
+        cache = get_jwks_cache()
+        cache.min_refetch_interval = 0
+        retrieve_auth0_jwks({"kid": "forged"})
+        assert auth0_mock.call_count == 1
+
+        redis_values.clear()
+        retrieve_auth0_jwks({"kid": "forged"})
+        assert auth0_mock.call_count == 1
+
+        retrieve_auth0_jwks({"kid": "another"})
+        assert auth0_mock.call_count == 2
+
+    def test_single_flight(self, app: Flask, requests_mock: Mocker) -> None:
+        fetching = threading.Event()
+        release = threading.Event()
+
+        def slow_jwks(request: Any, context: Any) -> str:
+            fetching.set()
+            release.wait(timeout=5)
+            return JWKS_RAW
+
+        auth0_mock = requests_mock.get(
+            "https://draysonhealth.eu.auth0.com/.well-known/jwks.json", text=slow_jwks
+        )
+        header = jwt.get_unverified_header(JWT)
+        results = []
+
+        def fetch() -> None:
+            with app.app_context():
+                results.append(retrieve_auth0_jwks(header))
+
+        threads = [threading.Thread(target=fetch) for _ in range(5)]
+        for thread in threads:
+            thread.start()
+        assert fetching.wait(timeout=5)
+        release.set()
+        for thread in threads:
+            thread.join(timeout=5)
+
+        assert len(results) == 5
+        assert all(result is results[0] for result in results)
+        assert auth0_mock.call_count == 1
+
+    def test_failed_fetch_not_retried_immediately(
+        self, requests_mock: Mocker, header: Dict
+    ) -> None:
+        auth0_mock = requests_mock.get(
+            "https://draysonhealth.eu.auth0.com/.well-known/jwks.json", status_code=503
+        )
+        for _ in range(3):
+            with pytest.raises(EnvironmentError):
+                retrieve_auth0_jwks(header)
+        assert auth0_mock.call_count == 1
+
+    def test_fetch_timeout(
+        self, app: Flask, requests_mock: Mocker, header: Dict
+    ) -> None:
+        app.config["AUTH0_JWKS_FETCH_TIMEOUT"] = 3
+        auth0_mock = requests_mock.get(
+            "https://draysonhealth.eu.auth0.com/.well-known/jwks.json",
+            exc=requests.exceptions.ConnectTimeout,
+        )
+        for _ in range(3):
+            with pytest.raises(EnvironmentError):
+                retrieve_auth0_jwks(header)
+        assert auth0_mock.call_count == 1
+        assert auth0_mock.last_request.timeout == 3
+        assert not get_jwks_cache()._lock.locked()
+
+    def test_jwks_url_fetch_timeout(
+        self, app: Flask, requests_mock: Mocker, header: Dict
+    ) -> None:
+        app.config["AUTH0_JWKS_FETCH_TIMEOUT"] = 3
+        other_mock = requests_mock.get(
+            "https://other/keys", exc=requests.exceptions.ReadTimeout
+        )
+        with pytest.raises(EnvironmentError):
+            retrieve_jwks(header, "https://other/keys")
+        assert other_mock.last_request.timeout == 3
+        assert not get_jwks_cache("https://other/keys")._lock.locked()
+
+    def test_stale_refreshed_in_background(
+        self, auth0_mock: Any, header: Dict, redis_values: Dict[str, Any]
+    ) -> None:
+        cache = get_jwks_cache()
+        cache.ttl = 0
+        stale = retrieve_auth0_jwks(header)
+        redis_values["AUTH0_JWKS"] = JWKS_RAW
+
+        # The stale copy is served immediately while the refresh happens elsewhere
+        assert retrieve_auth0_jwks(header) is stale
+        for _ in range(100):
+            if not cache._refresh_lock.locked():
+                break
+            time.sleep(0.01)
+        assert retrieve_auth0_jwks(header) is not stale
+        assert auth0_mock.call_count == 1
+
+    def test_failed_background_refresh_backs_off(
+        self,
+        auth0_mock: Any,
+        requests_mock: Mocker,
+        header: Dict,
+        redis_values: Dict[str, Any],
+    ) -> None:
+        cache = get_jwks_cache()
+        cache.ttl = 0
+        stale = retrieve_auth0_jwks(header)
+        redis_values.clear()
+        failing_mock = requests_mock.get(
+            "https://draysonhealth.eu.auth0.com/.well-known/jwks.json", status_code=503
+        )
+
+        for _ in range(5):
+            assert retrieve_auth0_jwks(header) is stale
+            for _ in range(100):
+                if not cache._refresh_lock.locked():
+                    break
+                time.sleep(0.01)
+        assert failing_mock.call_count == 1
+        assert cache._expires_at > time.monotonic()
+
+
+def test_verification_key_cached_per_kid() -> None:
+    header = jwt.get_unverified_header(JWT)
+    rsa_key = retrieve_relevant_jwk(json.loads(JWKS_RAW), header)
+
+    key = get_verification_key(rsa_key, "RS256")
+    assert get_verification_key(dict(rsa_key or {}), "RS256") is key
+    assert get_verification_key(rsa_key, "RS512") is not key
+
+    # The expired token is still correctly signed, so a cached key object verifies it
+    claims = ParsedJwt(JWT).verify(
+        key, ["RS256"], options={"verify_exp": False, "verify_aud": False}
+    )
+    assert claims["iss"] == AUTH0_DOMAIN
+
+
+def test_verification_key_cached_per_secret() -> None:
+    key = get_verification_key("secret", "HS256")
+    assert get_verification_key("secret", "HS256") is key
+    assert get_verification_key("other secret", "HS256") is not key
+
+    token = jwt.encode({"sub": "1234"}, "secret", algorithm="HS256")
+    assert jwt.decode(token, key, algorithms=["HS256"]) == {"sub": "1234"}
+
+
+@pytest.mark.parametrize(
+    "key_data,algorithm",
+    [("secret", None), ("secret", "RS256"), (None, "HS256"), ({"kty": "RSA"}, "HS256")],
+)
+def test_verification_key_not_constructed(key_data: Any, algorithm: str) -> None:
+    assert get_verification_key(key_data, algorithm) is key_data
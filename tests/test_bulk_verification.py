@@ -0,0 +1,163 @@
+import time
+from typing import Any, Dict
+
+import pytest
+import redis
+import requests
+from flask import Flask
+from jose import jwt as jose_jwt
+from pytest_mock import MockFixture
+
+from flask_batteries_included.helpers.security import bulk_verification
+from flask_batteries_included.helpers.security.bulk_verification import verify_tokens
+from flask_batteries_included.helpers.security.outcomes import (
+    OUTCOME_BAD_SIGNATURE,
+    OUTCOME_EXPIRED,
+    OUTCOME_INVALID_TOKEN,
+    OUTCOME_KEY_NOT_FOUND,
+    OUTCOME_KEY_UNAVAILABLE,
+    OUTCOME_MALFORMED_TOKEN,
+    OUTCOME_UNKNOWN_ISSUER,
+)
+
+
+def _token(key: str = "secret", **claims: Any) -> str:
+    payload: Dict[str, Any] = {
+        "iss": "http://localhost/",
+        "exp": int(time.time()) + 3600,
+        "metadata": {"system_id": "dhos-robot"},
+        "scope": "read:things",
+        **claims,
+    }
+    return jose_jwt.encode(payload, key, algorithm="HS256")
+
+
+@pytest.mark.usefixtures("app")
+def test_verify_tokens_results_in_order() -> None:
+    good = _token()
+    results = verify_tokens(
+        [
+            good,
+            _token(key="wrong"),
+            _token(exp=int(time.time()) - 10),
+            _token(iss="https://unknown/"),
+            "not.a.jwt",
+            "not-a-jwt",
+            good,
+        ]
+    )
+
+    assert [r.error for r in results] == [
+        None,
+        OUTCOME_BAD_SIGNATURE,
+        OUTCOME_EXPIRED,
+        OUTCOME_UNKNOWN_ISSUER,
+        OUTCOME_INVALID_TOKEN,
+        OUTCOME_MALFORMED_TOKEN,
+        None,
+    ]
+    assert results[0].ok
+    assert results[0].claims is not None
+    assert results[0].claims["system_id"] == "dhos-robot"
+    assert results[0].scopes == ["read:things"]
+
+
+@pytest.mark.usefixtures("app")
+def test_verify_tokens_dedupes_and_groups(mocker: MockFixture) -> None:
+    chunk_spy = mocker.spy(bulk_verification, "_verify_chunk")
+    tokens = [_token(sub=str(i)) for i in range(3)]
+
+    results = verify_tokens(tokens * 2)
+
+    assert all(r.ok for r in results)
+    # One group (same issuer and key), each distinct token verified once
+    assert chunk_spy.call_count == 1
+    assert len(chunk_spy.call_args[0][2]) == 3
+
+    # Verified tokens are cached for subsequent batches
+    chunk_spy.reset_mock()
+    verify_tokens(tokens)
+    chunk_spy.assert_not_called()
+
+
+def test_verify_tokens_key_not_found(app: Flask, mocker: MockFixture) -> None:
+    token = jose_jwt.encode(
+        {"iss": app.config["AUTH0_DOMAIN"], "sub": "x"},
+        "secret",
+        algorithm="HS256",
+        headers={"kid": "unknown"},
+    )
+    mocker.patch(
+        "flask_batteries_included.helpers.security.jwk.retrieve_auth0_jwks",
+        return_value={"keys": []},
+    )
+    with app.app_context():
+        assert verify_tokens([token])[0].error == OUTCOME_KEY_NOT_FOUND
+
+
+@pytest.mark.parametrize(
+    "error",
+    [
+        EnvironmentError("Could not retrieve JWKs from Auth0"),
+        requests.ConnectionError("JWKS endpoint down"),
+        redis.ConnectionError("redis down"),
+    ],
+)
+def test_verify_tokens_key_unavailable(
+    app: Flask, mocker: MockFixture, error: Exception
+) -> None:
+    auth0_token = jose_jwt.encode(
+        {"iss": app.config["AUTH0_DOMAIN"], "sub": "x"},
+        "secret",
+        algorithm="HS256",
+        headers={"kid": "k"},
+    )
+    mocker.patch(
+        "flask_batteries_included.helpers.security.jwk.retrieve_auth0_jwks",
+        side_effect=error,
+    )
+    with app.app_context():
+        results = verify_tokens([auth0_token, _token(), auth0_token])
+
+    # Only the group whose key couldn't be loaded fails
+    assert [r.error for r in results] == [
+        OUTCOME_KEY_UNAVAILABLE,
+        None,
+        OUTCOME_KEY_UNAVAILABLE,
+    ]
+
+
+def test_verify_tokens_process_pool(app: Flask) -> None:
+    app.config["JWT_BULK_VERIFICATION_THRESHOLD"] = 2
+    app.config["JWT_BULK_VERIFICATION_PROCESSES"] = 2
+    tokens = [_token(sub=str(i)) for i in range(5)] + [_token(key="wrong")]
+    with app.app_context():
+        try:
+            results = verify_tokens(tokens)
+        finally:
+            bulk_verification.get_bulk_verification_pool().shutdown()
+
+    assert [r.ok for r in results] == [True] * 5 + [False]
+    assert results[4].claims is not None
+    assert "read:things" in results[4].scopes  # type:ignore
+
+
+def test_pool_shut_down_at_exit(app: Flask) -> None:
+    with app.app_context():
+        pool = bulk_verification.get_bulk_verification_pool()
+        assert pool.submit(abs, -1).result(timeout=30) == 1
+
+    bulk_verification._shutdown_pools()
+    with pytest.raises(RuntimeError):
+        pool.submit(abs, -1)
+
+
+def test_pool_workers_not_forked(app: Flask) -> None:
+    with app.app_context():
+        pool = bulk_verification.get_bulk_verification_pool()
+        try:
+            mp_context = pool._mp_context
+            assert mp_context is not None
+            assert mp_context.get_start_method() in ("forkserver", "spawn")
+        finally:
+            pool.shutdown()
@@ -0,0 +1,79 @@
+import copy
+import json
+import pickle
+from typing import Dict
+
+import pytest
+
+from flask_batteries_included.helpers.security.claim_index import IndexedList
+from flask_batteries_included.helpers.security.endpoint_security import compare_keys
+
+
+def test_behaves_like_a_list() -> None:
+    values = IndexedList(["L1", "L2"])
+    assert values == ["L1", "L2"]
+    assert isinstance(values, list)
+    assert json.dumps({"location_ids": values}) == '{"location_ids": ["L1", "L2"]}'
+    assert "L1" in values
+    assert "L3" not in values
+
+
+def test_unhashable_items() -> None:
+    values = IndexedList([{"id": "L1"}, {"id": "L2"}])
+    assert {"id": "L2"} in values
+    assert {"id": "L3"} not in values
+    assert ["L1"] not in IndexedList(["L1"])
+
+
+def test_mutation_invalidates_index() -> None:
+    values = IndexedList(["L1"])
+    values.append("L2")
+    assert "L2" in values
+    values[0] = "L3"
+    assert "L1" not in values
+    assert "L3" in values
+    values += ["L4"]
+    assert "L4" in values
+
+
+def test_copy_shares_index() -> None:
+    values = IndexedList(["L1", "L2"])
+    copied = values.copy()
+    assert isinstance(copied, IndexedList)
+    assert copied._index is values._index
+    copied.append("L3")
+    assert "L3" in copied
+    assert "L3" not in values
+
+
+def test_compare_keys_with_indexed_list_claim() -> None:
+    jwt_claims: Dict = {"location_ids": IndexedList(f"L{i}" for i in range(5000))}
+    claims_map = {"location_id": "location_ids"}
+    assert compare_keys(jwt_claims, claims_map, location_id="L4999") is True
+    assert compare_keys(jwt_claims, claims_map, location_id="L5000") is False
+
+
+def test_frozen() -> None:
+    values = IndexedList(["L1", "L2"]).freeze()
+    for mutate in (
+        lambda: values.append("L3"),
+        lambda: values.extend(["L3"]),
+        lambda: values.remove("L1"),
+        lambda: values.pop(),
+        lambda: values.clear(),
+        lambda: values.sort(),
+        lambda: values.reverse(),
+        lambda: values.__setitem__(0, "L3"),
+        lambda: values.__delitem__(0),
+    ):
+        with pytest.raises(TypeError):
+            mutate()
+    assert values == ["L1", "L2"]
+    assert "L1" in values
+
+    # Copies are mutable
+    for copied in (values.copy(), copy.copy(values), copy.deepcopy(values)):
+        copied.append("L3")
+        assert copied == ["L1", "L2", "L3"]
+        assert "L3" in copied
+    assert pickle.loads(pickle.dumps(values)) == ["L1", "L2"]
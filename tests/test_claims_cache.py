@@ -0,0 +1,208 @@
+import copy
+import json
+import pickle
+import time
+from typing import Any, Dict
+
+import pytest
+from flask import Blueprint, Flask, Response, jsonify
+from flask.testing import FlaskClient
+from jose import jwt as jose_jwt
+from pytest_mock import MockFixture
+
+from flask_batteries_included.helpers.security import jwt_parsers, protected_route
+from flask_batteries_included.helpers.security.claim_index import IndexedList
+from flask_batteries_included.helpers.security.claims_cache import (
+    VerifiedClaimsCache,
+    get_claims_cache,
+)
+from flask_batteries_included.helpers.security.endpoint_security import scopes_present
+
+app_cached_routes = Blueprint("cached_routes", __name__)
+
+
+@app_cached_routes.route("/cached")
+@protected_route(scopes_present(required_scopes="hello:world"))
+def app_cached() -> Response:
+    return jsonify({"result": True})
+
+
+@app_cached_routes.route("/cached_other_issuer")
+@protected_route(
+    scopes_present(required_scopes="hello:world"),
+    allowed_issuers="https://other.issuer/",
+)
+def app_cached_other_issuer() -> Response:
+    return jsonify({"result": True})
+
+
+class TestVerifiedClaimsCache:
+    def test_miss_then_hit(self) -> None:
+        cache = VerifiedClaimsCache(max_size=10, ttl=60)
+        assert cache.get("a.b.c", True) is None
+        cache.put("a.b.c", True, issuer="iss", claims={"sub": "x"}, scopes=["s"])
+        cached = cache.get("a.b.c", True)
+        assert cached is not None
+        assert cached.issuer == "iss"
+        assert cached.claims == {"sub": "x"}
+        assert cached.scopes == ["s"]
+        assert (cache.hits, cache.misses) == (1, 1)
+
+    def test_verify_mode_is_part_of_key(self) -> None:
+        cache = VerifiedClaimsCache(max_size=10, ttl=60)
+        cache.put("a.b.c", False, issuer="iss", claims={}, scopes=[])
+        assert cache.get("a.b.c", True) is None
+        assert cache.get("a.b.c", False) is not None
+
+    def test_expires_at_token_exp(self) -> None:
+        cache = VerifiedClaimsCache(max_size=10, ttl=60)
+        cache.put("a.b.c", True, issuer="iss", claims={}, scopes=[], exp=time.time())
+        assert cache.get("a.b.c", True) is None
+        assert len(cache) == 0
+
+    def test_expires_after_ttl(self) -> None:
+        cache = VerifiedClaimsCache(max_size=10, ttl=0)
+        cache.put("a.b.c", True, issuer="iss", claims={}, scopes=[], exp=2**40)
+        assert cache.get("a.b.c", True) is None
+
+    def test_lru_eviction(self) -> None:
+        cache = VerifiedClaimsCache(max_size=2, ttl=60)
+        cache.put("1", True, issuer="iss", claims={}, scopes=[])
+        cache.put("2", True, issuer="iss", claims={}, scopes=[])
+        assert cache.get("1", True) is not None
+        cache.put("3", True, issuer="iss", claims={}, scopes=[])
+        assert cache.get("2", True) is None
+        assert cache.get("1", True) is not None
+        assert cache.get("3", True) is not None
+
+    def test_disabled(self) -> None:
+        cache = VerifiedClaimsCache(max_size=0)
+        cache.put("a.b.c", True, issuer="iss", claims={}, scopes=[])
+        assert cache.get("a.b.c", True) is None
+        assert cache.misses == 0
+
+    def test_returns_copies(self) -> None:
+        cache = VerifiedClaimsCache(max_size=10, ttl=60)
+        cache.put("a.b.c", True, issuer="iss", claims={"sub": "x"}, scopes=["s"])
+        first = cache.get("a.b.c", True)
+        assert first is not None
+        first.claims["sub"] = "tampered"
+        first.scopes.append("admin")
+        second = cache.get("a.b.c", True)
+        assert second is not None
+        assert second.claims == {"sub": "x"}
+        assert second.scopes == ["s"]
+
+    def test_nested_claims_copied(self) -> None:
+        cache = VerifiedClaimsCache(max_size=10, ttl=60)
+        claims: Dict[str, Any] = {
+            "location_ids": IndexedList(["L1"]),
+            "raw": {"metadata": {"locations": [{"id": "L1"}]}},
+        }
+        stored, _ = cache.put("a.b.c", True, issuer="iss", claims=claims, scopes=[])
+        # The caller's claims aren't frozen or shared
+        claims["location_ids"].append("L0")
+        stored["location_ids"].append("L0")
+        stored["raw"]["metadata"]["locations"].append({"id": "L0"})
+
+        first = cache.get("a.b.c", True)
+        assert first is not None
+        first.claims["location_ids"].append("L2")
+        assert "L2" in first.claims["location_ids"]
+        first.claims["raw"]["metadata"]["locations"].append({"id": "L2"})
+        first.claims["raw"]["metadata"]["locations"][0]["id"] = "L3"
+        copied = dict(first.claims)
+        assert copied["location_ids"] == ["L1", "L2"]
+        copied["raw"]["metadata"]["locations"].clear()
+        first.claims.get("raw", {})["metadata"].pop("locations")
+        for value in first.claims.values():
+            assert not isinstance(value, IndexedList) or not value._frozen
+
+        second = cache.get("a.b.c", True)
+        assert second is not None
+        assert second.claims["location_ids"] == ["L1"]
+        assert "L1" in second.claims["location_ids"]
+        assert second.claims["raw"] == {"metadata": {"locations": [{"id": "L1"}]}}
+        assert json.loads(json.dumps(second.claims)) == {
+            "location_ids": ["L1"],
+            "raw": {"metadata": {"locations": [{"id": "L1"}]}},
+        }
+        assert pickle.loads(pickle.dumps(second.claims)) == second.claims
+        assert copy.deepcopy(second.claims) == second.claims
+
+    def test_hits_copy_only_claims_read(self, mocker: MockFixture) -> None:
+        cache = VerifiedClaimsCache(max_size=10, ttl=60)
+        claims: Dict[str, Any] = {
+            "location_ids": IndexedList(f"L{i}" for i in range(2000)),
+            "raw": {"metadata": {"locations": [{"id": f"L{i}"} for i in range(2000)]}},
+        }
+        cache.put("a.b.c", True, issuer="iss", claims=claims, scopes=["s"])
+        mock_deepcopy = mocker.patch("copy.deepcopy")
+
+        first = cache.get("a.b.c", True)
+        second = cache.get("a.b.c", True)
+        assert first is not None and second is not None
+        # Claims that haven't been read are still shared with the cache
+        assert dict.__getitem__(first.claims, "raw") is dict.__getitem__(
+            second.claims, "raw"
+        )
+        # Reading a list claim copies the list but keeps its index
+        location_ids = first.claims["location_ids"]
+        assert location_ids is not second.claims["location_ids"]
+        assert location_ids._index is second.claims["location_ids"]._index
+        mock_deepcopy.assert_not_called()
+
+    def test_keeps_scope_index(self) -> None:
+        cache = VerifiedClaimsCache(max_size=10, ttl=60)
+        scopes = IndexedList(["read:a", "read:b"])
+        cache.put("a.b.c", True, issuer="iss", claims={}, scopes=scopes)
+        cached = cache.get("a.b.c", True)
+        assert cached is not None
+        assert isinstance(cached.scopes, IndexedList)
+        assert cached.scopes._index is scopes._index
+
+
+class TestProtectedRouteCache:
+    @pytest.fixture
+    def app_cached(self, app: Flask) -> None:
+        app.register_blueprint(app_cached_routes)
+
+    @pytest.fixture
+    def auth_header(self) -> Dict[str, str]:
+        claims = {
+            "sub": "1234567890",
+            "iss": "http://localhost/",
+            "aud": "http://localhost/",
+            "exp": int(time.time()) + 600,
+            "scope": "hello:world",
+        }
+        token = jose_jwt.encode(claims, "secret", algorithm="HS256")
+        return {"Authorization": f"Bearer {token}"}
+
+    def test_token_verified_once(
+        self,
+        app: Flask,
+        app_cached: None,
+        client: FlaskClient,
+        mocker: MockFixture,
+        auth_header: Dict[str, str],
+    ) -> None:
+        decode_spy: Any = mocker.spy(jwt_parsers.InternalJwtParser, "decode_jwt")
+        for _ in range(3):
+            response = client.get("/cached", headers=auth_header)
+            assert response.status_code == 200
+
+        assert decode_spy.call_count == 1
+        with app.app_context():
+            cache = get_claims_cache()
+            assert (cache.hits, cache.misses) == (2, 1)
+
+    def test_cached_token_still_checks_issuer(
+        self,
+        app_cached: None,
+        client: FlaskClient,
+        auth_header: Dict[str, str],
+    ) -> None:
+        assert client.get("/cached", headers=auth_header).status_code == 200
+        response = client.get("/cached_other_issuer", headers=auth_header)
+        assert response.status_code == 403
@@ -1,4 +1,5 @@
 import os
+from typing import Any, Dict
 from unittest.mock import Mock
 
 import pytest
@@ -309,3 +310,60 @@ def test_field_in_body_matches_jwt_claim(
         body_field_name="patient_uuid", jwt_claim_name="patient_id"
     )
     assert f(jwt_claims, None) is expected
+
+
+def test_nested_combinators_are_flattened() -> None:
+    policy = or_(or_(key_present("a"), key_present("b")), key_present("c"))
+    assert isinstance(policy, endpoint_security.Policy)
+    assert len(policy.policies) == 3  # type:ignore
+    assert policy({"c": 1}, {}) is True
+    assert policy({"d": 1}, {}) is False
+
+
+def test_single_combinator_argument_is_unwrapped() -> None:
+    inner = key_present("a")
+    assert and_(inner) is inner
+
+
+def test_plain_functions_in_combinators() -> None:
+    def always_true(jwt_claims: Dict, claims_map: Dict, **kwargs: Any) -> bool:
+        return True
+
+    policy = and_(always_true, key_present("a"))
+    assert policy({"a": 1}, {}) is True
+    assert policy({}, {}) is False
+
+
+def test_combinators_short_circuit() -> None:
+    second = Mock(return_value=True)
+    assert or_(key_present("a"), second)({"a": 1}, {}) is True
+    assert and_(key_present("a"), second)({}, {}) is False
+    second.assert_not_called()
+
+
+def test_explain() -> None:
+    policy = or_(
+        and_(key_present("patient_id"), scopes_present("read:patient")),
+        key_contains_value("role", "admin"),
+    )
+    jwt_claims = {"patient_id": "12345", "role": "clinician"}
+    assert policy.explain(jwt_claims, {}, jwt_scopes=["read:patient"]) is None
+
+    explanation = policy.explain(jwt_claims, {}, jwt_scopes=["read:user"])
+    assert explanation is not None
+    assert "missing scopes ['read:patient']" in explanation
+    assert "key 'role' does not have value 'admin'" in explanation
+
+
+def test_debug_payload_skipped_when_not_logged(mocker: MockFixture) -> None:
+    mocker.patch.object(endpoint_security, "_debug_enabled", return_value=False)
+    mock_debug = mocker.patch.object(endpoint_security.logger, "debug")
+    assert key_present("a")({}, {}) is False
+    assert key_contains_value_in_list("a", ["x"])({"a": "y"}, {}) is False
+    mock_debug.assert_not_called()
+
+
+def test_key_contains_value_in_list_unhashable_claim() -> None:
+    policy = key_contains_value_in_list("a", ["x", "y"])
+    assert policy({"a": ["x"]}, {}) is False
+    assert policy({"a": "y"}, {}) is True
@@ -1,6 +1,10 @@
 import re
+from typing import List
+
+from flask import Flask
 
 from flask_batteries_included.helpers import generate_uuid
+from flask_batteries_included.helpers.app_singleton import app_singleton
 
 
 def test_generate_uuid() -> None:
@@ -11,3 +15,19 @@ def test_generate_uuid() -> None:
         )
         is not None
     )
+
+
+def test_app_singleton() -> None:
+    built: List[object] = []
+
+    def factory() -> object:
+        built.append(object())
+        return built[-1]
+
+    first_app, second_app = Flask("first"), Flask("second")
+    with first_app.app_context():
+        value = app_singleton("test_singleton", factory)
+        assert app_singleton("test_singleton", factory) is value
+    with second_app.app_context():
+        assert app_singleton("test_singleton", factory) is not value
+    assert len(built) == 2
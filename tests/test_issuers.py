@@ -0,0 +1,344 @@
+import time
+from typing import Any, Dict
+
+import ecdsa
+import pytest
+import rsa
+from _pytest.monkeypatch import MonkeyPatch
+from flask import Blueprint, Flask, Response, jsonify
+from jose import jwk as jose_jwk
+from jose import jwt as jose_jwt
+from prometheus_client import REGISTRY
+from pytest_mock import MockFixture
+from requests_mock.mocker import Mocker
+
+from flask_batteries_included import create_app
+from flask_batteries_included.helpers.security import jwk, protected_route
+from flask_batteries_included.helpers.security.endpoint_security import scopes_present
+from flask_batteries_included.helpers.security.issuers import (
+    build_issuer_registry,
+    check_issuer_config,
+    get_issuer_registry,
+    reset_issuer_registry,
+)
+from flask_batteries_included.helpers.security.jwt_parsers import (
+    Auth0JwtParser,
+    Auth0LoginJwtParser,
+    InternalJwtParser,
+)
+
+ALGORITHMS = ["HS256", "RS256"]
+
+app_issuer_routes = Blueprint("issuer_routes", __name__)
+
+
+@app_issuer_routes.route("/issuer_secured")
+@protected_route(scopes_present(required_scopes="hello:world"))
+def app_issuer_secured() -> Response:
+    return jsonify({"result": True})
+
+
+@pytest.fixture
+def base_config() -> Dict[str, Any]:
+    return {
+        "VALID_JWT_ALGORITHMS": ALGORITHMS,
+        "HS_ISSUER": "http://localhost/",
+        "HS_KEY": "secret",
+    }
+
+
+def test_internal_issuer_only(base_config: Dict[str, Any]) -> None:
+    registry = build_issuer_registry(base_config)
+
+    assert registry.issuers() == ("http://localhost/",)
+    verified = registry.get("http://localhost/", True)
+    unverified = registry.get("http://localhost/", False)
+    assert isinstance(verified, InternalJwtParser)
+    assert isinstance(unverified, InternalJwtParser)
+    assert verified.hs_key == "secret"
+    assert verified.hs_keyring == {}
+    assert verified.decode_options["verify_signature"] is True
+    assert unverified.decode_options["verify_signature"] is False
+    assert registry.get("https://unknown/", True) is None
+    assert registry.get(None, True) is None
+
+
+def test_all_issuers(base_config: Dict[str, Any]) -> None:
+    registry = build_issuer_registry(
+        {
+            **base_config,
+            "AUTH0_DOMAIN": "https://auth0/",
+            "AUTH0_AUDIENCE": "https://audience/",
+            "AUTH0_METADATA": "https://metadata",
+            "AUTH0_SCOPE_KEY": "https://scope",
+            "AUTH0_CUSTOM_DOMAIN": "https://custom/",
+            "AUTH0_HS_KEY": "custom-secret",
+            "EPR_SERVICE_ADAPTER_ISSUER": "https://epr/",
+            "EPR_SERVICE_ADAPTER_HS_KEY": "epr-secret",
+        }
+    )
+
+    auth0 = registry.get("https://auth0/", True)
+    assert isinstance(auth0, Auth0JwtParser)
+    assert auth0.required_audience == "https://audience/"
+    assert auth0.scope_key == "https://scope"
+
+    custom = registry.get("https://custom/", True)
+    assert isinstance(custom, Auth0LoginJwtParser)
+    assert custom.hs_key == "custom-secret"
+    assert custom.required_audience == "http://localhost/"
+
+    epr = registry.get("https://epr/", False)
+    assert isinstance(epr, InternalJwtParser)
+    assert epr.title == "EPR Service Adapter"
+    assert epr.hs_key == "epr-secret"
+
+
+def test_first_issuer_wins(base_config: Dict[str, Any]) -> None:
+    registry = build_issuer_registry(
+        {**base_config, "EPR_SERVICE_ADAPTER_ISSUER": "http://localhost/"}
+    )
+    parser = registry.get("http://localhost/", True)
+    assert isinstance(parser, InternalJwtParser)
+    assert parser.title == "Internal"
+
+
+@pytest.mark.parametrize(
+    "config",
+    [
+        {"JWT_ISSUERS": [{"issuer": "http://localhost/", "parser": "internal"}]},
+        {
+            "AUTH0_DOMAIN": "https://auth0/",
+            "JWT_ISSUERS": [{"issuer": "https://auth0/", "parser": "internal"}],
+        },
+        {
+            "EPR_SERVICE_ADAPTER_ISSUER": "https://epr/",
+            "JWT_ISSUERS": [{"issuer": "https://epr/", "parser": "internal"}],
+        },
+        {
+            "JWT_ISSUERS": [
+                {"issuer": "https://partner/", "parser": "internal"},
+                {"issuer": "https://partner/", "parser": "auth0_login"},
+            ]
+        },
+    ],
+)
+def test_duplicate_issuer_invalid(
+    base_config: Dict[str, Any], config: Dict[str, Any]
+) -> None:
+    for issuer_config in config["JWT_ISSUERS"]:
+        issuer_config["hs_key"] = "partner-secret"
+    config = {**base_config, **config}
+    with pytest.raises(EnvironmentError, match="declared more than once"):
+        check_issuer_config(config)
+    with pytest.raises(EnvironmentError, match="declared more than once"):
+        build_issuer_registry(config)
+
+
+def test_duplicate_issuer_checked_at_startup(monkeypatch: MonkeyPatch) -> None:
+    monkeypatch.setenv(
+        "JWT_ISSUERS",
+        '[{"issuer": "https://partner/", "parser": "internal", "hs_key": "a"},'
+        ' {"issuer": "https://partner/", "parser": "internal", "hs_key": "b"}]',
+    )
+    with pytest.raises(EnvironmentError, match="declared more than once"):
+        create_app(use_auth0=True, testing=True)
+
+
+def test_registry_built_once_per_app(app: Flask) -> None:
+    with app.app_context():
+        registry = get_issuer_registry()
+        assert get_issuer_registry() is registry
+        assert isinstance(
+            registry.get(app.config["AUTH0_DOMAIN"], True), Auth0JwtParser
+        )
+
+        app.config["EPR_SERVICE_ADAPTER_ISSUER"] = "https://epr/"
+        assert get_issuer_registry().get("https://epr/", True) is None
+        reset_issuer_registry()
+        assert get_issuer_registry().get("https://epr/", True) is not None
+
+
+def test_configured_issuers(base_config: Dict[str, Any]) -> None:
+    registry = build_issuer_registry(
+        {
+            **base_config,
+            "JWT_ISSUERS": [
+                {
+                    "issuer": "https://b2c/",
+                    "parser": "auth0",
+                    "audience": "https://api/",
+                    "jwks_url": "https://b2c/keys",
+                    "metadata_key": "extension_metadata",
+                    "scope_key": "scp",
+                    "title": "Azure AD B2C",
+                },
+                {
+                    "issuer": "https://partner/",
+                    "parser": "internal",
+                    "hs_key": "partner-secret",
+                    "hs_keyring": {"2025": "partner-new-secret"},
+                    "algorithms": ["HS512"],
+                },
+            ],
+        }
+    )
+
+    assert registry.issuers() == (
+        "http://localhost/",
+        "https://b2c/",
+        "https://partner/",
+    )
+    b2c = registry.get("https://b2c/", True)
+    assert isinstance(b2c, Auth0JwtParser)
+    assert b2c.title == "Azure AD B2C"
+    assert b2c.jwks_url == "https://b2c/keys"
+    assert b2c.required_audience == "https://api/"
+    assert b2c.metadata_key == "extension_metadata"
+    assert b2c.scope_key == "scp"
+    b2c_unverified = registry.get("https://b2c/", False)
+    assert b2c_unverified is not None
+    assert b2c_unverified.decode_options["verify_signature"] is False
+
+    partner = registry.get("https://partner/", True)
+    assert isinstance(partner, InternalJwtParser)
+    assert partner.title == "Internal"
+    assert partner.hs_key == "partner-secret"
+    assert partner.required_audience == "http://localhost/"
+    assert partner.allowed_algorithms == ["HS512"]
+    assert partner.resolve_key({"kid": "2025"}) == "partner-new-secret"
+
+
+@pytest.mark.parametrize(
+    "issuer_config,message",
+    [
+        ("https://x/", "must be JSON objects"),
+        ({"parser": "internal", "hs_key": "x"}, "must have an issuer"),
+        ({"issuer": "https://x/", "parser": "saml"}, "unknown parser saml"),
+        ({"issuer": "https://x/", "parser": "auth0"}, "must have a jwks_url"),
+        ({"issuer": "https://x/", "parser": "auth0_login"}, "must have a hs_key"),
+    ],
+)
+def test_configured_issuer_invalid(
+    base_config: Dict[str, Any], issuer_config: Any, message: str
+) -> None:
+    config = {**base_config, "JWT_ISSUERS": [issuer_config]}
+    with pytest.raises(EnvironmentError, match=message):
+        check_issuer_config(config)
+    with pytest.raises(EnvironmentError, match=message):
+        build_issuer_registry(config)
+
+
+def test_configured_issuers_checked_at_startup(monkeypatch: MonkeyPatch) -> None:
+    monkeypatch.setenv("JWT_ISSUERS", '[{"issuer": "https://b2c/", "parser": "auth0"}]')
+    with pytest.raises(EnvironmentError, match="must have a jwks_url"):
+        create_app(use_auth0=True, testing=True)
+
+
+def test_configured_jwks_issuer_uses_own_jwks(app: Flask, mocker: MockFixture) -> None:
+    app.config["JWT_ISSUERS"] = [
+        {"issuer": "https://b2c/", "parser": "auth0", "jwks_url": "https://b2c/keys"}
+    ]
+    jwks = {"keys": [{"kid": "k", "kty": "RSA", "use": "sig", "n": "n", "e": "e"}]}
+    mock_retrieve = mocker.patch.object(jwk, "retrieve_jwks", return_value=jwks)
+    mock_auth0 = mocker.patch.object(jwk, "retrieve_auth0_jwks")
+
+    with app.app_context():
+        parser = get_issuer_registry().get("https://b2c/", True)
+        assert parser is not None
+        assert parser.resolve_key({"kid": "k"})["n"] == "n"
+
+    mock_retrieve.assert_called_once_with({"kid": "k"}, "https://b2c/keys")
+    assert not mock_auth0.called
+
+
+class TestConfiguredJwksIssuerRoute:
+    jwks_url = "https://b2c/keys"
+
+    @pytest.fixture(scope="class")
+    def signing_keys(self) -> Dict[str, str]:
+        _, rsa_private_key = rsa.newkeys(1024)
+        return {
+            "RS256": rsa_private_key.save_pkcs1().decode("utf-8"),
+            "ES256": ecdsa.SigningKey.generate(curve=ecdsa.NIST256p)
+            .to_pem()
+            .decode("utf-8"),
+        }
+
+    @pytest.fixture
+    def app_issuer(self, app: Flask, mock_dhosredis: None) -> Flask:
+        app.config["JWT_ISSUERS"] = [
+            {
+                "issuer": "https://b2c/",
+                "parser": "auth0",
+                "audience": "https://api/",
+                "jwks_url": self.jwks_url,
+                "algorithms": ["RS256", "ES256"],
+            }
+        ]
+        app.register_blueprint(app_issuer_routes)
+        return app
+
+    def _get(self, app: Flask, signing_key: str, algorithm: str) -> Response:
+        claims = {
+            "iss": "https://b2c/",
+            "aud": "https://api/",
+            "sub": "1234",
+            "exp": int(time.time()) + 600,
+            "scope": "hello:world",
+        }
+        token = jose_jwt.encode(
+            claims, signing_key, algorithm=algorithm, headers={"kid": "k"}
+        )
+        return app.test_client().get(
+            "/issuer_secured", headers={"Authorization": f"Bearer {token}"}
+        )
+
+    @pytest.mark.parametrize("algorithm", ["RS256", "ES256"])
+    def test_jwk_without_use(
+        self,
+        app_issuer: Flask,
+        requests_mock: Mocker,
+        signing_keys: Dict[str, str],
+        algorithm: str,
+    ) -> None:
+        public_jwk = jose_jwk.construct(signing_keys[algorithm], algorithm)
+        key = {**public_jwk.public_key().to_dict(), "kid": "k"}
+        key.pop("use", None)
+        requests_mock.get(self.jwks_url, json={"keys": [key]})
+
+        response = self._get(app_issuer, signing_keys[algorithm], algorithm)
+        assert response.status_code == 200
+
+    def test_unusable_jwk_rejected(
+        self,
+        app_issuer: Flask,
+        requests_mock: Mocker,
+        signing_keys: Dict[str, str],
+    ) -> None:
+        # An EC key can't verify an RS256 token
+        public_jwk = jose_jwk.construct(signing_keys["ES256"], "ES256")
+        key = {**public_jwk.public_key().to_dict(), "kid": "k"}
+        requests_mock.get(self.jwks_url, json={"keys": [key]})
+        labels = {"issuer": "Auth0 standard", "outcome": "key_not_found"}
+        failures = (
+            REGISTRY.get_sample_value("jwt_validation_latency_seconds_count", labels)
+            or 0.0
+        )
+
+        response = self._get(app_issuer, signing_keys["RS256"], "RS256")
+        assert response.status_code == 403
+        assert (
+            REGISTRY.get_sample_value("jwt_validation_latency_seconds_count", labels)
+            == failures + 1
+        )
+
+
+def test_internal_keyring(base_config: Dict[str, Any]) -> None:
+    registry = build_issuer_registry(
+        {**base_config, "HS_KEYRING": {"2025": "new-secret"}}
+    )
+    parser = registry.get("http://localhost/", True)
+    assert isinstance(parser, InternalJwtParser)
+    assert parser.resolve_key({"kid": "2025"}) == "new-secret"
+    assert parser.resolve_key({}) == "secret"
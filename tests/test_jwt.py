@@ -1,17 +1,26 @@
 import json
-from typing import Any, Dict
+import logging
+import threading
+import time
+from typing import Any, Dict, List
 from unittest.mock import Mock, patch
 
 import pytest
 import requests
+from _pytest.logging import LogCaptureFixture
 from flask import Flask, g
 from flask.testing import FlaskClient
 from jose import jwt as jose_jwt
 from pytest_mock import MockFixture
 from requests_mock.mocker import Mocker
 
-from flask_batteries_included.helpers.security import jwt_parsers
+from flask_batteries_included.helpers.security import (
+    jwt_parsers,
+    parsed_jwt,
+    protected_route,
+)
 from flask_batteries_included.helpers.security.jwt import (
+    SystemJwtCache,
     _add_system_jwt_to_headers,
     add_system_jwt_to_headers,
     current_jwt_user,
@@ -37,7 +46,23 @@ def test_current_jwt_user_invalid() -> None:
     assert current_jwt_user() == "unknown"
 
 
-@patch.object(requests, "get")
+@pytest.mark.usefixtures("app_context")
+def test_current_jwt_user_resolved_once(caplog: LogCaptureFixture) -> None:
+    g.jwt_claims = {"something_id": "12345"}
+    with caplog.at_level(logging.WARNING):
+        assert [current_jwt_user() for _ in range(1000)] == ["unknown"] * 1000
+    assert caplog.text.count("Could not get user UUID from JWT") == 1
+
+    # New claims on the same request are picked up, but don't warn again
+    g.jwt_claims = {"clinician_id": "12345"}
+    assert current_jwt_user() == "12345"
+    g.jwt_claims = {"other_id": "12345"}
+    with caplog.at_level(logging.WARNING):
+        assert current_jwt_user() == "unknown"
+    assert caplog.text.count("Could not get user UUID from JWT") == 1
+
+
+@patch.object(requests.Session, "get")
 def test_add_system_id_to_headers(mockget: Any) -> None:
     mockresponse = Mock()
     mockresponse.json.return_value = {"jwt": "SOMESORTOFJWT"}
@@ -63,6 +88,81 @@ def test_add_system_id_to_headers2(app: Flask, requests_mock: Mocker) -> None:
     }
 
 
+class TestSystemJwtCache:
+    url = "http://localhost:7000/dhos/v1/system/my-system-id/jwt"
+
+    @pytest.fixture
+    def cache(self) -> SystemJwtCache:
+        return SystemJwtCache(refresh_margin=60)
+
+    def _jwt(self, expires_in: int) -> str:
+        return jose_jwt.encode(
+            {"system_id": "my-system-id", "exp": int(time.time()) + expires_in},
+            "secret",
+        )
+
+    def test_cached_until_expiry(
+        self, cache: SystemJwtCache, requests_mock: Mocker
+    ) -> None:
+        token = self._jwt(expires_in=3600)
+        system_mock = requests_mock.get(self.url, json={"jwt": token})
+
+        assert cache.get(self.url) == token
+        assert cache.get(self.url) == token
+        assert system_mock.call_count == 1
+
+    def test_refreshed_ahead_of_expiry(
+        self, cache: SystemJwtCache, requests_mock: Mocker
+    ) -> None:
+        expiring = self._jwt(expires_in=30)
+        fresh = self._jwt(expires_in=3600)
+        system_mock = requests_mock.get(
+            self.url, [{"json": {"jwt": expiring}}, {"json": {"jwt": fresh}}]
+        )
+
+        assert cache.get(self.url) == expiring
+        # Still valid, so served while the replacement is fetched
+        assert cache.get(self.url) == expiring
+        for _ in range(100):
+            if not cache._refreshing:
+                break
+            time.sleep(0.01)
+        assert cache.get(self.url) == fresh
+        assert system_mock.call_count == 2
+
+    def test_fetch_timeout(self, cache: SystemJwtCache, requests_mock: Mocker) -> None:
+        system_mock = requests_mock.get(self.url, json={"jwt": self._jwt(3600)})
+        cache.get(self.url, timeout=3)
+        assert system_mock.last_request.timeout == 3
+
+    def test_fetch_error_status(
+        self, cache: SystemJwtCache, requests_mock: Mocker
+    ) -> None:
+        requests_mock.get(self.url, status_code=503, text="unavailable")
+        with pytest.raises(requests.HTTPError):
+            cache.get(self.url)
+
+    def test_session_per_thread(self, cache: SystemJwtCache) -> None:
+        sessions: List[requests.Session] = []
+        thread = threading.Thread(target=lambda: sessions.append(cache._session()))
+        thread.start()
+        thread.join()
+        assert cache._session() is cache._session()
+        assert sessions[0] is not cache._session()
+
+    @pytest.mark.parametrize("token", ["SOMESORTOFJWT", "expired"])
+    def test_not_cached(
+        self, cache: SystemJwtCache, requests_mock: Mocker, token: str
+    ) -> None:
+        if token == "expired":
+            token = self._jwt(expires_in=-10)
+        system_mock = requests_mock.get(self.url, json={"jwt": token})
+
+        assert cache.get(self.url) == token
+        assert cache.get(self.url) == token
+        assert system_mock.call_count == 2
+
+
 def test_decode_hs_jwt_expired() -> None:
     options: dict = JwtParser._construct_verification_options(True)
     decoded = decode_hs_jwt(
@@ -150,6 +250,22 @@ def test_connexion_bearer_auth_permission_error() -> None:
         decode_bearer_token("FOO.BAR")
 
 
+def test_connexion_bearer_auth_shares_parsed_token(
+    app: Flask, mocker: MockFixture
+) -> None:
+    from flask_batteries_included.helpers.security.connexion_bearerinfo import (
+        decode_bearer_token,
+    )
+
+    spy = mocker.spy(parsed_jwt, "ParsedJwt")
+    with app.test_request_context(
+        headers={"Authorization": f"Bearer {SAMPLE_JWT_EXPIRED}"}
+    ):
+        decode_bearer_token(SAMPLE_JWT_EXPIRED)
+        protected_route()._retrieve_jwt_claims(verify=False)
+    assert spy.call_count == 1
+
+
 @pytest.mark.usefixtures("app")
 @pytest.mark.parametrize("claims", [None, {}, {"unknown": "key"}])
 def test_connexion_bearer_auth_fails(claims: Any) -> None:
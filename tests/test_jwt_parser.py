@@ -7,6 +7,7 @@ from jose import jwt as jose_jwt
 from pytest_mock import MockFixture
 
 from flask_batteries_included.helpers.security import jwk
+from flask_batteries_included.helpers.security.claim_index import IndexedList
 from flask_batteries_included.helpers.security.jwt_parsers import (
     Auth0JwtParser,
     Auth0LoginJwtParser,
@@ -149,6 +150,9 @@ class TestParsers:
         assert parsed["sub"] == "user:12345"
         assert parsed["iss"] == "https://test.issuer.com/"
         assert parsed_scopes == expected_scopes
+        assert isinstance(parsed_scopes, IndexedList)
+        assert isinstance(parsed["location_ids"], IndexedList)
+        assert "L2" in parsed["location_ids"]
 
     def test_parse_access_token_custom_scope_key(self, mocker: MockFixture) -> None:
         mocker.patch.object(jwk, "retrieve_auth0_jwks", return_value={})
@@ -192,6 +196,31 @@ class TestParsers:
         with pytest.raises(jose_jwt.JWTError):
             internal_jwt_parser.decode_jwt(jwt_token=token, unverified_header={})
 
+    @pytest.mark.parametrize(
+        "kid,key",
+        [(None, "secret"), ("2024", "old-secret"), ("2025", "new-secret")],
+    )
+    def test_internal_parse_keyring(
+        self, internal_jwt_parser: InternalJwtParser, kid: Optional[str], key: str
+    ) -> None:
+        internal_jwt_parser.hs_keyring = {"2024": "old-secret", "2025": "new-secret"}
+        headers = {"kid": kid} if kid else None
+        token: str = jose_jwt.encode(claims=self.claims, key=key, headers=headers)
+        claims, _ = internal_jwt_parser.decode_jwt(
+            jwt_token=token, unverified_header=jose_jwt.get_unverified_header(token)
+        )
+        assert claims["iss"] == self.issuer
+
+    def test_internal_parse_keyring_unknown_kid(
+        self, internal_jwt_parser: InternalJwtParser
+    ) -> None:
+        internal_jwt_parser.hs_keyring = {"2025": "new-secret"}
+        with pytest.raises(ValueError):
+            internal_jwt_parser.resolve_key({"kid": "forged"})
+        # Without a keyring the kid is ignored
+        internal_jwt_parser.hs_keyring = {}
+        assert internal_jwt_parser.resolve_key({"kid": "forged"}) == self.hs_key
+
     def test_auth0_login_parse(
         self, auth0_login_jwt_parser: Auth0LoginJwtParser, caplog: LogCaptureFixture
     ) -> None:
@@ -1,11 +1,16 @@
 import logging
-from typing import Any, Dict, Optional, Type
+from pathlib import Path
+from typing import Any, Dict, Generator, Optional, Type
 
 import pytest
 from _pytest.logging import LogCaptureFixture
+from _pytest.monkeypatch import MonkeyPatch
 from flask import Flask
+from prometheus_client import REGISTRY, Histogram, values
+from pytest_mock import MockFixture
 
 from flask_batteries_included import init_monitoring
+from flask_batteries_included.helpers import metrics
 
 
 class _Anything:
@@ -63,3 +68,248 @@ def test_monitoring_endpoints(
     assert response.status_code == 200
     if content_type == "application/json":
         assert response.json == expected
+
+
+class TestMultiprocess:
+    @pytest.fixture
+    def multiproc_dir(self, tmp_path: Path, monkeypatch: MonkeyPatch) -> Path:
+        monkeypatch.setenv("PROMETHEUS_MULTIPROC_DIR", str(tmp_path))
+        return tmp_path
+
+    def test_metrics_from_worker_files(self, app: Flask, multiproc_dir: Path) -> None:
+        # Write a counter as two worker processes would
+        for pid in ("101", "102"):
+            value = values.MultiProcessValue(lambda: pid)(
+                "counter", "fbi_test_total", "fbi_test_total", [], [], "help"
+            )
+            value.inc(2)
+
+        metrics.init_metrics(app)
+        response = app.test_client().get("/metrics")
+
+        assert response.status_code == 200
+        assert "fbi_test_total 4.0" in response.get_data(as_text=True)
+
+    def test_warns_if_set_too_late(
+        self, app: Flask, multiproc_dir: Path, caplog: LogCaptureFixture
+    ) -> None:
+        with caplog.at_level(logging.WARNING):
+            metrics.init_metrics(app)
+        assert (
+            "multiprocess directory was set after metrics were created" in caplog.text
+        )
+
+    def test_clear_multiprocess_dir(self, multiproc_dir: Path) -> None:
+        (multiproc_dir / "counter_1.db").write_bytes(b"")
+        (multiproc_dir / "other.txt").write_bytes(b"")
+        metrics.clear_multiprocess_dir()
+        assert [p.name for p in multiproc_dir.iterdir()] == ["other.txt"]
+
+    def test_mark_worker_dead(self, multiproc_dir: Path, mocker: MockFixture) -> None:
+        mock_dead = mocker.patch.object(metrics.multiprocess, "mark_process_dead")
+        metrics.mark_worker_dead(123)
+        mock_dead.assert_called_once_with(123)
+
+    def test_single_process(self, mocker: MockFixture) -> None:
+        mock_dead = mocker.patch.object(metrics.multiprocess, "mark_process_dead")
+        metrics.mark_worker_dead(123)
+        metrics.clear_multiprocess_dir()
+        assert not mock_dead.called
+        assert metrics._metrics_registry() is metrics.REGISTRY
+
+
+class TestAccessLog:
+    @pytest.fixture
+    def app_with_route(self, app: Flask) -> Flask:
+        @app.route("/thing/<thing_id>")
+        def get_thing(thing_id: str) -> Dict:
+            return {"thing_id": thing_id}
+
+        @app.route("/forbidden")
+        def get_forbidden() -> Dict:
+            raise PermissionError("Forbidden")
+
+        metrics.init_metrics(app)
+        return app
+
+    def test_records_logged(
+        self, app_with_route: Flask, caplog: LogCaptureFixture
+    ) -> None:
+        with caplog.at_level(logging.DEBUG):
+            app_with_route.test_client().get(
+                "/thing/1?a=b", headers={"User-Agent": "tests/1.0", "X-Thing": "x"}
+            )
+
+        info, debug = [r for r in caplog.records if hasattr(r, "httpRequest")]
+        assert info.getMessage() == 'GET "get_thing" 200'
+        assert getattr(info, "httpRequest")["userAgent"] == "tests/1.0"
+        assert (
+            getattr(info, "httpRequest")["requestUrl"] == "http://localhost/thing/1?a=b"
+        )
+        assert getattr(debug, "httpRequest") == {
+            "requestXHeaders": {"X-Thing": "x"},
+            "requestQueryParams": {"a": "b"},
+            "requestPathParams": {"thing_id": "1"},
+        }
+
+    def test_sampled_out(
+        self, app_with_route: Flask, caplog: LogCaptureFixture
+    ) -> None:
+        app_with_route.extensions["fbi_access_log_sampler"] = metrics.AccessLogSampler(
+            rates={"get_thing": 0.0}
+        )
+        before = REGISTRY.get_sample_value(
+            "flask_request_count_total",
+            {"method": "GET", "endpoint": "get_thing", "http_status": "200"},
+        )
+        with caplog.at_level(logging.INFO):
+            app_with_route.test_client().get("/thing/1")
+
+        assert not [r for r in caplog.records if hasattr(r, "httpRequest")]
+        # Metrics still count every request
+        assert (
+            REGISTRY.get_sample_value(
+                "flask_request_count_total",
+                {"method": "GET", "endpoint": "get_thing", "http_status": "200"},
+            )
+            == (before or 0) + 1
+        )
+
+    def test_errors_not_sampled_out(
+        self, app_with_route: Flask, caplog: LogCaptureFixture
+    ) -> None:
+        app_with_route.extensions["fbi_access_log_sampler"] = metrics.AccessLogSampler(
+            rates={"get_forbidden": 0.0, "4xx": 0.0}, default_rate=0.0
+        )
+        with caplog.at_level(logging.INFO):
+            for _ in range(3):
+                assert app_with_route.test_client().get("/forbidden").status_code == 403
+
+        records = [r for r in caplog.records if hasattr(r, "httpRequest")]
+        assert [r.getMessage() for r in records] == ['GET "get_forbidden" 403'] * 3
+        assert all(getattr(r, "sampled_weight") == 1.0 for r in records)
+
+    def test_sampled_weight(
+        self, app_with_route: Flask, caplog: LogCaptureFixture, mocker: MockFixture
+    ) -> None:
+        app_with_route.extensions["fbi_access_log_sampler"] = metrics.AccessLogSampler(
+            rates={"2xx": 0.25}
+        )
+        mocker.patch.object(metrics.random, "random", return_value=0.1)
+        with caplog.at_level(logging.INFO):
+            app_with_route.test_client().get("/thing/1")
+
+        (record,) = [r for r in caplog.records if hasattr(r, "httpRequest")]
+        assert getattr(record, "sampled_weight") == 4.0
+
+    def test_records_not_built_when_not_logged(
+        self, app_with_route: Flask, caplog: LogCaptureFixture, mocker: MockFixture
+    ) -> None:
+        mock_details = mocker.patch.object(metrics, "_request_details")
+        mock_additional = mocker.patch.object(metrics, "_additional_details")
+        with caplog.at_level(logging.WARNING):
+            response = app_with_route.test_client().get("/thing/1")
+
+        assert response.status_code == 200
+        assert not mock_details.called
+        assert not mock_additional.called
+
+
+class TestAccessLogSampler:
+    def test_defaults_log_everything(self) -> None:
+        sampler = metrics.AccessLogSampler()
+        assert sampler.weight("endpoint", 200, 0.01) == 1.0
+
+    def test_endpoint_rate_before_status_class(self, mocker: MockFixture) -> None:
+        mocker.patch.object(metrics.random, "random", return_value=0.3)
+        sampler = metrics.AccessLogSampler(
+            rates={"busy": 0.5, "2xx": 0.1}, default_rate=0.0
+        )
+        assert sampler.weight("busy", 200, 0.01) == 2.0
+        assert sampler.weight("other", 200, 0.01) == 0.0
+        assert sampler.weight(None, 302, 0.01) == 0.0
+
+    @pytest.mark.parametrize(
+        "status,latency",
+        [(401, 0.01), (403, 0.01), (404, 0.01), (500, 0.01), (503, 0.01), (200, 2.0)],
+    )
+    def test_errors_and_slow_requests_always_logged(
+        self, status: int, latency: float
+    ) -> None:
+        sampler = metrics.AccessLogSampler(default_rate=0.0, slow_threshold=1.0)
+        assert sampler.weight("busy", status, latency) == 1.0
+
+    def test_sample_proportion(self) -> None:
+        sampler = metrics.AccessLogSampler(default_rate=0.1)
+        weights = [sampler.weight("busy", 200, 0.01) for _ in range(10_000)]
+        assert 700 < sum(1 for w in weights if w) < 1300
+        assert set(weights) == {0.0, 10.0}
+
+    @pytest.mark.parametrize("rates", [{"2xx": 1.5}, {"busy": -0.1}])
+    def test_invalid_rates(self, rates: Dict[str, float]) -> None:
+        with pytest.raises(ValueError):
+            metrics.AccessLogSampler(rates=rates)
+
+
+class TestRequestMetrics:
+    LABELS = {"method": "GET", "endpoint": "get_widget"}
+
+    @pytest.fixture
+    def app_with_route(self, app: Flask) -> Generator[Flask, None, None]:
+        @app.route("/widget/<widget_id>")
+        def get_widget(widget_id: str) -> Dict:
+            return {"widget_id": widget_id}
+
+        yield app
+        # Metrics are process-wide, so put the default buckets back for other tests
+        metrics._use_latency_buckets(tuple(Histogram.DEFAULT_BUCKETS))
+
+    def _sample(self, name: str, **labels: str) -> float:
+        return REGISTRY.get_sample_value(name, {**self.LABELS, **labels}) or 0.0
+
+    def test_latency_buckets(self, app_with_route: Flask) -> None:
+        app_with_route.config["REQUEST_LATENCY_BUCKETS"] = [0.005, 0.05, 0.5]
+        metrics.init_metrics(app_with_route)
+        app_with_route.test_client().get("/widget/1")
+
+        assert self._sample("flask_request_latency_seconds_bucket", le="0.05") == 1.0
+        assert (
+            REGISTRY.get_sample_value(
+                "flask_request_latency_seconds_bucket", {**self.LABELS, "le": "0.1"}
+            )
+            is None
+        )
+
+    def test_endpoint_metrics(self, app_with_route: Flask) -> None:
+        app_with_route.config["REQUEST_METRICS_BY_ENDPOINT"] = {"get_widget": ["count"]}
+        metrics.init_metrics(app_with_route)
+        count = self._sample("flask_request_count_total", http_status="200")
+        histogram = self._sample("flask_request_latency_seconds_count")
+        summary = self._sample("request_processing_seconds_count")
+
+        app_with_route.test_client().get("/widget/1")
+
+        assert self._sample("flask_request_count_total", http_status="200") == count + 1
+        assert self._sample("flask_request_latency_seconds_count") == histogram
+        assert self._sample("request_processing_seconds_count") == summary
+
+    def test_metrics_off(self, app_with_route: Flask) -> None:
+        app_with_route.config["REQUEST_METRICS"] = ["histogram"]
+        metrics.init_metrics(app_with_route)
+        summary = self._sample("request_processing_seconds_count")
+        histogram = self._sample("flask_request_latency_seconds_count")
+
+        app_with_route.test_client().get("/widget/1")
+
+        assert self._sample("flask_request_latency_seconds_count") == histogram + 1
+        assert self._sample("request_processing_seconds_count") == summary
+
+    def test_invalid_profile(self) -> None:
+        with pytest.raises(ValueError):
+            metrics.RequestMetricsProfile(metrics=["gauge"])
+        with pytest.raises(ValueError):
+            metrics.RequestMetricsProfile(
+                endpoint_metrics={"get_widget": ["count", "gauge"]}
+            )
+        with pytest.raises(ValueError):
+            metrics.RequestMetricsProfile(latency_buckets=[0.1, 0.01])
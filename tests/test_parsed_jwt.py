@@ -0,0 +1,195 @@
+import time
+from typing import Any, Dict
+
+import pytest
+from _pytest.monkeypatch import MonkeyPatch
+from flask import Flask
+from jose import jwt as jose_jwt
+from prometheus_client import REGISTRY
+
+from flask_batteries_included.helpers.security import parsed_jwt
+from flask_batteries_included.helpers.security.jwt_parsers import InternalJwtParser
+from flask_batteries_included.helpers.security.parsed_jwt import (
+    MalformedTokenError,
+    ParsedJwt,
+    TokenLimits,
+    check_token_structure,
+    get_token_limits,
+    parse_request_jwt,
+)
+
+ISSUER = "http://localhost/"
+
+
+@pytest.fixture
+def claims() -> Dict[str, Any]:
+    return {
+        "iss": ISSUER,
+        "aud": ISSUER,
+        "exp": int(time.time()) + 600,
+        "metadata": {"clinician_id": "12345"},
+        "scope": "read:foo write:foo",
+    }
+
+
+def test_parse_once(claims: Dict[str, Any]) -> None:
+    token = jose_jwt.encode(claims, "secret", algorithm="HS256", headers={"kid": "a"})
+    parsed = ParsedJwt(token)
+    assert parsed.claims == jose_jwt.get_unverified_claims(token)
+    assert parsed.header == jose_jwt.get_unverified_header(token)
+    assert parsed.header["kid"] == "a"
+    assert str(parsed) == token
+
+
+@pytest.mark.parametrize(
+    "token", ["", "FOO.BAR", "a.b.c", "e30.W10.c2ln", "W10.e30.c2ln"]
+)
+def test_parse_invalid(token: str) -> None:
+    with pytest.raises(jose_jwt.JWTError):
+        ParsedJwt(token)
+
+
+def test_verify(claims: Dict[str, Any]) -> None:
+    token = jose_jwt.encode(claims, "secret", algorithm="HS256")
+    verified = ParsedJwt(token).verify(
+        "secret", algorithms=["HS256"], audience=ISSUER, issuer=ISSUER
+    )
+    assert verified == jose_jwt.decode(
+        token, "secret", algorithms=["HS256"], audience=ISSUER, issuer=ISSUER
+    )
+
+
+def test_verify_bad_signature(claims: Dict[str, Any]) -> None:
+    token = jose_jwt.encode(claims, "whoops", algorithm="HS256")
+    with pytest.raises(jose_jwt.JWTError):
+        ParsedJwt(token).verify(
+            "secret", algorithms=["HS256"], audience=ISSUER, issuer=ISSUER
+        )
+
+
+def test_verify_disallowed_algorithm(claims: Dict[str, Any]) -> None:
+    token = jose_jwt.encode(claims, "secret", algorithm="HS512")
+    with pytest.raises(jose_jwt.JWTError):
+        ParsedJwt(token).verify(
+            "secret", algorithms=["HS256"], audience=ISSUER, issuer=ISSUER
+        )
+
+
+def test_verify_expired(claims: Dict[str, Any]) -> None:
+    claims["exp"] = int(time.time()) - 10
+    token = jose_jwt.encode(claims, "secret", algorithm="HS256")
+    with pytest.raises(jose_jwt.ExpiredSignatureError):
+        ParsedJwt(token).verify(
+            "secret", algorithms=["HS256"], audience=ISSUER, issuer=ISSUER
+        )
+
+
+def test_verify_wrong_audience(claims: Dict[str, Any]) -> None:
+    token = jose_jwt.encode(claims, "secret", algorithm="HS256")
+    with pytest.raises(jose_jwt.JWTClaimsError):
+        ParsedJwt(token).verify(
+            "secret", algorithms=["HS256"], audience="nope", issuer=ISSUER
+        )
+
+
+def test_verify_disabled(claims: Dict[str, Any]) -> None:
+    claims["exp"] = int(time.time()) - 10
+    token = jose_jwt.encode(claims, "whoops", algorithm="HS256")
+    options = InternalJwtParser._construct_verification_options(False)
+    assert ParsedJwt(token).verify("secret", ["HS256"], options=options) == claims
+
+
+def test_private_api_available() -> None:
+    # Fails if python-jose renames the internals ParsedJwt.verify relies on
+    assert parsed_jwt._has_private_api()
+
+
+class TestPublicApiFallback:
+    @pytest.fixture(autouse=True)
+    def no_private_api(self, monkeypatch: MonkeyPatch) -> None:
+        # Deleting the private functions would break jose's own decode, which uses them
+        monkeypatch.setattr(parsed_jwt, "_has_private_api", lambda: False)
+
+    def test_verify(self, claims: Dict[str, Any]) -> None:
+        token = jose_jwt.encode(claims, "secret", algorithm="HS256")
+        assert (
+            ParsedJwt(token).verify(
+                "secret", algorithms=["HS256"], audience=ISSUER, issuer=ISSUER
+            )
+            == claims
+        )
+
+    def test_verify_bad_signature(self, claims: Dict[str, Any]) -> None:
+        token = jose_jwt.encode(claims, "whoops", algorithm="HS256")
+        with pytest.raises(jose_jwt.JWTError):
+            ParsedJwt(token).verify(
+                "secret", algorithms=["HS256"], audience=ISSUER, issuer=ISSUER
+            )
+
+    def test_verify_expired(self, claims: Dict[str, Any]) -> None:
+        claims["exp"] = int(time.time()) - 10
+        token = jose_jwt.encode(claims, "secret", algorithm="HS256")
+        with pytest.raises(jose_jwt.ExpiredSignatureError):
+            ParsedJwt(token).verify(
+                "secret", algorithms=["HS256"], audience=ISSUER, issuer=ISSUER
+            )
+
+    def test_verify_disabled(self, claims: Dict[str, Any]) -> None:
+        claims["exp"] = int(time.time()) - 10
+        token = jose_jwt.encode(claims, "whoops", algorithm="HS256")
+        options = InternalJwtParser._construct_verification_options(False)
+        assert ParsedJwt(token).verify("secret", ["HS256"], options=options) == claims
+
+
+def test_parser_accepts_parsed_jwt(claims: Dict[str, Any]) -> None:
+    parser = InternalJwtParser(
+        required_audience=ISSUER,
+        required_issuer=ISSUER,
+        allowed_algorithms=["HS256"],
+        hs_key="secret",
+    )
+    parsed = ParsedJwt(jose_jwt.encode(claims, "secret", algorithm="HS256"))
+    jwt_claims, jwt_scopes = parser.decode_jwt(parsed, parsed.header)
+    assert jwt_claims["clinician_id"] == "12345"
+    assert jwt_scopes == ["read:foo", "write:foo"]
+
+
+@pytest.mark.parametrize(
+    "token,reason",
+    [
+        ("a" * 101, "too_long"),
+        ("a" * 21 + ".b.c", "header_too_long"),
+        ("a" * 30, "header_too_long"),
+        ("a.b", "segments"),
+        ("a.b.c.d", "segments"),
+        ("a..c", "segments"),
+        ("a.b+/.c", "alphabet"),
+        ("a.b.c=", "alphabet"),
+    ],
+)
+def test_check_token_structure_rejects(token: str, reason: str) -> None:
+    before = (
+        REGISTRY.get_sample_value("jwt_malformed_token_count_total", {"reason": reason})
+        or 0
+    )
+    with pytest.raises(MalformedTokenError) as e:
+        check_token_structure(token, TokenLimits(max_length=100, max_header_length=20))
+    assert getattr(e.value, "reason") == reason
+    assert (
+        REGISTRY.get_sample_value("jwt_malformed_token_count_total", {"reason": reason})
+        == before + 1
+    )
+
+
+def test_check_token_structure_accepts(claims: Dict[str, Any]) -> None:
+    token = jose_jwt.encode(claims, "secret", algorithm="HS256")
+    check_token_structure(token, TokenLimits())
+    check_token_structure("e30.e30.", TokenLimits())
+
+
+def test_token_limits_from_config(app: Flask) -> None:
+    app.config["JWT_MAX_TOKEN_LENGTH"] = 50
+    with app.app_context():
+        assert get_token_limits().max_length == 50
+        with pytest.raises(MalformedTokenError):
+            parse_request_jwt("a" * 20 + "." + "b" * 20 + "." + "c" * 20)
@@ -1,14 +1,22 @@
+import asyncio
+import inspect
 import logging
 import os
+import threading
 from typing import Any, Dict, Generator
 from unittest.mock import Mock
 
 import pytest
 from _pytest.logging import LogCaptureFixture
-from flask import Blueprint, Flask, Response, jsonify
+from flask import Blueprint, Flask, Response, g, jsonify
+from prometheus_client import REGISTRY
 
-from flask_batteries_included.helpers.security import protected_route
+from flask_batteries_included.helpers.security import (
+    init_jwt_validation,
+    protected_route,
+)
 from flask_batteries_included.helpers.security.endpoint_security import scopes_present
+from flask_batteries_included.helpers.security.jwt_parsers import InternalJwtParser
 
 app_protected_routes = Blueprint("protected_routes", __name__)
 
@@ -101,3 +109,115 @@ def test_protection(
         assert response.json == {"result": True}
     else:
         assert "missing required scopes: ['hello:world']" in caplog.text
+
+
+@pytest.mark.parametrize("ignore_validation", [True], indirect=True)
+def test_validation_plan_resolved_once(
+    app: Flask,
+    client: Any,
+    app_protected: None,
+    ignore_validation: bool,
+    mocker: Any,
+) -> None:
+    # Config is read by the first protected request, not on every request
+    assert client.get("/secured_development").status_code == 200
+    app.config["IGNORE_JWT_VALIDATION"] = False
+    mock_app_context = mocker.spy(app, "app_context")
+    response = client.get("/secured_development")
+    assert response.status_code == 200
+    mock_app_context.assert_not_called()
+
+
+@pytest.mark.parametrize("ignore_validation", [True], indirect=True)
+def test_validation_plan_reset(
+    app: Flask, client: Any, app_protected: None, ignore_validation: bool
+) -> None:
+    assert client.get("/secured_development").status_code == 200
+    app.config["IGNORE_JWT_VALIDATION"] = False
+    init_jwt_validation(app)
+    assert client.get("/secured_development").status_code == 403
+
+
+@protected_route(scopes_present(required_scopes="hello:world"))
+async def async_view() -> str:
+    return "async result"
+
+
+@pytest.mark.parametrize("jwt_scopes", ["hello:world"])
+def test_async_view(app: Flask, mock_bearer_authorization: Dict, mocker: Any) -> None:
+    decode_threads = []
+    original_decode = InternalJwtParser.decode_jwt
+
+    def record_thread(*args: Any, **kwargs: Any) -> Any:
+        decode_threads.append(threading.current_thread().name)
+        return original_decode(*args, **kwargs)
+
+    mocker.patch.object(
+        InternalJwtParser, "decode_jwt", autospec=True, side_effect=record_thread
+    )
+    with app.test_request_context(headers=mock_bearer_authorization):
+        assert inspect.iscoroutinefunction(async_view)
+        assert asyncio.run(async_view()) == "async result"
+        assert g.jwt_scopes == ["hello:world"]
+
+    # Verification happened off the event loop
+    assert len(decode_threads) == 1
+    assert decode_threads[0].startswith("jwt-verification")
+
+
+@pytest.mark.parametrize("jwt_scopes", ["foo:bar"])
+def test_async_view_denied(app: Flask, mock_bearer_authorization: Dict) -> None:
+    with app.test_request_context(headers=mock_bearer_authorization):
+        with pytest.raises(PermissionError):
+            asyncio.run(async_view())
+
+
+def _validation_count(issuer: str, outcome: str) -> float:
+    return (
+        REGISTRY.get_sample_value(
+            "jwt_validation_latency_seconds_count",
+            {"issuer": issuer, "outcome": outcome},
+        )
+        or 0.0
+    )
+
+
+@pytest.mark.parametrize(
+    "jwt_scopes,expected_outcome",
+    [("hello:world", "ok"), ("foo:bar", "denied_by_policy")],
+)
+def test_validation_metrics(
+    client: Any,
+    app_protected: None,
+    mock_bearer_authorization: Dict,
+    expected_outcome: str,
+) -> None:
+    before = _validation_count("Internal", expected_outcome)
+    client.get("/secured_production", headers=mock_bearer_authorization)
+    assert _validation_count("Internal", expected_outcome) == before + 1
+
+
+def test_validation_metrics_no_token(client: Any, app_protected: None) -> None:
+    before = _validation_count("none", "no_token")
+    client.get("/secured_production")
+    assert _validation_count("none", "no_token") == before + 1
+
+
+@pytest.mark.parametrize(
+    "token",
+    ["a" * 300_000, "not-a-jwt", "bad.to+ken.here"],
+    ids=["long", "segments", "alphabet"],
+)
+def test_malformed_token_rejected_before_decoding(
+    client: Any, app_protected: None, mocker: Any, token: str
+) -> None:
+    mock_parse = mocker.patch(
+        "flask_batteries_included.helpers.security.parsed_jwt.ParsedJwt"
+    )
+    before = _validation_count("none", "malformed_token")
+    response = client.get(
+        "/secured_production", headers={"Authorization": f"Bearer {token}"}
+    )
+    assert response.status_code == 403
+    assert _validation_count("none", "malformed_token") == before + 1
+    assert not mock_parse.called
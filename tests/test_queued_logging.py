@@ -0,0 +1,124 @@
+import logging
+import threading
+from typing import Generator, List
+
+import pytest
+from flask import Flask
+
+from flask_batteries_included.helpers.queued_logging import (
+    QueuedLogHandler,
+    init_queued_logging,
+)
+
+
+class _CollectingHandler(logging.Handler):
+    def __init__(self, gate: threading.Event = None) -> None:
+        super().__init__()
+        self.records: List[logging.LogRecord] = []
+        self.gate = gate
+
+    def emit(self, record: logging.LogRecord) -> None:
+        if self.gate is not None:
+            self.gate.wait(5)
+        self.records.append(record)
+
+
+def _record(msg: str, *args: object) -> logging.LogRecord:
+    return logging.makeLogRecord(
+        {"msg": msg, "args": args, "levelno": logging.INFO, "levelname": "INFO"}
+    )
+
+
+@pytest.fixture
+def root_handlers() -> Generator[None, None, None]:
+    root_logger = logging.getLogger()
+    saved = root_logger.handlers
+    yield
+    for handler in root_logger.handlers:
+        if isinstance(handler, QueuedLogHandler):
+            handler.close()
+    root_logger.handlers = saved
+
+
+def test_records_written_by_background_thread() -> None:
+    target = _CollectingHandler()
+    queued = QueuedLogHandler([target])
+    args = {"claims": "original"}
+
+    queued.handle(_record("claims are %s", args))
+    args["claims"] = "changed"
+    queued.close()
+
+    assert [r.getMessage() for r in target.records] == [
+        "claims are {'claims': 'original'}"
+    ]
+
+
+def test_drop_when_full() -> None:
+    gate = threading.Event()
+    target = _CollectingHandler(gate)
+    queued = QueuedLogHandler([target], queue_size=2, overflow="drop")
+
+    for i in range(10):
+        queued.handle(_record(f"message {i}"))
+    assert queued.dropped > 0
+    dropped = queued.dropped
+
+    gate.set()
+    queued.close()
+
+    messages = [r.getMessage() for r in target.records]
+    assert messages[0] == "message 0"
+    assert len(messages) == 10 - dropped + 1
+    assert f"Dropped {dropped} log records because the log queue was full" in messages
+
+
+def test_block_when_full() -> None:
+    target = _CollectingHandler()
+    queued = QueuedLogHandler([target], queue_size=1, overflow="block")
+    for i in range(50):
+        queued.handle(_record(f"message {i}"))
+    queued.close()
+
+    assert queued.dropped == 0
+    assert len(target.records) == 50
+
+
+def test_handler_levels_respected() -> None:
+    target = _CollectingHandler()
+    target.setLevel(logging.WARNING)
+    queued = QueuedLogHandler([target])
+    queued.handle(_record("info"))
+    queued.close()
+    assert target.records == []
+
+
+def test_request_headers_kept(app: Flask) -> None:
+    target = _CollectingHandler()
+    queued = QueuedLogHandler([target])
+    with app.test_request_context(headers={"X-Client": "tests"}):
+        queued.handle(_record("hello"))
+    queued.close()
+    assert getattr(target.records[0], "X-Client") == "tests"
+
+
+def test_invalid_overflow() -> None:
+    with pytest.raises(ValueError):
+        QueuedLogHandler([], overflow="spill")
+
+
+@pytest.mark.usefixtures("root_handlers")
+def test_init_queued_logging(app: Flask) -> None:
+    target = _CollectingHandler()
+    logging.getLogger().handlers = [target]
+    app.config["LOG_QUEUE_OVERFLOW"] = "block"
+
+    queued = init_queued_logging(app)
+    assert init_queued_logging(app) is queued
+    assert logging.getLogger().handlers == [queued]
+    assert queued.handlers == [target]
+    assert queued.overflow == "block"
+
+    logging.getLogger().warning("via the queue")
+    queued.close()
+    assert "via the queue" in [r.getMessage() for r in target.records]
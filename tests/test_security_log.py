@@ -0,0 +1,174 @@
+import logging
+from typing import Any
+
+import pytest
+from _pytest.logging import LogCaptureFixture
+from flask import Blueprint, Flask, Response, jsonify
+from jose import jwt as jose_jwt
+from she_logging import logger
+
+from flask_batteries_included.helpers.security import protected_route
+from flask_batteries_included.helpers.security import (
+    security_log as security_log_module,
+)
+from flask_batteries_included.helpers.security.endpoint_security import scopes_present
+from flask_batteries_included.helpers.security.jwt import decode_hs_jwt
+from flask_batteries_included.helpers.security.security_log import (
+    SecurityLog,
+    get_security_log,
+)
+
+app_logged_routes = Blueprint("logged_routes", __name__)
+
+
+@app_logged_routes.route("/logged")
+@protected_route(scopes_present(required_scopes="hello:world"))
+def app_logged() -> Response:
+    return jsonify({"result": True})
+
+
+@pytest.fixture
+def app_logged_protected(app: Flask) -> None:
+    app.config["JWT_FAILURE_LOG_SAMPLES"] = 2
+    app.register_blueprint(app_logged_routes)
+
+
+@pytest.fixture(autouse=True)
+def she_logging_configured() -> None:
+    # she_logging replaces the root handlers (and caplog's with them) the first time it is used
+    logger.isEnabledFor(logging.INFO)
+
+
+class TestSecurityLog:
+    def test_samples_per_issuer_and_reason(self) -> None:
+        security_log = SecurityLog(window=60, max_samples=2)
+        assert [security_log.should_log("a", "expired") for _ in range(3)] == [
+            True,
+            True,
+            False,
+        ]
+        assert security_log.should_log("b", "expired") is True
+        assert security_log.should_log("a", "bad_signature") is True
+
+    def test_summary_when_window_ends(self, caplog: LogCaptureFixture) -> None:
+        security_log = SecurityLog(window=60, max_samples=1)
+        for _ in range(4):
+            security_log.should_log("a", "expired")
+        security_log.should_log("b", "expired")
+
+        with caplog.at_level(logging.WARNING):
+            security_log.flush()
+
+        assert len(caplog.records) == 1
+        record = caplog.records[0]
+        assert record.getMessage() == "Suppressed logging of 3 JWT validation failures"
+        assert getattr(record, "jwt_failures") == {"a:expired": 4}
+        # The new window samples afresh
+        assert security_log.should_log("a", "expired") is True
+
+    def test_no_summary_when_nothing_suppressed(
+        self, caplog: LogCaptureFixture
+    ) -> None:
+        security_log = SecurityLog(window=60, max_samples=5)
+        security_log.should_log("a", "expired")
+        with caplog.at_level(logging.WARNING):
+            security_log.flush()
+        assert caplog.records == []
+
+    def test_window_rolls_on_next_failure(
+        self, caplog: LogCaptureFixture, mocker: Any
+    ) -> None:
+        mock_time = mocker.patch("time.monotonic", return_value=1000.0)
+        security_log = SecurityLog(window=60, max_samples=1)
+        security_log.should_log("a", "expired")
+        security_log.should_log("a", "expired")
+
+        mock_time.return_value = 1061.0
+        with caplog.at_level(logging.WARNING):
+            assert security_log.should_log("a", "expired") is True
+        assert "Suppressed logging of 1 JWT validation failures" in caplog.text
+
+    def test_flush_if_due(self, caplog: LogCaptureFixture, mocker: Any) -> None:
+        mock_time = mocker.patch("time.monotonic", return_value=1000.0)
+        security_log = SecurityLog(window=60, max_samples=1)
+        security_log.should_log("a", "expired")
+        security_log.should_log("a", "expired")
+
+        with caplog.at_level(logging.WARNING):
+            security_log.flush_if_due()
+            assert caplog.records == []
+            mock_time.return_value = 1061.0
+            security_log.flush_if_due()
+        assert "Suppressed logging of 1 JWT validation failures" in caplog.text
+
+    def test_flushed_at_exit(self, caplog: LogCaptureFixture) -> None:
+        security_log = SecurityLog(window=60, max_samples=1)
+        security_log.should_log("a", "expired")
+        security_log.should_log("a", "expired")
+        with caplog.at_level(logging.WARNING):
+            security_log_module._flush_security_logs()
+        assert "Suppressed logging of 1 JWT validation failures" in caplog.text
+
+    def test_per_app(self, app: Flask) -> None:
+        app.config["JWT_FAILURE_LOG_SAMPLES"] = 3
+        with app.app_context():
+            security_log = get_security_log()
+            assert security_log.max_samples == 3
+            assert get_security_log() is security_log
+
+
+def test_invalid_token_flood_is_sampled(
+    client: Any, app_logged_protected: None, caplog: LogCaptureFixture
+) -> None:
+    with caplog.at_level(logging.INFO):
+        for _ in range(10):
+            response = client.get(
+                "/logged", headers={"Authorization": "Bearer not.a.jwt"}
+            )
+            assert response.status_code == 403
+
+    assert caplog.text.count("Failed to decode JWT claim") == 2
+
+
+def test_summary_logged_after_failures_stop(
+    client: Any, app_logged_protected: None, caplog: LogCaptureFixture, mocker: Any
+) -> None:
+    mock_time = mocker.patch("time.monotonic", return_value=1000.0)
+    with caplog.at_level(logging.INFO):
+        for _ in range(3):
+            client.get("/logged", headers={"Authorization": "Bearer not.a.jwt"})
+        assert "Suppressed logging" not in caplog.text
+
+        # A later request without a failure reports the closed window
+        mock_time.return_value = 1061.0
+        client.get("/logged")
+    assert "Suppressed logging of 1 JWT validation failures" in caplog.text
+
+
+def test_permission_error_omits_claim_values(
+    client: Any, app_logged_protected: None, caplog: LogCaptureFixture
+) -> None:
+    claims = {
+        "iss": "http://localhost/",
+        "scope": "foo:bar",
+        "metadata": {"locations": [{"id": f"location-{i}"} for i in range(100)]},
+    }
+    token = jose_jwt.encode(claims, "secret", algorithm="HS256")
+    with caplog.at_level(logging.INFO):
+        response = client.get("/logged", headers={"Authorization": f"Bearer {token}"})
+
+    assert response.status_code == 403
+    assert "not valid for call to" in caplog.text
+    assert "location-99" not in caplog.text
+
+
+def test_decode_hs_jwt_failures_are_sampled(
+    app: Flask, caplog: LogCaptureFixture
+) -> None:
+    app.config["JWT_FAILURE_LOG_SAMPLES"] = 1
+    token = jose_jwt.encode({"sub": "x"}, "secret", algorithm="HS256")
+    with app.app_context(), caplog.at_level(logging.ERROR):
+        for _ in range(3):
+            assert decode_hs_jwt("wrong", token, ["HS256"], {}) is None
+
+    assert caplog.text.count("Access attempted with incorrect JWT token") == 1